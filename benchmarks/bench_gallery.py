@@ -0,0 +1,92 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmark reading fingerprint galleries.
+
+Run like this::
+
+  $ python benchmarks/bench_gallery.py              # 1M records
+  $ python benchmarks/bench_gallery.py -n 10000     # less records
+
+Builds a gallery with fake templates in a temporary directory and
+measures build time, open time and random lookups.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+os.environ.setdefault('KIVY_NO_ARGS', '1')  # keep kivy off our options
+from waeup.identifier.gallery import (  # noqa: E402
+    write_gallery, append_to_gallery, compact_gallery, GalleryReader,
+    )
+
+
+def fake_entries(num, size):
+    template = b'FP1' + b'x' * (size - 3)
+    for n in range(num):
+        yield ('AA%07d' % n, 1, template)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--num', type=int, default=1000000,
+                        help="Number of records (default: 1000000).")
+    parser.add_argument('-s', '--size', type=int, default=128,
+                        help="Size of each template (default: 128).")
+    parser.add_argument('-l', '--lookups', type=int, default=100000,
+                        help="Number of random lookups (default: 100000).")
+    args = parser.parse_args()
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'bench.fpg')
+    try:
+        secs, num = timed(
+            write_gallery, path, fake_entries(args.num, args.size))
+        print("build:   %8.3f s for %s records, %s bytes" % (
+            secs, num, os.path.getsize(path)))
+        for n in range(1000):
+            append_to_gallery(path, 'BB%07d' % n, 1, b'FP1-appended')
+        secs, gallery = timed(GalleryReader, path)
+        print("open:    %8.3f ms (1000 appended records)" % (secs * 1000))
+        ids = ['AA%07d' % random.randrange(args.num)
+               for x in range(args.lookups)]
+        start = time.perf_counter()
+        for student_id in ids:
+            gallery.get(student_id, 1)
+        secs = time.perf_counter() - start
+        print("hits:    %8.2f us/lookup" % (secs / args.lookups * 1e6))
+        start = time.perf_counter()
+        for student_id in ids:
+            gallery.get('Z' + student_id, 1)
+        secs = time.perf_counter() - start
+        print("misses:  %8.2f us/lookup" % (secs / args.lookups * 1e6))
+        gallery.close()
+        secs, result = timed(compact_gallery, path)
+        print("compact: %8.3f s (%s entries)" % (secs, result[0]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmark idle mode: CPU load of the app, active and idle.
+
+Run like this::
+
+  $ python benchmarks/bench_idle.py
+  $ python benchmarks/bench_idle.py --seconds 30 --idle-fps 1
+
+Starts the app (with a fresh home dir) on its main screen, lets it
+settle and measures the CPU load of the whole process while active
+and while in idle mode. Prints the loads and the wakeup latency: the
+time from an event arriving while idle until the first frame at full
+rate. Events are injected from a thread, outside the clock loop, at a
+random point of the idle frame, like touches or scanner results. They
+wait for the next idle frame, so the latency can be up to 1/idle_fps.
+
+Needs a display.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def child(seconds, idle_fps, wakeups):
+    from kivy.clock import Clock, mainthread
+    from waeup.identifier import app
+    from waeup.identifier.app import FPScanApp
+    results = dict()
+
+    class BenchApp(FPScanApp):
+        kv_file = os.path.join(os.path.dirname(app.__file__), 'fpscan.kv')
+
+        def on_start(self):
+            super(BenchApp, self).on_start()
+            self.idle_mode.timeout = 0  # we switch modes ourselves
+            self.idle_mode.idle_fps = idle_fps
+            Clock.schedule_once(self.measure_active, 2)
+
+        def measure_active(self, dt):
+            self.mark = (time.monotonic(), time.process_time())
+            Clock.schedule_once(self.measure_idle, seconds)
+
+        def load(self):
+            wall, cpu = time.monotonic(), time.process_time()
+            return (cpu - self.mark[1]) * 100.0 / (wall - self.mark[0])
+
+        def measure_idle(self, dt):
+            results['active'] = self.load()
+            self.idle_mode.set_idle(True)
+            self.mark = (time.monotonic(), time.process_time())
+            Clock.schedule_once(self.wake, seconds)
+
+        def wake(self, dt):
+            results['idle'] = self.load()
+            results['wake'] = []
+            self.inject()
+
+        def inject(self, dt=None):
+            self.idle_mode.set_idle(True)
+            thread = threading.Thread(target=self.send_event)
+            thread.daemon = True
+            thread.start()
+
+        def send_event(self):
+            # let the clock fall asleep, then hit a random point of the
+            # idle frame from outside the clock loop
+            time.sleep((1.0 + random.random()) / idle_fps)
+            self.sent = time.monotonic()
+            self.receive_event()
+
+        @mainthread
+        def receive_event(self):
+            self.idle_mode.poke()
+            Clock.schedule_once(self.first_frame)
+
+        def first_frame(self, dt):
+            # the first frame at full rate
+            results['wake'].append(time.monotonic() - self.sent)
+            if len(results['wake']) < wakeups:
+                Clock.schedule_once(self.inject, 0.5)
+            else:
+                self.stop()
+
+    BenchApp().run()
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--seconds', type=float, default=10,
+                        help="Seconds to measure each state (default: 10).")
+    parser.add_argument('--idle-fps', type=float, default=2,
+                        help="Frames per second while idle (default: 2).")
+    parser.add_argument('-w', '--wakeups', type=int, default=10,
+                        help="Number of wakeups to measure (default: 10).")
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.seconds, args.idle_fps, args.wakeups)
+    env = dict(os.environ, HOME=tempfile.mkdtemp(), KIVY_NO_ARGS='1',
+               KIVY_NO_CONSOLELOG='1')
+    output = subprocess.check_output(
+        [sys.executable, __file__, '--child', '--seconds', str(args.seconds),
+         '--idle-fps', str(args.idle_fps), '--wakeups', str(args.wakeups)],
+        env=env)
+    results = json.loads(output.decode().strip().splitlines()[-1])
+    print("active  %6.1f %% CPU" % results['active'])
+    print("idle    %6.1f %% CPU" % results['idle'])
+    wake = results['wake']
+    print("wakeup  %6.1f ms average, %.1f ms max (idle frame: %.1f ms)" % (
+        sum(wake) * 1000 / len(wake), max(wake) * 1000,
+        1000 / args.idle_fps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmark the student roster.
+
+Run like this::
+
+  $ python benchmarks/bench_roster.py
+  $ python benchmarks/bench_roster.py --students 500000
+
+Writes a roster file with random student ids, loads it and prints
+load time, memory used (compared to a `set` of the same ids) and the
+time per completion and membership lookup.
+"""
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+os.environ.setdefault('KIVY_NO_ARGS', '1')  # keep kivy off our options
+from waeup.identifier.app import RE_STUDENT_ID  # noqa: E402
+from waeup.identifier.roster import read_roster_file  # noqa: E402
+
+
+def make_ids(num):
+    rnd = random.Random(0)
+    result = set()
+    while len(result) < num:
+        result.add('%s%05d' % (
+            ''.join(rnd.choice(string.ascii_uppercase) for x in range(2)),
+            rnd.randrange(100000)))
+    return sorted(result)
+
+
+def per_call(func, args):
+    start = time.perf_counter()
+    for arg in args:
+        func(arg)
+    return (time.perf_counter() - start) / len(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--students', type=int, default=200000,
+                        help="Number of student ids (default: 200000).")
+    args = parser.parse_args()
+    student_ids = make_ids(args.students)
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w') as roster_file:
+        roster_file.write('\n'.join(student_ids))
+    try:
+        start = time.perf_counter()
+        roster, skipped = read_roster_file(path, RE_STUDENT_ID)
+        load_time = time.perf_counter() - start
+    finally:
+        os.unlink(path)
+    tracemalloc.start()
+    id_set = set(''.join(sid) for sid in student_ids)  # fresh strings
+    set_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del id_set
+    samples = random.Random(1).sample(student_ids, 1000)
+    prefixes = [sid[:3] for sid in samples] + [sid[:5] for sid in samples]
+    print("ids         %10d" % len(roster))
+    print("load        %10.1f ms" % (load_time * 1000))
+    print("memory      %10.1f KB (set of str: %.1f KB)" % (
+        roster.nbytes / 1024.0, set_size / 1024.0))
+    print("complete    %10.1f us" % (
+        per_call(roster.complete, prefixes) * 1e6))
+    print("contains    %10.1f us" % (
+        per_call(roster.__contains__, samples) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
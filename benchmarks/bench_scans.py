@@ -0,0 +1,94 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmark scanner backends.
+
+Run like this::
+
+  $ python benchmarks/bench_scans.py
+  $ python benchmarks/bench_scans.py --runs 5000 --threads 8
+
+Runs scans with captures (like enrollments do) through the subprocess
+backend with the `fake_fpscan` script and through the simulated
+backend and prints scans per second.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+os.environ.setdefault('KIVY_NO_ARGS', '1')  # keep kivy off our options
+import waeup.identifier  # noqa: E402
+from waeup.identifier.app import FPScanCommand, TemplateBuffer  # noqa: E402
+from waeup.identifier.backends import (  # noqa: E402
+    SimulatedBackend, SubprocessBackend,
+    )
+
+
+def create_fake_fpscan(path):
+    src = os.path.join(os.path.dirname(waeup.identifier.__file__),
+                       'fake_fpscan')
+    with open(src) as fd:
+        content = fd.read()
+    with open(path, 'w') as fd:
+        fd.write('#!%s\n' % sys.executable)
+        fd.write(content)
+    os.chmod(path, 0o755)
+    return path
+
+
+def run_scans(backend, path, runs, threads):
+    def worker(num):
+        for x in range(num):
+            cmd = FPScanCommand(
+                path, ['-s'], capture=TemplateBuffer(), backend=backend)
+            cmd.run()
+            assert cmd.returncode == 0
+    start = time.perf_counter()
+    workers = [
+        threading.Thread(target=worker, args=(runs // threads, ))
+        for x in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (runs // threads * threads) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-r', '--runs', type=int, default=1000,
+                        help="Scans per simulated run (default: 1000).")
+    parser.add_argument('-s', '--subprocess-runs', type=int, default=20,
+                        help="Scans per subprocess run (default: 20).")
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help="Concurrent scanning threads (default: 1).")
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    path = create_fake_fpscan(os.path.join(workdir, 'fpscan'))
+    print("backend      scans/s")
+    for backend, runs in (
+            (SubprocessBackend(), args.subprocess_runs),
+            (SimulatedBackend(template_size=800), args.runs)):
+        print("%-10s %9.1f" % (
+            backend.name, run_scans(backend, path, runs, args.threads)))
+
+
+if __name__ == '__main__':
+    main()
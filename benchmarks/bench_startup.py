@@ -0,0 +1,106 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmark app startup: time to first frame.
+
+Run like this::
+
+  $ python benchmarks/bench_startup.py
+  $ python benchmarks/bench_startup.py --runs 10
+
+Starts the app several times in fresh processes (with a fresh home
+dir) and reports the median time from process start to the first
+frame drawn, with screens built lazily (the default) and with all
+screens built upfront. Also compares loading the icons as single files
+and from the icons atlas.
+
+Needs a display.
+"""
+import time
+START = time.perf_counter()
+import argparse  # noqa: E402
+import os  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+
+VARIANTS = ('lazy', 'eager', 'icon-files', 'icon-atlas')
+
+
+def child(variant):
+    os.environ.setdefault('KIVY_NO_ARGS', '1')
+    from kivy.core.window import Window  # textures need a GL context
+    if variant.startswith('icon-'):
+        from kivy.core.image import Image as CoreImage
+        from waeup.identifier.app import IMAGES_PATH, ICONS_ATLAS
+        start = time.perf_counter()
+        if variant == 'icon-files':
+            for name in sorted(os.listdir(IMAGES_PATH)):
+                if name.endswith('.png') and not name.startswith('icons'):
+                    CoreImage(os.path.join(IMAGES_PATH, name))
+        else:
+            CoreImage('%s/waeupicon' % ICONS_ATLAS)
+        print(time.perf_counter() - start)
+        return
+    from waeup.identifier import app
+    from waeup.identifier.app import FPScanApp, LAZY_SCREENS
+
+    class BenchApp(FPScanApp):
+        kv_file = os.path.join(os.path.dirname(app.__file__), 'fpscan.kv')
+
+        def on_start(self):
+            super(BenchApp, self).on_start()
+            if variant == 'eager':
+                for name in LAZY_SCREENS:
+                    self.get_screen(name)
+            Window.bind(on_flip=self.first_frame)
+
+        def first_frame(self, *args):
+            Window.unbind(on_flip=self.first_frame)
+            print(time.perf_counter() - START)
+            self.stop()
+
+    BenchApp().run()
+
+
+def measure(variant, runs):
+    results = []
+    for num in range(runs):
+        env = dict(os.environ, HOME=tempfile.mkdtemp(), KIVY_NO_ARGS='1',
+                   KIVY_NO_CONSOLELOG='1')
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--child', variant], env=env)
+        results.append(float(output.decode().strip().splitlines()[-1]))
+    return statistics.median(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-r', '--runs', type=int, default=5,
+                        help="Number of runs per variant (default: 5).")
+    parser.add_argument('--child', choices=VARIANTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+    for variant in VARIANTS:
+        print("%-10s %8.1f ms" % (
+            variant, measure(variant, args.runs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -63,11 +63,19 @@ setup(
         docs=[
             'Sphinx',
             'sphinx_rtd_theme',
-        ]
+        ],
+        photos=[
+            'Pillow',
+        ],
+        watch=[
+            'inotify_simple',
+        ],
     ),
     entry_points="""
     [console_scripts]
     waeup_identifier = waeup.identifier:main
     fake_kofa_server = waeup.identifier.testing:start_fake_kofa
+    waeup_gallery_compact = waeup.identifier.gallery:compact_gallery_main
+    waeup_soak = waeup.identifier.soak:soak_main
     """,
 )
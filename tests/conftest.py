@@ -1,10 +1,11 @@
 # fixtures for py.test.
 #
 # py.test finds them automatically if put in a file called `conftest.py`.
+import contextlib
 import pytest
 import threading
 import xmlrpc.client as xmlrpcclient
-from waeup.identifier.testing import AuthenticatingXMLRPCServer
+from waeup.identifier.testing import AuthenticatingXMLRPCServer, fake_kofa
 
 
 @pytest.fixture(scope="function")
@@ -48,3 +49,29 @@ def waeup_proxy(request, waeup_server):
     proxy.reset_student_db()                      # clean up before test
     request.addfinalizer(proxy.reset_student_db)  # clean up after
     return proxy
+
+
+@pytest.fixture(scope="function")
+def kofa_server(request):
+    """A fake Kofa server on a free port with its own student database.
+
+    Use its `url` to talk to it. Different to `waeup_server`, every
+    test gets a fresh server, and tests using it can run in parallel.
+    """
+    with fake_kofa() as server:
+        yield server
+
+
+@pytest.fixture(scope="function")
+def kofa_servers(request):
+    """A factory for any number of isolated fake Kofa servers.
+
+    Call it with the arguments accepted by `testing.fake_kofa` to get a
+    running server. All servers are stopped after the test.
+    """
+    stack = contextlib.ExitStack()
+    request.addfinalizer(stack.close)
+
+    def factory(**kw):
+        return stack.enter_context(fake_kofa(**kw))
+    return factory
@@ -2,13 +2,24 @@ import os
 import pytest
 import stat
 import sys
+import threading
 import time
 import unittest
 import waeup.identifier
+from unittest import mock
 from waeup.identifier.app import (
     FPScanApp, detect_scanners, check_path, fpscan, scan,
-    BackgroundCommand, FPScanCommand, RE_STUDENT_ID
+    BackgroundCommand, FPScanCommand, RE_STUDENT_ID, find_scanners,
+    ResultJoin, Prefetcher, EnrollmentSession, ThroughputCounter, Warmup,
+    get_fpm_path, read_fpm_file, TemplateBuffer, arm_scanner, BlockingMeter,
+    ActivityLog, ActivityList, ACTIVITY_SIZE, IdleMode, StudentIdInput,
+    get_spool_dir, spool_fingerprints, get_spooled, upload_spooled,
+    get_rejected_dir, read_spool_file, discard_spooled,
+    SuggestionBar,
     )
+from waeup.identifier.backends import SimulatedBackend, set_backend
+from waeup.identifier.roster import Roster
+from waeup.identifier.wire import binary_dumps, binary_view
 from waeup.identifier.testing import (
     VirtualHomeProvider, VirtualHomingTestCase, create_fpscan,
     create_executable, create_python_script
@@ -144,6 +155,594 @@ class DetectScannersTests(VirtualHomingTestCase):
             ]
 
 
+class ArmScannerTests(VirtualHomingTestCase):
+
+    def create_fpscan(self, output):
+        path = os.path.join(self.path_dir, 'fpscan')
+        with open(path, 'w') as fd:
+            fd.write('#!%s\nprint("%s")\n' % (sys.executable, output))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def test_invalid_path(self):
+        # invalid fpscan paths are reported
+        assert arm_scanner('invalid_path', ['-s']) == (
+            'invalid-path', [], None)
+
+    def test_no_scanner(self):
+        # missing scanners are reported
+        path = self.create_fpscan('0')
+        assert arm_scanner(path, ['-s']) == ('no-scanner', [], None)
+
+    def test_armed(self):
+        # we get a scan command ready to start
+        path = self.create_fpscan('My Scanner\\n  2 0 1 0 1 384 290')
+        error, scanners, cmd = arm_scanner(path, ['-s'])
+        assert error is None
+        assert scanners == ['My Scanner']
+        assert isinstance(cmd, FPScanCommand)
+        assert cmd.cmd == [path, '-s']
+        assert cmd.is_alive() is False
+
+    def test_known_scanners(self):
+        # we do not detect scanners again if we know them
+        path = self.create_fpscan('0')
+        error, scanners, cmd = arm_scanner(path, ['-s'], scanners=['Mine'])
+        assert error is None
+        assert scanners == ['Mine']
+
+
+class BlockingMeterTests(unittest.TestCase):
+
+    def test_measure(self):
+        # we measure blocking times per action
+        meter = BlockingMeter(budget=0.05)
+        with meter.measure('fast'):
+            pass
+        for x in range(2):
+            with meter.measure('slow'):
+                time.sleep(0.06)
+        stats = meter.get_stats()
+        assert stats['fast']['count'] == 1
+        assert stats['fast']['over_budget'] == 0
+        assert stats['slow']['count'] == 2
+        assert stats['slow']['over_budget'] == 2
+        assert stats['slow']['max'] >= 0.06
+
+    def test_measure_exception(self):
+        # failing actions are measured as well
+        meter = BlockingMeter()
+        with pytest.raises(ValueError):
+            with meter.measure('failing'):
+                raise ValueError()
+        assert meter.get_stats()['failing']['count'] == 1
+
+
+class FPMFileTests(VirtualHomingTestCase):
+
+    def test_get_fpm_path(self):
+        # we get separate paths for separate fingers
+        assert get_fpm_path().endswith('data.fpm')
+        assert get_fpm_path(2).endswith('data-2.fpm')
+
+    def test_read_fpm_file(self):
+        # we can read valid fpm files
+        path = os.path.join(self.path_dir, 'data.fpm')
+        with open(path, 'wb') as fd:
+            fd.write(b'FP1-fake')
+        assert read_fpm_file(path) == b'FP1-fake'
+
+    def test_read_fpm_file_invalid(self):
+        # we complain about invalid fpm files
+        path = os.path.join(self.path_dir, 'data.fpm')
+        with open(path, 'wb') as fd:
+            fd.write(b'not-a-fingerprint')
+        self.assertRaises(ValueError, read_fpm_file, path)
+
+
+def fill_buffer(buf, content):
+    # let `buf` read `content` from a pipe
+    read_fd, write_fd = os.pipe()
+    thread = threading.Thread(target=buf.read_from, args=(read_fd, ))
+    thread.start()
+    with open(write_fd, 'wb') as fd:
+        fd.write(content)
+    thread.join()
+
+
+class SpoolTests(VirtualHomingTestCase):
+
+    def test_get_spool_dir(self):
+        # the spool dir lives in the home dir
+        assert get_spool_dir() == os.path.join(
+            self.home_dir, '.waeupident-spool')
+        assert get_rejected_dir() == os.path.join(get_spool_dir(), 'rejected')
+
+    def test_spool_fingerprints(self):
+        # all fingerprints of a student are stored in one file
+        path1 = spool_fingerprints('AA11111', {1: b'FP1-a', 2: b'FP1-b'})
+        path2 = spool_fingerprints('BB22222', {1: memoryview(b'FP1-c')})
+        assert path1 == os.path.join(get_spool_dir(), 'AA11111.spool')
+        assert read_spool_file(path1) == {1: b'FP1-a', 2: b'FP1-b'}
+        assert read_spool_file(path2) == {1: b'FP1-c'}
+        assert get_spooled() == {'AA11111': path1, 'BB22222': path2}
+
+    def test_spool_replaces(self):
+        # newer captures replace all older ones of the same student
+        spool_fingerprints('AA11111', {1: b'FP1-old', 2: b'FP1-old'})
+        path = spool_fingerprints('AA11111', {1: b'FP1-new'})
+        assert read_spool_file(path) == {1: b'FP1-new'}
+        assert os.listdir(get_spool_dir()) == ['AA11111.spool']
+
+    def test_read_spool_file_invalid(self):
+        # we complain about files w/o valid fingerprints
+        path = os.path.join(self.path_dir, 'AA11111.spool')
+        for data in (b'invalid', binary_dumps([1]),
+                     binary_dumps({'1': binary_view(b'nonsense')})):
+            with open(path, 'wb') as fd:
+                fd.write(data)
+            self.assertRaises(ValueError, read_spool_file, path)
+
+    def test_get_spooled_empty(self):
+        # no spool dir, no spooled fingerprints
+        assert get_spooled() == {}
+        assert get_spooled(os.path.join(self.path_dir, 'missing')) == {}
+
+    def test_discard_spooled(self):
+        # we can drop outdated fingerprints
+        spool_fingerprints('AA11111', {1: b'FP1-a'})
+        discard_spooled('AA11111')
+        discard_spooled('AA11111')  # no error
+        assert get_spooled() == {}
+
+    def test_upload_spooled(self):
+        # uploaded fingerprints are removed, rejected ones moved away
+        calls = []
+
+        def upload(student_id, fingerprints):
+            calls.append((student_id, fingerprints))
+            if student_id == 'BB22222':
+                return "Error 1: No such student"
+            elif student_id == 'CC33333':
+                raise ConnectionRefusedError("down")
+            return True
+        for student_id in ('AA11111', 'BB22222', 'CC33333'):
+            spool_fingerprints(student_id, {1: b'FP1-a'})
+        uploaded, failed, rejected = upload_spooled(upload)
+        assert uploaded == ['AA11111']
+        assert failed == {'CC33333': "Error: down"}
+        assert rejected == {'BB22222': "Error 1: No such student"}
+        assert [x[0] for x in calls] == ['AA11111', 'BB22222', 'CC33333']
+        assert calls[0][1] == {1: b'FP1-a'}
+        # rejected files are not tried again, failed ones are
+        assert list(get_spooled()) == ['CC33333']
+        assert os.listdir(get_rejected_dir()) == ['BB22222.spool']
+
+    def test_upload_spooled_invalid(self):
+        # invalid files are rejected w/o upload
+        os.makedirs(get_spool_dir())
+        path = os.path.join(get_spool_dir(), 'AA11111.spool')
+        with open(path, 'wb') as fd:
+            fd.write(b'invalid')
+        uploaded, failed, rejected = upload_spooled(lambda sid, fps: True)
+        assert (uploaded, failed) == ([], {})
+        assert list(rejected) == ['AA11111']
+        assert get_spooled() == {}
+
+    def test_discard_waits_for_resend(self):
+        # newer captures are uploaded only after a running resend
+        events = []
+        uploading, proceed = threading.Event(), threading.Event()
+
+        def upload(student_id, fingerprints):
+            uploading.set()
+            proceed.wait(5)
+            events.append('resent')
+            return True
+        spool_fingerprints('AA11111', {1: b'FP1-old'})
+        resend = threading.Thread(target=upload_spooled, args=(upload, ))
+        resend.start()
+        uploading.wait(5)
+        discard = threading.Thread(target=lambda: (
+            discard_spooled('AA11111'), events.append('discarded')))
+        discard.start()
+        time.sleep(0.05)
+        assert events == []
+        proceed.set()
+        resend.join()
+        discard.join()
+        assert events == ['resent', 'discarded']
+
+
+class TemplateBufferTests(unittest.TestCase):
+
+    def test_read_from(self):
+        # we can read data from a pipe
+        buf = TemplateBuffer()
+        fill_buffer(buf, b'FP1-fake')
+        assert buf.length == 8
+        assert buf.view() == b'FP1-fake'
+        assert buf.validate() == b'FP1-fake'
+
+    def test_grow_and_reuse(self):
+        # buffers grow if needed and are reused afterwards
+        buf = TemplateBuffer(size=4)
+        fill_buffer(buf, b'FP1' + b'x' * 100)
+        assert buf.view() == b'FP1' + b'x' * 100
+        storage = buf._buf
+        fill_buffer(buf, b'FP1-short')
+        assert buf.view() == b'FP1-short'
+        assert buf._buf is storage
+
+    def test_validate_invalid(self):
+        # we complain about invalid data
+        buf = TemplateBuffer()
+        self.assertRaises(ValueError, buf.validate)
+        fill_buffer(buf, b'invalid')
+        self.assertRaises(ValueError, buf.validate)
+
+
+class EnrollmentSessionTests(VirtualHomingTestCase):
+
+    def create_capture(self, content=b'FP1-fake'):
+        path = os.path.join(self.path_dir, 'capture.fpm')
+        with open(path, 'wb') as fd:
+            fd.write(content)
+        return path
+
+    def test_next_finger(self):
+        # we get the fingers to capture in order
+        session = EnrollmentSession('AA11111', [1, 2])
+        assert session.next_finger() == 1
+        session.add_capture(1, self.create_capture()).join()
+        assert session.next_finger() == 2
+        session.add_capture(2, self.create_capture()).join()
+        assert session.next_finger() is None
+        assert session.fingerprints == {1: b'FP1-fake', 2: b'FP1-fake'}
+
+    def test_invalid_captures_retaken(self):
+        # invalid captures have to be taken again
+        session = EnrollmentSession('AA11111', [1, 2])
+        session.add_capture(1, self.create_capture(b'invalid')).join()
+        assert session.next_finger() == 1
+        assert 1 in session.errors
+        session.add_capture(1, self.create_capture()).join()
+        assert session.errors == {}
+        assert session.next_finger() == 2
+
+    def test_when_validated(self):
+        # we get notified when all captures are validated
+        calls = []
+        session = EnrollmentSession('AA11111', [1])
+        thread = session.add_capture(1, self.create_capture())
+        session.when_validated(calls.append)
+        thread.join()
+        assert calls == [session]
+        session.when_validated(calls.append)  # nothing pending
+        assert calls == [session, session]
+
+    def test_buffer_captures(self):
+        # captures in buffers are kept without copying
+        session = EnrollmentSession('AA11111', [1])
+        buf = session.get_buffer(1)
+        fill_buffer(buf, b'FP1-fake')
+        session.add_capture(1, buf).join()
+        assert isinstance(session.fingerprints[1], memoryview)
+        assert session.fingerprints[1] == b'FP1-fake'
+        # retakes reuse the buffer
+        assert session.get_buffer(1) is buf
+        assert session.fingerprints == {}
+
+    def test_save(self):
+        # we can store captures in the spool dir
+        session = EnrollmentSession('AA11111', [1])
+        session.add_capture(1, self.create_capture()).join()
+        path = session.save()
+        assert path == session.spool_path == get_spooled()['AA11111']
+        assert path.startswith(self.home_dir)
+        assert read_spool_file(path) == {1: b'FP1-fake'}
+        assert not os.path.exists(get_fpm_path(1))
+
+
+class ThroughputCounterTests(unittest.TestCase):
+
+    def test_per_minute(self):
+        # we get jobs per minute since the earliest job started
+        counter = ThroughputCounter()
+        assert counter.per_minute() == 0.0
+        counter.record(100.0, 120.0)
+        counter.record(110.0, 130.0)
+        assert counter.per_minute(now=160.0) == 2.0
+        assert counter.total == 2
+
+    def test_window(self):
+        # old jobs are dropped
+        counter = ThroughputCounter(window=60)
+        counter.record(0.0, 30.0)
+        counter.record(100.0, 120.0)
+        assert counter.per_minute(now=130.0) == 2.0
+        assert counter.total == 2
+
+
+class ActivityLogTests(unittest.TestCase):
+
+    def test_bounded(self):
+        # only the most recent entries are kept, newest first
+        log = ActivityLog(size=3)
+        for num in range(5):
+            log.add('enroll', 'AA%05d' % num, 'ok')
+        rows = log.get_rows()
+        assert log.total == 5
+        assert len(rows) == 3
+        assert rows[0]['text'].endswith('enroll  AA00004: ok')
+        assert rows[2]['text'].endswith('enroll  AA00002: ok')
+
+    def test_failures_colored(self):
+        # failed results are shown in red
+        log = ActivityLog()
+        log.add('verify', 'AA11111', 'match')
+        log.add('verify', 'AA22222', 'FAILED', ok=False)
+        rows = log.get_rows()
+        assert rows[0]['color'] == (1, .4, .4, 1)
+        assert rows[1]['color'] == (.6, .6, .6, 1)
+
+    def test_on_change(self):
+        # entries can be added from several threads
+        changes = []
+        log = ActivityLog(size=50, on_change=lambda: changes.append(1))
+
+        def add_many():
+            for num in range(100):
+                log.add('enroll', 'AA11111', 'ok')
+        threads = [threading.Thread(target=add_many) for num in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert log.total == 400
+        assert len(changes) == 400
+        assert len(log.get_rows()) == 50
+
+
+class ActivityListTests(unittest.TestCase):
+
+    def get_data(self, num):
+        return [dict(text='row %s' % x, color=(1, 1, 1, 1))
+                for x in range(num)]
+
+    def test_visible_rows(self):
+        # only the rows in the viewport are shown, by pooled labels
+        activity_list = ActivityList(height=100, row_height=24)
+        activity_list.data = self.get_data(ACTIVITY_SIZE)
+        assert activity_list.spacer.height == ACTIVITY_SIZE * 24
+        assert len(activity_list.rows) == 6
+        assert activity_list.spacer.children == list(
+            reversed(activity_list.rows))
+        assert [x.text for x in activity_list.rows] == [
+            'row 0', 'row 1', 'row 2', 'row 3', 'row 4', 'row 5']
+        assert activity_list.rows[0].top == ACTIVITY_SIZE * 24
+
+    def test_scrolled(self):
+        # scrolling assigns another slice of data to the same labels
+        activity_list = ActivityList(height=100, row_height=24)
+        activity_list.data = self.get_data(ACTIVITY_SIZE)
+        labels = list(activity_list.rows)
+        activity_list.scroll_y = 0
+        assert activity_list.rows == labels
+        assert labels[0].text == 'row 495'
+        assert labels[0].y == 4 * 24
+        assert labels[-1].text == ''
+        assert labels[-1].opacity == 0
+
+    def test_refresh_touches_pool_only(self):
+        # a refresh only updates the pooled labels, however much data
+        activity_list = ActivityList(height=100, row_height=24)
+        activity_list.data = self.get_data(ACTIVITY_SIZE)
+        labels = list(activity_list.rows)
+        updates = []
+        for label in labels:
+            label.bind(text=lambda *args: updates.append(1))
+        data = self.get_data(ACTIVITY_SIZE + 1)[1:]
+        activity_list.data = data
+        assert activity_list.rows == labels
+        assert len(updates) == len(labels)
+        assert labels[0].text == 'row 1'
+
+    def test_few_rows(self):
+        # unused pooled labels are hidden
+        activity_list = ActivityList(height=100, row_height=24)
+        activity_list.data = self.get_data(2)
+        assert [x.opacity for x in activity_list.rows] == [1, 1, 0, 0, 0, 0]
+        activity_list.data = []
+        assert activity_list.spacer.height == 0
+        assert [x.text for x in activity_list.rows] == [''] * 6
+
+
+class FakeClock(object):
+    _max_fps = 60.0
+
+
+class IdleModeTests(unittest.TestCase):
+
+    def test_idle(self):
+        # without activity the frame rate is lowered, pokes restore it
+        clock = FakeClock()
+        changes = []
+        idle_mode = IdleMode(
+            timeout=10, idle_fps=2, clock=clock,
+            callback=lambda mode, idle: changes.append(idle))
+        start = idle_mode.last_activity
+        assert idle_mode.check(now=start + 5) is False
+        assert idle_mode.check(now=start + 10) is True
+        assert clock._max_fps == 2.0
+        idle_mode.poke()
+        assert idle_mode.idle is False
+        assert clock._max_fps == 60.0
+        assert changes == [True, False]
+
+    def test_busy(self):
+        # busy apps never go idle
+        busy = [True]
+        idle_mode = IdleMode(
+            timeout=10, clock=FakeClock(), busy=lambda: busy[0])
+        start = idle_mode.last_activity
+        assert idle_mode.check(now=start + 20) is False
+        busy[0] = False
+        assert idle_mode.check(now=start + 25) is False
+        assert idle_mode.check(now=start + 30) is True
+
+    def test_disabled(self):
+        # a timeout of zero disables idle mode
+        idle_mode = IdleMode(timeout=0, clock=FakeClock())
+        assert idle_mode.check(now=time.monotonic() + 3600) is False
+
+    def test_stats(self):
+        # wall and CPU time are counted per state
+        idle_mode = IdleMode(clock=FakeClock())
+        idle_mode.set_idle(True)
+        time.sleep(0.01)
+        stats = idle_mode.get_stats()
+        assert stats['idle_time'] >= 0.01
+        assert 0.0 <= stats['idle_cpu'] <= 100.0
+        assert 'idle 0s at' in idle_mode.format()
+
+
+class FindScannersTests(VirtualHomingTestCase):
+
+    def test_find_scanners_no_fpscan(self):
+        # w/o fpscan we get an empty list instead of an exception
+        assert find_scanners('invalid_path') == []
+
+    def test_find_scanners(self):
+        # with scanners available we get them
+        path = create_fpscan(self.path_dir, 'Fake Scanner\\n  1 2 3')
+        assert find_scanners(path) == ['Fake Scanner']
+
+
+class ResultJoinTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def callback(self, join):
+        self.calls.append(join)
+
+    def test_callback_when_all_done(self):
+        # the callback is called once, when all results are in
+        join = ResultJoin(['a', 'b'], self.callback)
+        assert join.set_result('a', 1) is True
+        assert self.calls == []
+        join.result_setter('b')(2)
+        assert self.calls == [join]
+        assert join.results == {'a': 1, 'b': 2}
+
+    def test_unknown_and_repeated_results(self):
+        # we ignore results of unknown or already finished jobs
+        join = ResultJoin(['a', 'b'], self.callback)
+        assert join.set_result('c', 1) is False
+        assert join.set_result('a', 1) is True
+        assert join.set_result('a', 2) is False
+        assert join.results == {'a': 1}
+
+    def test_cancel(self):
+        # canceled joins discard results and do not call back
+        join = ResultJoin(['a'], self.callback)
+        join.cancel()
+        assert join.set_result('a', 1) is False
+        assert self.calls == []
+
+    def test_threads(self):
+        # results can be delivered from background threads
+        join = ResultJoin(['a', 'b'], self.callback)
+        threads = [threading.Thread(target=join.set_result, args=(n, n))
+                   for n in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.calls == [join]
+
+
+class PrefetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.gate = threading.Event()
+        self.results = []
+        self.done = threading.Event()
+
+    def fetch(self, *args):
+        # a slow fake fetch function
+        self.calls.append(args)
+        self.gate.wait(5)
+        return 'result of %s' % (args, )
+
+    def callback(self, result):
+        self.results.append(result)
+        self.done.set()
+
+    def test_hit_while_running(self):
+        # we reuse prefetches that are still running
+        prefetcher = Prefetcher(self.fetch)
+        prefetcher.prefetch('url', 'AA11111')
+        prefetcher.fetch(('url', 'AA11111'), self.callback)
+        assert self.results == []
+        self.gate.set()
+        assert self.done.wait(5)
+        assert self.results == ["result of ('url', 'AA11111')"]
+        assert self.calls == [('url', 'AA11111')]
+        stats = prefetcher.get_stats()
+        assert stats['hits'] == 1
+        assert stats['hit_rate'] == 1.0
+        assert stats['saved_time'] >= 0.0
+
+    def test_hit_when_done(self):
+        # finished prefetches are delivered immediately
+        self.gate.set()
+        prefetcher = Prefetcher(self.fetch)
+        prefetcher.prefetch('url', 'AA11111')
+        for x in range(500):
+            if prefetcher._current['finished'] is not None:
+                break
+            time.sleep(0.01)
+        prefetcher.fetch(('url', 'AA11111'), self.callback)
+        assert self.results == ["result of ('url', 'AA11111')"]
+        assert len(self.calls) == 1
+
+    def test_prefetch_deduplicated(self):
+        # prefetching the same thing twice calls `func` only once
+        self.gate.set()
+        prefetcher = Prefetcher(self.fetch)
+        prefetcher.prefetch('url', 'AA11111')
+        prefetcher.prefetch('url', 'AA11111')
+        prefetcher.fetch(('url', 'AA11111'), self.callback)
+        assert self.done.wait(5)
+        assert len(self.calls) == 1
+
+    def test_miss(self):
+        # changed args cancel stale prefetches
+        self.gate.set()
+        prefetcher = Prefetcher(self.fetch)
+        prefetcher.prefetch('url', 'AA11111')
+        prefetcher.prefetch('url', 'BB11111')
+        prefetcher.cancel()
+        prefetcher.fetch(('url', 'BB11111'), self.callback)
+        assert self.done.wait(5)
+        assert self.results == ["result of ('url', 'BB11111')"]
+        assert prefetcher.get_stats()['misses'] == 1
+        assert prefetcher.get_stats()['hit_rate'] == 0.0
+
+    def test_fetch_consumes(self):
+        # prefetched data is used only once
+        self.gate.set()
+        prefetcher = Prefetcher(self.fetch)
+        prefetcher.prefetch('url', 'AA11111')
+        prefetcher.fetch(('url', 'AA11111'), self.callback)
+        prefetcher.fetch(('url', 'AA11111'), self.callback)
+        assert prefetcher.get_stats()['hits'] == 1
+        assert prefetcher.get_stats()['misses'] == 1
+
+
 class ScanTests(VirtualHomingTestCase):
 
     def test_scan_no_fpscan(self):
@@ -161,18 +760,358 @@ class AppTests(unittest.TestCase, VirtualHomeProvider):
 
     def setUp(self):
         self.setup_virtual_home()
-        fake_fpscan = os.path.join(self.path_dir, 'fpscan')
-        open(fake_fpscan, 'w').write('#!%s\nprint("0")\n' % sys.executable)
-        os.chmod(fake_fpscan, os.stat(fake_fpscan).st_mode | stat.S_IEXEC)
+        # found in $PATH, but run by a simulated backend without devices
+        create_executable(os.path.join(self.path_dir, 'fpscan'), '')
+        self.backend = SimulatedBackend(devices=[])
+        self.old_backend = set_backend(self.backend)
         self.app = FPScanApp()
 
     def tearDown(self):
+        set_backend(self.old_backend)
         self.teardown_virtual_home()
 
     def test_create(self):
         # we can create app instances
         assert self.app is not None
 
+    def test_warmup(self):
+        # the warmup checks fpscan, scanners and server
+        self.app.config = self.app.load_config()
+        self.app.warmup.callback = None
+        self.app.warmup.run()
+        assert self.app.warmup.results['fpscan'].endswith('fpscan')
+        assert self.app.warmup.errors == {
+            'scanners': 'No scanner found', 'server': 'No credentials'}
+        assert self.app.warmup.ready is False
+        assert self.backend.runs['detect'] == 1
+
+    def test_scanner_armed_canceled(self):
+        # results of canceled armings are dropped
+        from kivy.clock import Clock
+        self.app.arming_token = object()
+        self.app.scanner_armed(object(), 'Touch', (None, ['Mine'], None))
+        Clock.tick()
+        assert self.app.detected_scanners == []
+        assert 'scanner_armed' in self.app.blocking_meter.get_stats()
+
+    def test_continuous_upload_finished(self):
+        # in continuous mode upload results are listed, no popups shown
+        from kivy.clock import Clock
+        self.app.config = self.app.load_config()
+        self.app.config.set('Enrollment', 'continuous', '1')
+        assert self.app.is_continuous() is True
+        session = EnrollmentSession('AA11111', [1])
+        self.app.uploads_running = 2
+        self.app.upload_finished(session, True)
+        self.app.upload_finished(
+            EnrollmentSession('AA22222', [1]), 'Error: 503 Unavailable')
+        Clock.tick()
+        assert self.app.uploads_running == 0
+        assert self.app.enroll_stats.total == 1
+        lines = self.app.enroll_status.split('\n')
+        assert lines[0].endswith('AA22222: Error: 503 Unavailable')
+        assert lines[1].endswith('AA11111: ok')
+        assert self.app.throughput.endswith('students/min (0 uploading)')
+
+    def test_store_enrollment(self):
+        # only captures the server did not get are spooled
+        self.app.config = self.app.load_config()
+        session = EnrollmentSession('AA11111', [1])
+        session.fingerprints = {1: b'FP1-new'}
+        spool_fingerprints('AA11111', {1: b'FP1-old', 2: b'FP1-old'})
+        store = 'waeup.identifier.app.store_fingerprints'
+        with mock.patch(store, return_value=True):
+            assert self.app.store_enrollment(session) is True
+        assert get_spooled() == {}  # outdated captures dropped
+        with mock.patch(store, return_value="Error 1: No such student"):
+            assert self.app.store_enrollment(session) == (
+                "Error 1: No such student")
+        assert get_spooled() == {}
+        assert session.spool_path is None
+        with mock.patch(store, side_effect=ConnectionRefusedError('down')):
+            assert self.app.store_enrollment(session) == "Error: down"
+        assert read_spool_file(session.spool_path) == {1: b'FP1-new'}
+
+    def test_upload_failed_popup(self):
+        # we tell whether captures will be uploaded later
+        from kivy.clock import Clock
+        self.app.config = self.app.load_config()
+        self.app.config.set('Enrollment', 'continuous', '0')
+        assert self.app.is_continuous() is False
+        session = EnrollmentSession('AA11111', [1])
+        self.app.uploads_running = 2
+        with mock.patch('waeup.identifier.app.FPScanPopup') as popup:
+            self.app.upload_finished(session, "Error 1: No such student")
+            Clock.tick()
+            session = EnrollmentSession('AA11111', [1])
+            session.spool_path = 'AA11111.spool'
+            self.app.upload_finished(session, "Error: down")
+            Clock.tick()
+        messages = [x[1]['message'] for x in popup.call_args_list]
+        assert 'uploaded later' not in messages[0]
+        assert messages[1].endswith('will be uploaded later.')
+
+    def test_resend_spooled(self):
+        # fingerprints of failed uploads are sent again later
+        from kivy.clock import Clock
+        self.app.config = self.app.load_config()
+        assert self.app.resend_spooled() is None  # nothing spooled
+        spool_fingerprints('AA11111', {1: b'FP1-fake'})
+        with mock.patch('waeup.identifier.app.store_fingerprints',
+                        return_value=True) as store:
+            thread = self.app.resend_spooled()
+            assert self.app.resend_spooled() is None  # already running
+            thread.join()
+        Clock.tick()
+        assert store.call_args[0][1:] == ('AA11111', {1: b'FP1-fake'})
+        assert self.app.spool_running is False
+        assert get_spooled() == {}
+        assert self.app.activity.entries[0][1:] == (
+            'resend', 'AA11111', 'ok', True)
+
+    def test_activity_refresh_coalesced(self):
+        # many results in one frame lead to a single list refresh
+        from kivy.clock import Clock
+        refreshs = []
+        self.app.bind(activity_data=lambda *args: refreshs.append(1))
+        for num in range(ACTIVITY_SIZE + 100):
+            self.app.activity.add('enroll', 'AA%05d' % num, 'ok')
+        assert self.app.activity_data == []
+        Clock.tick()
+        assert len(self.app.activity_data) == ACTIVITY_SIZE
+        assert len(refreshs) == 1
+
+    def test_idle_mode(self):
+        # idle settings are taken from config, scans keep the app active
+        self.app.config = self.app.load_config()
+        self.app.config.set('Idle', 'idle_timeout', '30')
+        self.app.config.set('Idle', 'idle_fps', '0')
+        self.app.set_idle_mode()
+        assert self.app.idle_mode.timeout == 30.0
+        assert self.app.idle_mode.idle_fps == 1.0
+        self.app.cmd_running = object()
+        assert self.app.is_busy() is True
+        assert self.app.idle_mode.check(now=time.monotonic() + 60) is False
+
+    def test_config_snapshot(self):
+        # config changes renew the snapshot
+        self.app.config = self.app.load_config()
+        snapshot = self.app.snapshot
+        assert snapshot.continuous is False
+        self.app.config.set('Enrollment', 'continuous', '1')
+        assert snapshot.continuous is False
+        assert self.app.snapshot.continuous is True
+
+    def test_config_file_changed(self):
+        # changed config files are reloaded and applied at once
+        from kivy.clock import Clock
+        self.app.config = self.app.load_config()
+        applied = []
+        self.app.set_routes = lambda: applied.append(self.app.snapshot)
+        path = self.app.get_application_config()
+        with open(path, 'w') as fd:
+            fd.write(
+                '[Server]\nwaeup_url = http://new\nroutes = AB=http://x\n')
+        self.app.config_file_changed(path)
+        Clock.tick()
+        assert len(applied) == 1
+        assert applied[0].waeup_url == 'http://new'
+        assert applied[0].routes == 'AB=http://x'
+        self.app.config.set('Server', 'routes', '')  # shared with other tests
+
+    def test_roster(self):
+        # student ids missing in the roster are rejected locally
+        from kivy.clock import Clock
+        self.app.config = self.app.load_config()
+        path = os.path.join(self.path_dir, 'roster.csv')
+        with open(path, 'w') as fd:
+            fd.write('AA11111\nAA11112\ninvalid\n')
+        self.app.config.set('Students', 'roster_path', path)  # loads roster
+        for num in range(100):
+            Clock.tick()
+            if self.app.roster is not None:
+                break
+            time.sleep(0.01)
+        assert list(self.app.roster) == ['AA11111', 'AA11112']
+        self.app.root = mock.Mock(f_student_id='')
+        with mock.patch('waeup.identifier.app.FPScanPopup') as popup:
+            self.app.on_stud_id_entered((mock.Mock(text='AA11113'), ))
+            assert self.app.prevent_scanning is True
+            popup.assert_called_once_with(
+                title="Invalid Student Id",
+                message="The entered student id is unknown")
+            self.app.on_stud_id_entered((mock.Mock(text='AA11112'), ))
+            assert self.app.prevent_scanning is False
+        self.app.config.set('Students', 'roster_path', '')
+        assert self.app.roster is None
+
+    def test_suggestion_bar(self):
+        # suggested ids are shown as buttons, which are reused
+        bar = SuggestionBar()
+        bar.suggestions = ['AA11111', 'AA11112']
+        buttons = list(reversed(bar.children))
+        assert [x.text for x in buttons] == ['AA11111', 'AA11112']
+        bar.suggestions = ['AA11112']
+        assert bar.children == [buttons[0]]
+        assert buttons[0].text == 'AA11112'
+        bar.suggestions = []
+        assert bar.children == []
+
+    def test_student_id_suggestions(self):
+        # student id inputs suggest ids from the roster
+        student_id_input = StudentIdInput()
+        student_id_input.text = 'AA1'
+        assert student_id_input.suggestions == []
+        student_id_input.roster = Roster(['AA11111', 'AA12222', 'AB11111'])
+        student_id_input.text = 'AA11'
+        assert student_id_input.suggestions == ['AA11111']
+        student_id_input.text = ''
+        assert student_id_input.suggestions == []
+
+    def test_routes(self):
+        # students are routed to servers by id prefix
+        self.app.config = self.app.load_config()
+        self.app.config.set('Server', 'waeup_url', 'http://default:8080')
+        self.app.config.set(
+            'Server', 'routes', 'AB=http://kofa-ab CD=http://u:p@kofa-cd')
+        self.app.set_routes()
+        self.app.waeup_username, self.app.waeup_password = 'bob', 'pw'
+        assert self.app.get_server_url() == 'http://bob:pw@default:8080'
+        assert self.app.get_server_url('AB12345') == 'http://bob:pw@kofa-ab'
+        assert self.app.get_server_url('CD12345') == 'http://u:p@kofa-cd'
+        assert self.app.get_breaker('XY12345') is self.app.circuit_breaker
+        assert self.app.get_breaker('AB12345') is not (
+            self.app.circuit_breaker)
+
+    def test_read_with_failover(self):
+        # reads fail over to other endpoints of a route
+        self.app.config = self.app.load_config()
+        self.app.config.set('Server', 'waeup_url', 'http://h1|http://h2')
+        self.app.set_routes()
+        primary, replica = self.app.router.default.endpoints
+        calls = []
+
+        def fetch(url, student_id, breaker=None, raise_unreachable=False):
+            calls.append(url)
+            assert raise_unreachable is True
+            if url == 'http://:@h1':
+                raise ConnectionRefusedError('down')
+            return {}
+        assert self.app.read_with_failover(
+            fetch, 'http://:@h1', 'AB12345') == {}
+        assert calls == ['http://:@h1', 'http://:@h2']
+        assert primary.healthy is False
+        assert self.app.get_server_url() == 'http://:@h2'
+        assert self.app.get_server_url(write=True) == 'http://:@h1'
+        self.app.probes_done(self.app.prober)
+        from kivy.clock import Clock
+        Clock.tick()
+        assert self.app.endpoint_stats == 'h1: Error: down\nh2: not probed'
+
+    def test_photo_of_download_reused(self):
+        # photos sent along with templates are not downloaded again
+        self.app.root = mock.Mock(f_student_id='AA11111')
+        self.app.photo_loader = mock.Mock()
+        fpm_path = os.path.join(self.path_dir, 'data.fpm')
+        with mock.patch('waeup.identifier.app.FPScanPopup'), mock.patch(
+                'waeup.identifier.app.get_fpm_path', return_value=fpm_path):
+            assert self.app.store_template(dict(
+                fingerprints={'1': mock.Mock(data=b'FP1-fake')},
+                img_name='passport.jpg', img=b'JPEG')) is True
+            self.app.handle_verify('ok')
+        assert self.app.photo_loader.load.call_args[1] == dict(
+            photo=('passport.jpg', b'JPEG'))
+        # but only for the same student
+        self.app.root.f_student_id = 'AA22222'
+        with mock.patch('waeup.identifier.app.FPScanPopup'):
+            self.app.handle_verify('ok')
+        assert self.app.photo_loader.load.call_args[1] == dict(photo=None)
+
+    def test_prefetch_keyed_by_student(self):
+        # prefetches are used even if the read endpoint changed meanwhile
+        self.app.config = self.app.load_config()
+        self.app.config.set('Server', 'waeup_url', 'http://h1|http://h2')
+        self.app.set_routes()
+        primary, replica = self.app.router.default.endpoints
+        self.app.root = mock.Mock(f_student_id='AA11111')
+        urls = []
+
+        def fetch(func, url, student_id):
+            urls.append(url)
+            return {}
+        results = []
+        with mock.patch.object(self.app, 'read_with_failover', fetch):
+            self.app.prefetcher.prefetch('AA11111')
+            primary.record_failure('down')  # now h2 is the fastest
+            self.app.download_fingerprint(None, callback=results.append)
+            for num in range(100):
+                if results:
+                    break
+                time.sleep(0.01)
+        assert results == [{}]
+        assert len(urls) == 1  # downloaded only once
+        assert self.app.prefetcher.get_stats()['hits'] == 1
+
+    def test_read_with_failover_answered(self):
+        # error messages of servers that answered are no reason to fail over
+        self.app.config = self.app.load_config()
+        self.app.config.set('Server', 'waeup_url', 'http://h1|http://h2')
+        self.app.set_routes()
+        primary, replica = self.app.router.default.endpoints
+        calls = []
+
+        def fetch(url, student_id, breaker=None, raise_unreachable=False):
+            calls.append(url)
+            breaker.record_failure()  # e.g. by a concurrent probe
+            return 'Error 1: no such student'
+        assert self.app.read_with_failover(
+            fetch, 'http://:@h1', 'AB12345') == 'Error 1: no such student'
+        assert calls == ['http://:@h1']
+        assert primary.healthy is True
+
+    def test_routes_invalid(self):
+        # invalid routing tables are ignored
+        self.app.config = self.app.load_config()
+        self.app.config.set('Server', 'routes', 'ABCD=http://kofa')
+        self.app.set_routes()
+        assert len(self.app.router.routes) == 1
+
+
+class WarmupTests(unittest.TestCase):
+
+    def test_run(self):
+        # stages are run in order and get the results of earlier stages
+        warmup = Warmup([
+            ('one', lambda results: 1),
+            ('two', lambda results: results['one'] + 1)])
+        warmup.start().join()
+        assert warmup.results == {'one': 1, 'two': 2}
+        assert sorted(warmup.durations) == ['one', 'two']
+        assert warmup.ready is True
+        assert warmup.running is False
+
+    def test_failing_stage(self):
+        # failing stages are recorded and can be run again
+        calls = []
+        values = [ValueError('Not yet'), 'ok']
+
+        def flaky(results):
+            value = values.pop(0)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        warmup = Warmup(
+            [('one', lambda results: 1), ('flaky', flaky)],
+            callback=lambda warmup, name: calls.append(name))
+        warmup.run()
+        assert warmup.errors == {'flaky': 'Not yet'}
+        assert warmup.ready is False
+        warmup.run(names=['flaky'])
+        assert warmup.errors == {}
+        assert warmup.results == {'one': 1, 'flaky': 'ok'}
+        assert warmup.ready is True
+        assert calls == ['one', 'flaky', 'flaky']
+
 
 callback_counter = 0
 callback_data = None
@@ -358,6 +1297,26 @@ class FPScanCommandTests(unittest.TestCase, VirtualHomeProvider):
         assert stderr == b''
         assert os.path.exists(out_path)
 
+    def test_scan_capture(self):
+        # we can capture fingerprints into buffers, without files
+        buf = TemplateBuffer()
+        cmd = FPScanCommand(self.fpscan_path, ['-s'], capture=buf)
+        cmd.run()
+        ret_code, stdout, stderr = cmd.wait()
+        assert ret_code == 0
+        assert stdout == b'ok\n'
+        assert bytes(buf.validate()).startswith(b'FP1')
+        assert not os.path.exists(get_fpm_path())
+
+    def test_scan_capture_fail(self):
+        # failed scans leave buffers empty
+        buf = TemplateBuffer()
+        cmd = FPScanCommand(
+            self.fpscan_path, ['-s', '--scan-fail'], capture=buf)
+        cmd.run()
+        assert cmd.wait()[0] == 1
+        assert buf.length == 0
+
     def test_scan_invalid_device(self):
         # we detect missing devices when scanning
         cmd = FPScanCommand(self.fpscan_path, ['-s', '--no-device', ])
@@ -0,0 +1,145 @@
+# Tests for backends module
+import os
+import pytest
+import time
+from waeup.identifier.app import (
+    FPScanCommand, TemplateBuffer, arm_scanner, detect_scanners, fpscan,
+    scan,
+    )
+from waeup.identifier.backends import (
+    SimulatedBackend, SubprocessBackend, get_backend, set_backend,
+    )
+
+
+@pytest.fixture(scope="function")
+def simulated(request, monkeypatch, tmpdir):
+    """Use a `SimulatedBackend` as default scanner backend.
+
+    Runs in a temporary working directory, where `fpscan` writes its
+    files by default.
+    """
+    monkeypatch.chdir(tmpdir)
+    backend = SimulatedBackend()
+    old = set_backend(backend)
+    request.addfinalizer(lambda: set_backend(old))
+    return backend
+
+
+def test_default_backend():
+    # by default we run real binaries
+    assert isinstance(get_backend(), SubprocessBackend)
+
+
+def test_set_backend():
+    # we can change the default backend
+    backend = SimulatedBackend()
+    old = set_backend(backend)
+    try:
+        assert get_backend() is backend
+    finally:
+        assert set_backend(old) is backend
+
+
+class TestSimulatedBackend(object):
+
+    def test_paths(self):
+        # any path is accepted, except empty ones
+        backend = SimulatedBackend()
+        assert backend.exists('fpscan') is True
+        assert backend.exists(None) is False
+        assert backend.check('fpscan') == 'fpscan'
+        with pytest.raises(ValueError):
+            backend.check(None)
+
+    def test_detect(self, simulated):
+        # we can detect simulated devices
+        assert fpscan('fpscan') == (
+            0, 'Digital Persona U.are.U 4000/4000B/4500\n'
+            '  2 0 1 0 1 384 290\n', '')
+        assert detect_scanners('fpscan') == [
+            'Digital Persona U.are.U 4000/4000B/4500']
+        assert simulated.runs['detect'] == 2
+
+    def test_detect_no_device(self, simulated):
+        # we can simulate missing devices
+        simulated.devices = []
+        assert detect_scanners('fpscan') == []
+        assert fpscan('fpscan', ['-s']) == (
+            1, '', 'Invalid device number: 0.\n')
+
+    def test_scan(self, simulated, tmpdir):
+        # scans write templates
+        path = str(tmpdir / 'data.fpm')
+        assert fpscan('fpscan', ['-s', '-o', path]) == (0, 'ok\n', '')
+        assert (tmpdir / 'data.fpm').read_binary() == b'FP11'
+        assert scan('fpscan', 0) is None
+
+    def test_outcomes(self, simulated, tmpdir):
+        # outcomes are configurable and returned in turn
+        backend = SimulatedBackend(
+            outcomes=dict(scan=['ok', 'fail'], compare=['no-match', 'fail']))
+        set_backend(backend)
+        path = str(tmpdir / 'stored.fpm')
+        assert scan('fpscan', 0) is None
+        with pytest.raises(ValueError):
+            scan('fpscan', 0)
+        assert fpscan('fpscan', ['-c', '-i', path]) == (
+            1, '', 'Could not load data from file: %s.\n' % path)
+        (tmpdir / 'stored.fpm').write_binary(b'FP1')
+        assert fpscan('fpscan', ['-c', '-i', path]) == (0, 'no-match\n', '')
+        assert fpscan('fpscan', ['-c', '-i', path]) == (
+            1, 'error: unknown reason\n', '')
+
+    def test_template_size(self):
+        # templates can be padded to realistic sizes
+        backend = SimulatedBackend(template_size=10)
+        assert backend.make_template() == b'FP11' + b'\0' * 6
+        assert backend.make_template() == b'FP12' + b'\0' * 6
+
+    def test_command_capture(self, simulated):
+        # captures are passed through pipes like with real binaries
+        buf = TemplateBuffer()
+        cmd = FPScanCommand('fpscan', ['-s'], capture=buf)
+        cmd.run()
+        assert cmd.wait() == (0, b'ok\n', b'')
+        assert bytes(buf.validate()) == b'FP11'
+        assert not os.path.exists('data.fpm')
+
+    def test_command_timeout(self, simulated):
+        # simulated runs can be killed
+        simulated.latency['scan'] = 10.0
+        cmd = FPScanCommand(
+            'fpscan', ['-s'], timeout=0.05, capture=TemplateBuffer())
+        start = time.time()
+        cmd.start()
+        cmd.join()
+        assert time.time() - start < 5
+        assert cmd.returncode == -9
+        assert cmd.is_killed is True
+        assert cmd.capture.length == 0
+
+    def test_command_backend(self):
+        # commands can use a backend different from the default
+        backend = SimulatedBackend(devices=[])
+        cmd = FPScanCommand('fpscan', [], backend=backend)
+        cmd.run()
+        assert cmd.wait() == (0, b'0\n', b'')
+        with pytest.raises(IOError):
+            FPScanCommand('', [], backend=backend)
+
+    def test_arm_scanner(self, simulated):
+        # we can arm simulated scanners
+        error, scanners, cmd = arm_scanner('fpscan', ['-s'])
+        assert error is None
+        assert len(scanners) == 1
+        assert cmd.backend is simulated
+
+    def test_many_scans(self, simulated):
+        # simulated scans are cheap
+        start = time.time()
+        for num in range(1000):
+            cmd = FPScanCommand('fpscan', ['-s'], capture=TemplateBuffer())
+            cmd.run()
+            assert cmd.returncode == 0
+        assert time.time() - start < 10
+        assert simulated.runs['scan'] == 1000
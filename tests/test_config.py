@@ -1,8 +1,12 @@
 # Tests for config module
 import json
+import os
+import time
+from kivy.config import ConfigParser
+from waeup.identifier import config
 from waeup.identifier.config import (
     get_conffile_location, find_fpscan_binary, get_config, CONF_KEYS,
-    get_json_settings, get_default_settings
+    get_json_settings, get_default_settings, get_snapshot, ConfigWatcher,
     )
 
 
@@ -92,6 +96,18 @@ class Test_find_fpscan_binary(object):
         fake_fpscan.write('Just a fake script')
         assert find_fpscan_binary('invalid_path') == str(fake_fpscan)
 
+    def test_find_fpscan_binary_cached(self, home_dir, monkeypatch):
+        # found binaries are remembered as long as they exist
+        other_dir = home_dir.mkdir('other')
+        monkeypatch.setenv('PATH', '%s:%s' % (home_dir, other_dir))
+        fake_fpscan = other_dir / "fpscan"
+        fake_fpscan.write('Just a fake script')
+        assert find_fpscan_binary() == str(fake_fpscan)
+        (home_dir / "fpscan").write('Another fake script')
+        assert find_fpscan_binary() == str(fake_fpscan)
+        fake_fpscan.remove()
+        assert find_fpscan_binary() == str(home_dir / "fpscan")
+
 
 class Test_get_config(object):
 
@@ -131,3 +147,94 @@ class Test_get_config(object):
             if key in ['fpscan_path', ]:
                 continue
             assert key in conf_dict
+
+
+def get_app_config():
+    # a config with defaults as set by the app
+    conf = ConfigParser()
+    for section, defaults in get_default_settings():
+        conf.setdefaults(section, defaults)
+    return conf
+
+
+class Test_get_snapshot(object):
+
+    def test_get_snapshot(self, home_dir):
+        # snapshots contain typed config values
+        conf = get_app_config()
+        conf.read_string(
+            '[Enrollment]\nenroll_fingers = 3\ncontinuous = 1\n'
+            '[Idle]\nidle_fps = 5\n')
+        snapshot = get_snapshot(conf)
+        assert snapshot.waeup_url == 'https://localhost:8080'
+        assert snapshot.enroll_fingers == 3
+        assert snapshot.continuous is True
+        assert snapshot.profiling is False
+        assert snapshot.idle_fps == 5.0
+
+    def test_get_snapshot_invalid(self, home_dir):
+        # invalid and missing values are replaced by defaults
+        conf = get_app_config()
+        conf.set('Enrollment', 'enroll_fingers', 'many')
+        conf.remove_section('Idle')
+        snapshot = get_snapshot(conf)
+        assert snapshot.enroll_fingers == 1
+        assert snapshot.idle_timeout == 120.0
+        assert snapshot.fpscan_path == '<unset>'
+
+    def test_get_snapshot_immutable(self, home_dir):
+        # snapshots cannot be changed
+        snapshot = get_snapshot(get_app_config())
+        try:
+            snapshot.waeup_url = 'http://elsewhere'
+        except AttributeError:
+            pass
+        else:
+            assert False, 'snapshot changed'
+
+
+class TestConfigWatcher(object):
+
+    def test_check(self, home_dir):
+        # changes, replacements and new files are reported
+        path = str(home_dir / 'conf.ini')
+        changes = []
+        watcher = ConfigWatcher(path, changes.append)
+        assert watcher.check() is False  # no such file
+        with open(path, 'w') as fd:
+            fd.write('[Server]\n')
+        assert watcher.check() is True
+        assert watcher.check() is False
+        with open(path + '.tmp', 'w') as fd:
+            fd.write('[Server]\nrouted = 1\n')
+        os.rename(path + '.tmp', path)
+        assert watcher.check() is True
+        assert changes == [path, path]
+
+    def watch(self, path, interval):
+        # write to `path` while a watcher runs
+        changes = []
+        watcher = ConfigWatcher(path, changes.append, interval=interval)
+        watcher.start()
+        time.sleep(0.05)
+        with open(path, 'w') as fd:
+            fd.write('[Server]\n')
+        for num in range(50):
+            if changes:
+                break
+            time.sleep(0.02)
+        watcher.stop()
+        return changes
+
+    def test_watch_inotify(self, home_dir):
+        # with inotify, changes are noticed right away
+        if config.inotify_simple is None:
+            return
+        path = str(home_dir / 'conf.ini')
+        assert self.watch(path, interval=0.5) == [path]
+
+    def test_watch_polling(self, home_dir, monkeypatch):
+        # without inotify we check the file regularly
+        monkeypatch.setattr(config, 'inotify_simple', None)
+        path = str(home_dir / 'conf.ini')
+        assert self.watch(path, interval=0.05) == [path]
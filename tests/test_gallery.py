@@ -0,0 +1,134 @@
+# Tests for gallery module
+import os
+import pytest
+from waeup.identifier.gallery import (
+    make_key, split_key, write_gallery, append_to_gallery, GalleryReader,
+    compact_gallery, compact_gallery_main, HEADER, INDEX_ENTRY,
+    )
+
+
+class TestHelpers(object):
+
+    def test_make_key_sorts_by_id_and_finger(self):
+        # keys sort like (student_id, finger_num) tuples
+        keys = [make_key('AB12345', 2), make_key('AA123456', 1),
+                make_key('AB12345', 1), make_key('A12345', 10)]
+        assert [split_key(x) for x in sorted(keys)] == [
+            ('A12345', 10), ('AA123456', 1), ('AB12345', 1), ('AB12345', 2)]
+
+    def test_make_key_invalid_ids(self):
+        # we cannot store overlong or empty student ids
+        with pytest.raises(ValueError):
+            make_key('A' * 17, 1)
+        with pytest.raises(ValueError):
+            make_key('', 1)
+
+
+class TestGallery(object):
+
+    def test_write_and_read(self, tmpdir):
+        # we can write galleries and read templates back
+        path = str(tmpdir / 'gallery.fpg')
+        assert write_gallery(path, [
+            ('BB11111', 1, b'FP1-bob'),
+            ('AA11111', 1, b'FP1-alice-1'),
+            ('AA11111', 2, b'FP1-alice-2')]) == 3
+        with GalleryReader(path) as gallery:
+            assert len(gallery) == 3
+            assert bytes(gallery.get('AA11111', 2)) == b'FP1-alice-2'
+            assert bytes(gallery.get('BB11111')) == b'FP1-bob'
+            assert gallery.get('CC11111') is None
+            assert gallery.get('BB11111', 2) is None
+            assert gallery.keys() == [
+                ('AA11111', 1), ('AA11111', 2), ('BB11111', 1)]
+
+    def test_layout(self, tmpdir):
+        # templates are stored contiguously after header and index
+        path = str(tmpdir / 'gallery.fpg')
+        write_gallery(path, [('AA11111', 1, b'FP1-a'), ('BB11111', 1, b'FP1')])
+        assert os.path.getsize(path) == (
+            HEADER.size + 2 * INDEX_ENTRY.size + len(b'FP1-aFP1'))
+
+    def test_lookups_are_views(self, tmpdir):
+        # lookups give memoryviews into the mapped file
+        path = str(tmpdir / 'gallery.fpg')
+        write_gallery(path, [('AA11111', 1, b'FP1-alice')])
+        gallery = GalleryReader(path)
+        result = gallery.get('AA11111', 1)
+        assert isinstance(result, memoryview)
+        assert result.readonly
+        result.release()
+        gallery.close()
+
+    def test_fingerprints(self, tmpdir):
+        # we can get all fingers of a student as with Kofa
+        path = str(tmpdir / 'gallery.fpg')
+        write_gallery(path, [
+            ('AA11111', 1, b'FP1-1'), ('AA11111', 3, b'FP1-3'),
+            ('AA111111', 1, b'FP1-other')])
+        append_to_gallery(path, 'AA11111', 2, b'FP1-2')
+        with GalleryReader(path) as gallery:
+            result = dict(
+                (k, bytes(v)) for k, v in gallery.fingerprints(
+                    'AA11111').items())
+            assert 'AA11111' in gallery
+            assert 'ZZ11111' not in gallery
+        assert result == {'1': b'FP1-1', '2': b'FP1-2', '3': b'FP1-3'}
+
+    def test_append_creates_gallery(self, tmpdir):
+        # appending to non-existing galleries creates them
+        path = str(tmpdir / 'gallery.fpg')
+        append_to_gallery(path, 'AA11111', 1, b'FP1-old')
+        append_to_gallery(path, 'AA11111', 1, b'FP1-new')
+        with GalleryReader(path) as gallery:
+            assert gallery.index_count == 0
+            assert len(gallery) == 1
+            assert bytes(gallery.get('AA11111')) == b'FP1-new'
+
+    def test_truncated_append_ignored(self, tmpdir):
+        # half-written records at the end of a gallery are ignored
+        path = str(tmpdir / 'gallery.fpg')
+        append_to_gallery(path, 'AA11111', 1, b'FP1-complete')
+        append_to_gallery(path, 'BB11111', 1, b'FP1-incomplete')
+        with open(path, 'r+b') as fd:
+            fd.truncate(os.path.getsize(path) - 3)
+        with GalleryReader(path) as gallery:
+            assert gallery.keys() == [('AA11111', 1)]
+
+    def test_invalid_file(self, tmpdir):
+        # we refuse to read files that are no galleries
+        path = tmpdir / 'data.fpm'
+        path.write(b'FP1-some-fake-file-which-is-long-enough')
+        with pytest.raises(ValueError):
+            GalleryReader(str(path))
+        path.write(b'')
+        with pytest.raises(ValueError):
+            GalleryReader(str(path))
+
+    def test_compact(self, tmpdir):
+        # compaction merges appended records and drops stale ones
+        path = str(tmpdir / 'gallery.fpg')
+        write_gallery(path, [
+            ('AA11111', 1, b'FP1-old'), ('CC11111', 1, b'FP1-c')])
+        append_to_gallery(path, 'AA11111', 1, b'FP1-new')
+        append_to_gallery(path, 'BB11111', 1, b'FP1-b')
+        num, old_size, new_size = compact_gallery(path)
+        assert num == 3
+        assert new_size < old_size
+        with GalleryReader(path) as gallery:
+            assert gallery.index_count == 3
+            assert gallery.data_end == new_size
+            assert [(sid, num, bytes(data)) for sid, num, data in
+                    gallery.items()] == [
+                ('AA11111', 1, b'FP1-new'), ('BB11111', 1, b'FP1-b'),
+                ('CC11111', 1, b'FP1-c')]
+
+    def test_compact_main(self, tmpdir, capsys):
+        # we can compact galleries from commandline
+        path = str(tmpdir / 'gallery.fpg')
+        out_path = str(tmpdir / 'compacted.fpg')
+        append_to_gallery(path, 'AA11111', 1, b'FP1-a')
+        compact_gallery_main([path, '-o', out_path])
+        assert 'Compacted %s: 1 entries' % path in capsys.readouterr()[0]
+        with GalleryReader(out_path) as gallery:
+            assert gallery.index_count == 1
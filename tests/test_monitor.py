@@ -0,0 +1,215 @@
+# Tests for monitor module
+import os
+import threading
+import time
+from waeup.identifier.monitor import (
+    FrameHistogram, StallDetector, SamplingProfiler, profiling_requested,
+    ResourceTracker, count_open_fds, get_rss, get_thread_label,
+    )
+
+
+class TestFrameHistogram(object):
+
+    def test_buckets(self):
+        # frame intervals are sorted into buckets
+        histogram = FrameHistogram(bounds=(0.02, 0.1))
+        for interval in (0.01, 0.016, 0.05, 0.5):
+            histogram.add(interval)
+        assert histogram.get_buckets() == [(0.02, 2), (0.1, 1), (None, 1)]
+
+    def test_rolling(self):
+        # only the last frames are kept
+        histogram = FrameHistogram(size=2)
+        for interval in (1.0, 0.01, 0.01):
+            histogram.add(interval)
+        assert histogram.percentile(99) == 0.01
+
+    def test_format(self):
+        # we can get summaries
+        histogram = FrameHistogram()
+        assert histogram.format().startswith('frames: 0, p50 0.0 ms')
+        histogram.add(0.02)
+        assert '<=33ms:1' in histogram.format()
+
+
+class TestStallDetector(object):
+
+    def test_beat(self):
+        # heartbeats feed the histogram
+        detector = StallDetector()
+        detector.beat()
+        detector.beat()
+        assert len(detector.histogram.intervals) == 1
+
+    def test_check(self):
+        # stalls are detected and reported once
+        detector = StallDetector(threshold=0.1)
+        assert detector.check() is None  # no beat yet
+        detector.beat()
+        assert detector.check() is None
+        stall = detector.check(now=detector.last_beat + 0.2)
+        assert round(stall['duration'], 6) == 0.2
+        assert 'test_check' in stall['stack']
+        assert detector.check(now=detector.last_beat + 0.3) is None
+        assert list(detector.stalls) == [stall]
+
+    def test_pause(self):
+        # paused detectors neither report nor count the gap
+        detector = StallDetector(threshold=0.1)
+        detector.beat()
+        detector.pause()
+        assert detector.check(now=time.perf_counter() + 1) is None
+        detector.beat()
+        assert len(detector.histogram.intervals) == 0
+
+    def test_watchdog(self):
+        # the watchdog thread catches the main thread while blocking
+        detector = StallDetector(threshold=0.1)
+        detector.beat()
+        detector.start()
+        time.sleep(0.3)  # a blocking main thread
+        detector.stop()
+        assert len(detector.stalls) == 1
+        assert 'time.sleep(0.3)' in detector.stalls[0]['stack']
+
+
+def busy_worker(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+def sample_in_thread(profiler):
+    # the profiler does not sample its own thread
+    thread = threading.Thread(target=profiler.sample)
+    thread.start()
+    thread.join()
+
+
+class TestSamplingProfiler(object):
+
+    def test_profiling_requested(self):
+        # the profiler can be enabled via environment
+        assert profiling_requested({}) is False
+        assert profiling_requested({'WAEUP_IDENTIFIER_PROFILE': '1'})
+        assert not profiling_requested({'WAEUP_IDENTIFIER_PROFILE': '0'})
+
+    def test_sample(self, tmpdir):
+        # we sample the stacks of all threads
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=busy_worker, args=(stop, ), name='Worker-12')
+        thread.start()
+        profiler = SamplingProfiler(str(tmpdir))
+        sample_in_thread(profiler)
+        stop.set()
+        thread.join()
+        stacks = list(profiler.counts)
+        assert any(stack.startswith('Worker;') and
+                   stack.endswith('busy_worker (test_monitor.py)')
+                   for stack in stacks)
+        assert any(stack.startswith('MainThread;') for stack in stacks)
+        assert profiler.num_samples == 1
+
+    def test_thread_label(self):
+        # threads doing the same work share labels, others do not
+        def work():
+            pass
+
+        class Worker(threading.Thread):
+            pass
+        assert get_thread_label(threading.Thread(name='Worker-12')) == (
+            'Worker')
+        assert get_thread_label(threading.Thread(name='io-pool-2')) == (
+            'io-pool')
+        assert get_thread_label(threading.Thread(name='MainThread')) == (
+            'MainThread')
+        assert get_thread_label(threading.Thread(target=work)) == (
+            'Thread (TestSamplingProfiler.test_thread_label.<locals>.work)')
+        assert get_thread_label(threading.Thread(target=print)) == (
+            'Thread (print)')
+        assert get_thread_label(Worker()) == 'Worker'
+
+    def test_dump(self, tmpdir):
+        # we dump folded stacks and reset counts
+        profiler = SamplingProfiler(str(tmpdir.join('profiles')))
+        assert profiler.dump() is None
+        sample_in_thread(profiler)
+        path = profiler.dump()
+        with open(path) as fd:
+            lines = fd.read().splitlines()
+        assert lines[0].startswith('MainThread;')
+        assert lines[0].endswith(' 1')
+        assert not profiler.counts
+
+    def test_rotate(self, tmpdir):
+        # only the newest dumps are kept
+        profiler = SamplingProfiler(str(tmpdir), max_files=2)
+        paths = []
+        for x in range(3):
+            sample_in_thread(profiler)
+            paths.append(profiler.dump())
+        assert sorted(os.listdir(str(tmpdir))) == sorted(
+            os.path.basename(path) for path in paths[1:])
+
+    def test_start_stop(self, tmpdir):
+        # the profiler runs in background and dumps on stop
+        profiler = SamplingProfiler(
+            str(tmpdir), interval=0.005, dump_interval=0.05)
+        profiler.start()
+        assert profiler.running
+        time.sleep(0.2)
+        profiler.stop()
+        assert not profiler.running
+        assert profiler.num_samples > 5
+        assert len(os.listdir(str(tmpdir))) >= 2
+
+
+class TestResourceTracker(object):
+
+    def test_helpers(self):
+        # we can get RSS and open files
+        assert get_rss() > 1024 * 1024
+        fds = count_open_fds()
+        with open(__file__) as fd:
+            assert count_open_fds() == fds + 1
+        assert fd.closed
+
+    def test_growth(self):
+        # we can detect growing resources
+        tracker = ResourceTracker()
+        tracker.start()
+        tracker.mark_baseline()
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        fd = open(__file__)
+        try:
+            tracker.sample('grown')
+        finally:
+            stop.set()
+            thread.join()
+            fd.close()
+        growth = tracker.get_growth()
+        assert growth['threads'] == 1
+        assert growth['fds'] == 1
+        assert 'traced' not in growth
+        assert tracker.check(dict(threads=1, fds=0)) == [
+            "fds grew by 1 (limit: 0)"]
+        assert [x['label'] for x in tracker.samples] == [
+            'start', 'baseline', 'grown']
+        assert tracker.format().split('\n')[3].startswith('grown')
+
+    def test_top_allocators(self):
+        # with tracemalloc we learn about top allocators
+        tracker = ResourceTracker(trace_malloc=True)
+        tracker.start()
+        try:
+            tracker.mark_baseline()
+            data = [bytearray(1000) for x in range(1000)]
+            tracker.sample()
+            assert tracker.get_growth()['traced'] >= 1000000
+            assert 'test_monitor.py' in tracker.top_allocators(1)[0]
+        finally:
+            tracker.stop()
+        assert len(data) == 1000
+        assert tracker.top_allocators() == []
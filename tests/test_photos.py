@@ -0,0 +1,136 @@
+# Tests for photos module
+import io
+import pytest
+from kivy.clock import Clock
+from waeup.identifier.photos import LRUCache, PhotoLoader, decode_photo
+
+
+def create_jpeg(size=(800, 600)):
+    PILImage = pytest.importorskip('PIL.Image')
+    out = io.BytesIO()
+    PILImage.new('RGB', size, (255, 0, 0)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+def wait_for(thread, results):
+    # wait for background thread and run scheduled main thread calls
+    thread.join(5)
+    for x in range(10):
+        Clock.tick()
+        if results:
+            break
+
+
+class TestLRUCache(object):
+
+    def test_get_set(self):
+        # we can store and retrieve values
+        cache = LRUCache(2)
+        cache['a'] = 1
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_evict_least_recently_used(self):
+        # the least recently used item is dropped first
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert len(cache) == 2
+
+
+class TestDecodePhoto(object):
+
+    def test_decode_downscales(self):
+        # photos are scaled down to fit into max size
+        size, pixels = decode_photo(create_jpeg(), max_size=(100, 100))
+        assert max(size) <= 100
+        assert len(pixels) == size[0] * size[1] * 4
+
+    def test_decode_invalid(self):
+        # invalid data raises ValueError
+        with pytest.raises(ValueError):
+            decode_photo(b'not-a-photo')
+
+
+class TestPhotoLoader(object):
+
+    def fetch(self, url, student_id):
+        self.fetched.append(student_id)
+        return ('passport.jpg', self.photo)
+
+    def callback(self, student_id, texture):
+        self.results.append((student_id, texture))
+
+    def setup_method(self, method):
+        self.fetched = []
+        self.results = []
+        self.photo = b''
+
+    def test_load_and_cache(self):
+        # photos are decoded in background and cached
+        self.photo = create_jpeg()
+        loader = PhotoLoader(
+            self.fetch, make_texture=lambda size, pixels: ('tex', size))
+        wait_for(loader.load('url', 'AA11111', self.callback), self.results)
+        assert self.results[0][0] == 'AA11111'
+        assert self.results[0][1][0] == 'tex'
+        # second load is a cache hit w/o fetching
+        assert loader.load('url', 'AA11111', self.callback) is None
+        assert len(self.results) == 2
+        assert self.fetched == ['AA11111']
+        stats = loader.get_stats()
+        assert stats['decode_count'] == 1
+        assert stats['hit_rate'] == 0.5
+
+    def test_photo_given(self):
+        # photos downloaded before are not fetched again
+        loader = PhotoLoader(
+            self.fetch, make_texture=lambda size, pixels: ('tex', size))
+        wait_for(loader.load('url', 'AA11111', self.callback,
+                             photo=('passport.jpg', create_jpeg())),
+                 self.results)
+        assert self.results[0][1][0] == 'tex'
+        assert self.fetched == []
+
+    def test_expired(self):
+        # after `ttl` secs we ask the server again; new photos are decoded
+        self.photo = create_jpeg()
+        loader = PhotoLoader(
+            self.fetch, make_texture=lambda size, pixels: ('tex', size),
+            ttl=0)
+        wait_for(loader.load('url', 'AA11111', self.callback), self.results)
+        # unchanged photo: no decoding needed
+        del self.results[:]
+        wait_for(loader.load('url', 'AA11111', self.callback), self.results)
+        assert self.fetched == ['AA11111', 'AA11111']
+        assert loader.get_stats()['decode_count'] == 1
+        assert self.results[0][1][1] == (240, 180)
+        # changed photo
+        self.photo = create_jpeg(size=(100, 200))
+        del self.results[:]
+        wait_for(loader.load('url', 'AA11111', self.callback), self.results)
+        assert loader.get_stats()['decode_count'] == 2
+        assert self.results[0][1][1] == (100, 200)
+        assert loader.get_stats()['hit_rate'] == 0.0
+        assert len(loader.cache) == 1
+
+    def test_fetch_failed(self):
+        # if the server cannot be asked, cached photos are shown
+        self.photo = create_jpeg()
+        loader = PhotoLoader(
+            self.fetch, make_texture=lambda size, pixels: 'tex', ttl=0)
+        wait_for(loader.load('url', 'AA11111', self.callback), self.results)
+        loader.fetch = lambda url, student_id: 'Error: down'
+        wait_for(loader.load('url', 'AA11111', self.callback), self.results)
+        assert self.results == [('AA11111', 'tex'), ('AA11111', 'tex')]
+
+    def test_no_photo(self):
+        # we get `None` if there is no photo
+        loader = PhotoLoader(self.fetch, make_texture=lambda *args: 'tex')
+        wait_for(loader.load('url', 'AA11111', self.callback), self.results)
+        assert self.results == [('AA11111', None)]
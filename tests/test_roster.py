@@ -0,0 +1,72 @@
+# Tests for roster module
+import re
+import pytest
+from waeup.identifier.roster import Roster, read_roster_file
+
+
+class TestRoster(object):
+
+    def test_contains(self):
+        # we can tell whether a student id is in the roster
+        roster = Roster(['AB12345', 'AA123456', 'A12345', 'AB12345'])
+        assert len(roster) == 3
+        assert 'AB12345' in roster
+        assert 'A12345' in roster
+        assert 'AB1234' not in roster
+        assert 'AB123456' not in roster
+        assert 'AA1234567' not in roster
+        assert '' not in roster
+        assert 'AB1234ä' not in roster
+
+    def test_sorted(self):
+        # ids are kept sorted in fixed size records
+        roster = Roster(['AB12345', 'AA123456', 'A12345'])
+        assert list(roster) == ['A12345', 'AA123456', 'AB12345']
+        assert roster.width == 8
+        assert roster.nbytes == 24
+
+    def test_empty(self):
+        # empty rosters contain nothing
+        roster = Roster()
+        assert len(roster) == 0
+        assert 'AA11111' not in roster
+        assert roster.complete('A') == []
+
+    def test_complete(self):
+        # we get student ids starting with a given prefix
+        roster = Roster(['AA%05d' % num for num in range(200)] + ['AB00001'])
+        assert roster.complete('AA0010') == [
+            'AA00100', 'AA00101', 'AA00102', 'AA00103', 'AA00104']
+        assert roster.complete('AA0019', limit=20) == [
+            'AA%05d' % num for num in range(190, 200)]
+        assert roster.complete('AB') == ['AB00001']
+        assert roster.complete('AC') == []
+        assert roster.complete('AA00199') == ['AA00199']
+        assert roster.complete('AA001990') == []
+
+
+class TestReadRosterFile(object):
+
+    def test_read(self, tmpdir):
+        # roster files list one id per line, maybe with more columns
+        path = tmpdir / 'roster.csv'
+        path.write(
+            '# exported from Kofa\nAA11111,Bob\n"aa22222","Alice"\n\n'
+            'AA33333\n')
+        roster, skipped = read_roster_file(str(path))
+        assert list(roster) == ['AA11111', 'AA22222', 'AA33333']
+        assert skipped == 0
+
+    def test_read_invalid(self, tmpdir):
+        # ids not matching the pattern are skipped
+        path = tmpdir / 'roster.csv'
+        path.write_text('AA11111\nstudent_id\nAAä1111\nA1\n', 'utf-8')
+        roster, skipped = read_roster_file(
+            str(path), re.compile('^[A-Z]{1,3}[0-9]{5,}$'))
+        assert list(roster) == ['AA11111']
+        assert skipped == 3
+
+    def test_read_missing(self, tmpdir):
+        # unreadable files raise IOError
+        with pytest.raises(IOError):
+            read_roster_file(str(tmpdir / 'missing.csv'))
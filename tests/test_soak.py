@@ -0,0 +1,43 @@
+# Tests for soak module
+import pytest
+from waeup.identifier.backends import SimulatedBackend, set_backend
+from waeup.identifier.soak import (
+    DEFAULT_LIMITS, SoakError, enroll_cycle, run_soak, verify_cycle,
+    )
+from waeup.identifier.testing import xmlrpc_create_student
+
+
+@pytest.fixture(scope="function")
+def soak_env(request, monkeypatch, tmpdir, kofa_server):
+    """A fake Kofa server with students and a simulated scanner.
+    """
+    monkeypatch.chdir(tmpdir)
+    old = set_backend(SimulatedBackend())
+    request.addfinalizer(lambda: set_backend(old))
+    for num in range(5):
+        xmlrpc_create_student('SK%05d' % num, db=kofa_server.db)
+    return kofa_server
+
+
+def test_enroll_verify_cycle(soak_env):
+    # we can enroll and verify students
+    enroll_cycle(soak_env.url, 'SK00001', [1, 2])
+    assert sorted(soak_env.db['SK00001']['fingerprints']) == ['1', '2']
+    verify_cycle(soak_env.url, 'SK00001')
+
+
+def test_cycle_errors(soak_env):
+    # failing cycles raise errors
+    with pytest.raises(SoakError):
+        enroll_cycle(soak_env.url, 'XX00001')
+    with pytest.raises(SoakError):
+        verify_cycle(soak_env.url, 'SK00002')
+
+
+def test_run_soak(soak_env):
+    # resources do not grow in soak runs
+    tracker = run_soak(
+        soak_env.url, 30, students=5, warmup=10, sample_every=10)
+    assert [x['label'] for x in tracker.samples] == [
+        'start', 'baseline', '20', '30', 'end']
+    assert tracker.check(DEFAULT_LIMITS) == []
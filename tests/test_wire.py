@@ -0,0 +1,81 @@
+# Tests for wire module
+import pytest
+try:
+    import xmlrpc.client as xmlrpcclient   # Python 3.x
+except ImportError:                        # pragma: no cover
+    import xmlrpclib as xmlrpcclient       # Python 2.x
+from waeup.identifier.wire import (
+    binary_dumps, binary_loads, binary_view, get_codec, CODECS,
+    )
+
+
+SAMPLE = {
+    'email': 'foo@sample.org',
+    'fingerprints': {'1': xmlrpcclient.Binary(b'FP1\x00\xff')},
+    'img': xmlrpcclient.Binary(b''),
+    'values': [1, -2, 3.5, True, False, 'ünicode'],
+    }
+
+
+class TestBinaryFormat(object):
+
+    def test_roundtrip(self):
+        # we can encode and decode all supported types
+        assert binary_loads(binary_dumps(SAMPLE)) == SAMPLE
+        assert binary_loads(binary_dumps([None])) == [None]
+
+    def test_bytes_become_binaries(self):
+        # bytes-like objects are decoded as Binary instances
+        result = binary_loads(binary_dumps(memoryview(b'FP1')))
+        assert isinstance(result, xmlrpcclient.Binary)
+        assert result.data == b'FP1'
+
+    def test_compact(self):
+        # binary data is not base64 encoded
+        data = b'x' * 3000
+        assert len(binary_dumps(data)) < len(data) + 10
+
+    def test_invalid(self):
+        # invalid data is detected
+        with pytest.raises(ValueError):
+            binary_loads(b'XXX')
+        with pytest.raises(ValueError):
+            binary_loads(binary_dumps([1, 2])[:-3])
+        with pytest.raises(ValueError):
+            binary_loads(binary_dumps(1) + b'N')
+        with pytest.raises(TypeError):
+            binary_dumps(object())
+
+
+class TestCodecs(object):
+
+    @pytest.mark.parametrize('name', sorted(CODECS))
+    def test_request_roundtrip(self, name):
+        # requests can be encoded and decoded
+        codec = get_codec(name)
+        data = codec.dumps_request('put_student_fingerprints', ['A1', SAMPLE])
+        assert codec.loads_request(data) == (
+            'put_student_fingerprints', ['A1', SAMPLE])
+
+    @pytest.mark.parametrize('name', sorted(CODECS))
+    def test_response_roundtrip(self, name):
+        # responses and faults can be encoded and decoded
+        codec = get_codec(name)
+        assert codec.loads_response(codec.dumps_response(SAMPLE)) == SAMPLE
+        with pytest.raises(xmlrpcclient.Fault):
+            codec.loads_response(codec.dumps_fault(3, 'Some fault'))
+
+    @pytest.mark.parametrize('name', sorted(CODECS))
+    def test_binary_view(self, name):
+        # binary views are encoded like binaries, but not copied
+        codec = get_codec(name)
+        buf = bytearray(b'FP1-fake-data')
+        value = binary_view(memoryview(buf)[:8])
+        assert value.data.obj is buf
+        data = codec.dumps_response({'1': value})
+        assert codec.loads_response(data)['1'].data == b'FP1-fake'
+
+    def test_get_codec_invalid(self):
+        # we complain about unknown codecs
+        with pytest.raises(ValueError):
+            get_codec('invalid')
@@ -15,26 +15,52 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import collections
+import configparser
+import contextlib
+import functools
+import io
+import math
 import os
 import re
 import string
 import subprocess
 import threading
+import time
 from kivy.app import App
-from kivy.clock import mainthread
+from kivy.clock import Clock, mainthread
 from kivy.config import Config
+from kivy.factory import Factory
 from kivy.logger import Logger
-from kivy.properties import BooleanProperty, StringProperty
+from kivy.metrics import dp
+from kivy.properties import (
+    BooleanProperty, ListProperty, NumericProperty, ObjectProperty,
+    StringProperty)
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.button import Button
+from kivy.uix.label import Label
 from kivy.uix.popup import Popup
+from kivy.uix.relativelayout import RelativeLayout
 from kivy.uix.screenmanager import ScreenManager
+from kivy.uix.scrollview import ScrollView
 from kivy.uix.textinput import TextInput
-from subprocess import Popen, PIPE
+from waeup.identifier.backends import check_path, get_backend  # noqa: F401
 from waeup.identifier.config import (
     get_json_settings, get_default_settings, get_conffile_location,
+    find_fpscan_binary, get_snapshot, ConfigWatcher,
 )
+from waeup.identifier.monitor import (
+    StallDetector, SamplingProfiler, get_profile_dir, profiling_requested,
+)
+from waeup.identifier.photos import PhotoLoader
+from waeup.identifier.roster import read_roster_file
+from waeup.identifier.routing import Route, Router, Prober, parse_routes
 from waeup.identifier.webservice import (
-    store_fingerprint, get_url, get_fingerprints,
+    store_fingerprints, get_templates, get_photo, CircuitBreaker,
+    set_default_codec, call_kofa, get_server_methods, get_error_message,
+    extract_photo,
 )
+from waeup.identifier.wire import binary_dumps, binary_loads, binary_view
 
 
 # Enable virtualkeyboard
@@ -43,10 +69,6 @@ if Config is not None:
     if not Config.get('kivy', 'keyboard_mode'):
         Config.set('kivy', 'keyboard_mode', 'systemandmulti')
 
-#: The set of chars allowed in filenames we handle.
-#: Last char must not be slash.
-VALID_FILENAME = re.compile('^[a-zA-Z0-9/\._\-]+$')
-
 #: A valid student id looks like this
 #: Two or three uppercase ASCIIs followed by at least five digits
 RE_STUDENT_ID = re.compile('^[A-Z]{1,3}[0-9]{5,}$')
@@ -56,40 +78,272 @@ RE_STUDENT_ID = re.compile('^[A-Z]{1,3}[0-9]{5,}$')
 POLL_INTERVAL = 0.1
 
 
+#: Time (in seconds) the main thread may spend on a single action
+#: without delaying the next frame.
+FRAME_BUDGET = 1.0 / 60
+
+
 #: Directory where we store images
 IMAGES_PATH = os.path.join(os.path.dirname(__file__), 'images')
 
+#: Atlas with all icons of `IMAGES_PATH`, loaded as single texture.
+#: Rebuild it after changing icons with::
+#:
+#:   $ cd waeup/identifier/images
+#:   $ python -m kivy.atlas icons 256 emblem-readonly.png ...
+ICONS_ATLAS = 'atlas://%s/icons' % IMAGES_PATH
 
-def get_fpm_path():
+#: Screens built when they are shown first. Maps screen names to
+#: (kv) class names.
+LAZY_SCREENS = {
+    'screen_scan': 'ScanScreen',
+    'screen_creds': 'CredsScreen',
+}
+
+
+def get_fpm_path(finger_num=None):
     """Get the canonical path where to store fpm files.
 
-    This is currently a single static path to a single file.
+    This is currently a single static path to a single file. If
+    `finger_num` is given, we return a separate path for captures of
+    this finger.
     """
+    if finger_num is not None:
+        return os.path.join(os.getcwd(), "data-%s.fpm" % finger_num)
     return os.path.join(os.getcwd(), "data.fpm")
 
 
-def check_path(path):
-    """Check a given path.
+def get_spool_dir():
+    """Get the directory where fingerprints of failed uploads are kept.
+    """
+    return os.path.join(os.path.expanduser('~'), '.waeupident-spool')
+
+
+#: Names of spool files: ``<STUDENT_ID>.spool``.
+RE_SPOOL_FILE = re.compile(r'^([A-Za-z0-9]+)\.spool$')
+
+#: Guards spool files and `_resending`.
+_spool_cond = threading.Condition()
+
+#: Ids of students whose spooled fingerprints are being uploaded.
+_resending = set()
+
+
+def get_rejected_dir(spool_dir=None):
+    """Get the directory for spool files the server did not accept.
+    """
+    return os.path.join(spool_dir or get_spool_dir(), 'rejected')
+
+
+def _wait_for_resend(student_id):
+    # wait until spooled fingerprints of `student_id` are not uploaded
+    # anymore. Call with `_spool_cond` acquired.
+    while student_id in _resending:
+        _spool_cond.wait()
+
 
-    `path` must exist, be valid, and be executable. The returned path
-    will be a 'normalized' with illegal chars stripped.
+def spool_fingerprints(student_id, fingerprints, spool_dir=None):
+    """Keep `fingerprints` of `student_id` on disk for a later upload.
 
-    Illegal chars are considered all except ``[a-zA-Z0-9_.-]`` as
-    written in the `VALID_FILENAME` regular expression.
+    `fingerprints` is a dict mapping finger numbers to fingerprint
+    data. All of them are written to a single file in `spool_dir`
+    (by default the dir from `get_spool_dir()`) in binary wire format.
+    The file replaces fingerprints spooled for `student_id` before in
+    one step, so captures of different attempts are never mixed.
 
-    If the path does not exist, contains illegal chars, or is not
-    executable, a `ValueError` is raised.
+    Returns the path written.
     """
-    if path is None:
-        raise ValueError("Path must be a string, not None.")
-    path = os.path.abspath(path)
-    if not VALID_FILENAME.match(path):
-        raise ValueError("Path contains illegal chars: %s" % path)
-    if not (os.path.isfile(path) and os.access(path, os.X_OK)):
-        raise ValueError("Not a valid executable path: %s" % path)
+    spool_dir = spool_dir or get_spool_dir()
+    os.makedirs(spool_dir, exist_ok=True)
+    path = os.path.join(spool_dir, "%s.spool" % student_id)
+    data = binary_dumps(dict(
+        (str(finger_num), binary_view(fingerprint))
+        for finger_num, fingerprint in fingerprints.items()))
+    with _spool_cond:
+        _wait_for_resend(student_id)
+        with open(path + '.tmp', 'wb') as fd:
+            fd.write(data)
+        os.replace(path + '.tmp', path)
     return path
 
 
+def read_spool_file(path):
+    """Read the fingerprints in spool file `path`.
+
+    Returns a dict mapping finger numbers to fingerprint data. Raises
+    `ValueError` if the file does not contain valid fingerprints.
+    """
+    with open(path, 'rb') as fd:
+        fingerprints = binary_loads(fd.read())
+    if not isinstance(fingerprints, dict):
+        raise ValueError("Invalid spool file: %s" % path)
+    result = dict()
+    for finger_num, data in fingerprints.items():
+        data = getattr(data, 'data', b'')
+        if not (finger_num.isdigit() and data.startswith(b'FP')):
+            raise ValueError("Invalid fingerprint data in %s" % path)
+        result[int(finger_num)] = data
+    return result
+
+
+def get_spooled(spool_dir=None):
+    """Get the spool files waiting in `spool_dir` for upload.
+
+    Returns a dict mapping student ids to paths.
+    """
+    spool_dir = spool_dir or get_spool_dir()
+    result = dict()
+    if not os.path.isdir(spool_dir):
+        return result
+    for filename in sorted(os.listdir(spool_dir)):
+        match = RE_SPOOL_FILE.match(filename)
+        if match is not None:
+            result[match.group(1)] = os.path.join(spool_dir, filename)
+    return result
+
+
+def discard_spooled(student_id, spool_dir=None):
+    """Remove fingerprints spooled for `student_id`.
+
+    Call this before newer captures of `student_id` are uploaded. If
+    spooled fingerprints of `student_id` are being uploaded right now,
+    we wait for that upload to finish, so it cannot overwrite the
+    newer captures on the server.
+    """
+    path = os.path.join(spool_dir or get_spool_dir(), "%s.spool" % student_id)
+    with _spool_cond:
+        _wait_for_resend(student_id)
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _reject_spooled(path, spool_dir):
+    # move spool file `path` out of the way for good
+    rejected_dir = get_rejected_dir(spool_dir)
+    os.makedirs(rejected_dir, exist_ok=True)
+    os.replace(path, os.path.join(rejected_dir, os.path.basename(path)))
+
+
+def upload_spooled(upload, spool_dir=None):
+    """Upload all fingerprints waiting in `spool_dir`.
+
+    `upload` is called with a student id and a dict of fingerprints
+    like `webservice.store_fingerprints` with
+    ``raise_unreachable=True``: it returns ``True`` on success or an
+    error message if the server did not accept the fingerprints, and
+    raises if the server could not be reached.
+
+    Files of uploaded students are removed. Files the server did not
+    accept (or that cannot be read) are moved to the dir from
+    `get_rejected_dir()` and not tried again. Other files are kept for
+    the next try.
+
+    Returns a tuple ``(<UPLOADED>, <FAILED>, <REJECTED>)``: a list of
+    student ids uploaded and two dicts mapping student ids to error
+    messages, of students kept for later and of students rejected.
+    """
+    spool_dir = spool_dir or get_spool_dir()
+    uploaded, failed, rejected = [], dict(), dict()
+    for student_id, path in sorted(get_spooled(spool_dir).items()):
+        with _spool_cond:
+            if not os.path.exists(path):
+                continue  # discarded meanwhile
+            try:
+                fingerprints = read_spool_file(path)
+            except (IOError, ValueError) as err:
+                rejected[student_id] = "%s" % err
+                _reject_spooled(path, spool_dir)
+                continue
+            _resending.add(student_id)
+        try:
+            result = upload(student_id, fingerprints)
+        except Exception as err:
+            result, failed[student_id] = None, get_error_message(err)
+        with _spool_cond:
+            _resending.discard(student_id)
+            _spool_cond.notify_all()
+            if result is True:
+                os.unlink(path)
+                uploaded.append(student_id)
+            elif result is not None:
+                rejected[student_id] = result
+                _reject_spooled(path, spool_dir)
+    return uploaded, failed, rejected
+
+
+def read_fpm_file(path):
+    """Read fingerprint data from `path`.
+
+    Returns the fingerprint data as bytes. If the file does not
+    contain fingerprint data as written by libfprint, a `ValueError`
+    is raised.
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    if not data.startswith(b'FP'):
+        raise ValueError("Invalid fingerprint data in %s" % path)
+    return data
+
+
+#: Initial size of `TemplateBuffer` instances. Enough for common
+#: fpm files.
+TEMPLATE_BUFFER_SIZE = 4096
+
+
+class TemplateBuffer(object):
+    """A reusable in-memory buffer for fingerprint data.
+
+    Fingerprint data is read into the buffer by `read_from()`, which
+    can be called several times. The buffer grows as needed but is
+    never shrunk, so once it has been grown, it is not reallocated
+    again.
+
+    `view()` gives the data currently held as `memoryview`. Views
+    must be released before the next `read_from()`.
+    """
+    def __init__(self, size=TEMPLATE_BUFFER_SIZE):
+        self._buf = bytearray(size)
+        self.length = 0
+
+    def read_from(self, fd):
+        """Fill buffer with data read from file descriptor `fd`.
+
+        Reads until end of file. `fd` is closed afterwards. Returns
+        the number of bytes read.
+        """
+        self.length = 0
+        with io.FileIO(fd, 'rb', closefd=True) as infile:
+            while True:
+                if self.length == len(self._buf):
+                    self._buf.extend(bytes(len(self._buf)))
+                with memoryview(self._buf) as view:
+                    num = infile.readinto(view[self.length:])
+                if not num:
+                    break
+                self.length += num
+        return self.length
+
+    def view(self):
+        """Get a `memoryview` of the data read.
+        """
+        return memoryview(self._buf)[:self.length]
+
+    def validate(self):
+        """Get the data read as `memoryview` if it is fingerprint data.
+
+        Raises `ValueError` otherwise.
+        """
+        if self.length < 2 or self._buf[:2] != b'FP':
+            raise ValueError("Invalid fingerprint data in capture")
+        return self.view()
+
+    def save(self, path):
+        """Write the data read to `path`.
+        """
+        with open(path, 'wb') as fd:
+            fd.write(self.view())
+
+
 def fpscan(path, args=[]):
     """Call fpscan binary in `path` and return output.
 
@@ -101,9 +355,11 @@ def fpscan(path, args=[]):
     stdout and stderr repsectively.
 
     Both, ``<OUT_DATA>`` and ``<ERR_DATA>`` are UTF-8 encoded strings.
+
+    `fpscan` is run by the current scanner backend (see `backends`).
     """
     cmd = [path] + args
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    p = get_backend().popen(cmd)
     out, err = p.communicate()
     return p.returncode, out.decode('utf-8'), err.decode('utf-8')
 
@@ -114,7 +370,7 @@ def detect_scanners(fpscan_path):
     We use `fpscan` to find and work with available fingerprint
     scanners.
     """
-    path = check_path(fpscan_path)
+    path = get_backend().check(fpscan_path)
     status, out, err = fpscan(path)
     if status != 0:   # detection failed
         return []
@@ -125,10 +381,48 @@ def detect_scanners(fpscan_path):
     return result
 
 
+def find_scanners(fpscan_path):
+    """Detect available fingerprint scanners like `detect_scanners`.
+
+    Different to `detect_scanners` we do not raise exceptions on
+    invalid `fpscan_path` but return an empty list. Useful when
+    detecting in background.
+    """
+    try:
+        return detect_scanners(fpscan_path)
+    except ValueError:
+        return []
+
+
+def arm_scanner(fpscan_path, params, capture=None, scanners=None,
+                callback=None):
+    """Prepare a scan command. Meant to be run in background.
+
+    Checks the `fpscan_path`, detects scanners (if no `scanners` are
+    given) and creates an `FPScanCommand` with `params`, `capture` and
+    `callback`. The command is not started.
+
+    Returns a tuple ``(<ERROR>, <SCANNERS>, <COMMAND>)`` where
+    ``<ERROR>`` is `None`, ``'invalid-path'`` or ``'no-scanner'``.
+    """
+    if not get_backend().exists(fpscan_path):
+        return 'invalid-path', [], None
+    if not scanners:
+        try:
+            scanners = detect_scanners(fpscan_path)
+        except ValueError:
+            return 'invalid-path', [], None
+    if not scanners:
+        return 'no-scanner', [], None
+    cmd = FPScanCommand(
+        path=fpscan_path, params=params, callback=callback, capture=capture)
+    return None, scanners, cmd
+
+
 def scan(fpscan_path, device):
     """Perform a fingerprint scan.
     """
-    path = check_path(fpscan_path)
+    path = get_backend().check(fpscan_path)
     status, out, err = fpscan(path, ['-s', '-d', str(device)])
     if status != 0:  # scan failed
         raise ValueError('Scan failed: %s' % err)
@@ -194,6 +488,7 @@ class BackgroundCommand(threading.Thread):
         self.stdout_data = None
         self.stderr_data = None
         self.is_killed = False
+        self.pass_fds = ()
 
     def run(self):
         """Code run in a separate thread.
@@ -206,8 +501,8 @@ class BackgroundCommand(threading.Thread):
         concurrent thread.
         """
         # override base
-        self.p = subprocess.Popen(
-            self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.p = self.spawn()
+        self.process_started()
         if self.timeout is not None:
             # start watchdog that aborts when we need too much time
             self._timer = threading.Timer(self.timeout, self._kill)
@@ -215,12 +510,32 @@ class BackgroundCommand(threading.Thread):
             self._timer.start()
         self.stdout_data, self.stderr_data = self.p.communicate()
         self.returncode = self.p.returncode
+        self.process_finished()
         if self.callback is not None:
             if self._timer is not None:
                 self._timer.cancel()
             self.callback(self)
         return
 
+    def spawn(self):
+        """Start the subprocess and return it.
+        """
+        return subprocess.Popen(
+            self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            pass_fds=self.pass_fds)
+
+    def process_started(self):
+        """Hook called right after the subprocess was started.
+        """
+        pass
+
+    def process_finished(self):
+        """Hook called when the subprocess finished.
+
+        Called before `callback`.
+        """
+        pass
+
     def _kill(self):
         """Kill any running thread.
 
@@ -248,17 +563,54 @@ class BackgroundCommand(threading.Thread):
 
 
 class FPScanCommand(BackgroundCommand):
-    def __init__(self, path, params=[], timeout=None, callback=None):
+    def __init__(self, path, params=[], timeout=None, callback=None,
+                 capture=None, backend=None):
         """Execute `fpscan` as background command.
 
         `path` must be an existing binary path. `params` is a list of
         options to use when calling fpscan.
+
+        `capture`, if given, is a `TemplateBuffer`. Scanned
+        fingerprints are then not written to disk but passed through a
+        pipe into this buffer.
+
+        `backend` is the scanner backend running `fpscan`. By default
+        the current backend of the `backends` module.
         """
         cmd = [path, ] + params
-        if not os.path.exists(path):
+        self.backend = backend or get_backend()
+        if not self.backend.exists(path):
             raise IOError("No such path: %s" % (path, ))
         super(FPScanCommand, self).__init__(
             cmd, timeout=timeout, callback=callback)
+        self.capture = capture
+        self._reader = None
+        self._write_fd = None
+
+    def run(self):
+        if self.capture is not None:
+            read_fd, self._write_fd = os.pipe()
+            self.cmd = self.cmd + ['-o', '/dev/fd/%s' % self._write_fd]
+            self.pass_fds = (self._write_fd, )
+            self._reader = threading.Thread(
+                target=self.capture.read_from, args=(read_fd, ),
+                daemon=True)
+        super(FPScanCommand, self).run()
+
+    def spawn(self):
+        return self.backend.popen(self.cmd, pass_fds=self.pass_fds)
+
+    def process_started(self):
+        if self._reader is None:
+            return
+        # the child owns the write end now. We must close ours to
+        # see the end of data.
+        os.close(self._write_fd)
+        self._reader.start()
+
+    def process_finished(self):
+        if self._reader is not None:
+            self._reader.join()
 
     def get_result(self):
         """Return stdout output with newlines turned into spaces.
@@ -276,11 +628,635 @@ def call_in_background(callable, args=(), kwargs={}, callback=None):
     return thread
 
 
+class ResultJoin(object):
+    """Join results of several concurrently running jobs.
+
+    `names` is a list of job names. Each job should deliver its result
+    via `set_result()`. As soon as all jobs delivered, `callback` is
+    called with the `ResultJoin` instance as only argument. The
+    results can then be retrieved from the `results` dict, which maps
+    job names to results.
+
+    A join can be canceled with `cancel()`. Afterwards all results
+    are discarded and `callback` will not be called.
+    """
+    def __init__(self, names, callback):
+        self.pending = set(names)
+        self.results = dict()
+        self.callback = callback
+        self.canceled = False
+        self._lock = threading.Lock()
+
+    def set_result(self, name, result):
+        """Set `result` for job `name`.
+
+        Returns `True` if the result was accepted, `False` else.
+        """
+        with self._lock:
+            if self.canceled or name not in self.pending:
+                return False
+            self.results[name] = result
+            self.pending.discard(name)
+            done = not self.pending
+        if done:
+            self.callback(self)
+        return True
+
+    def result_setter(self, name):
+        """Get a callable that sets the result of job `name`.
+
+        The callable can be passed as `callback` to
+        `call_in_background`.
+        """
+        return functools.partial(self.set_result, name)
+
+    def cancel(self):
+        """Cancel the join.
+        """
+        with self._lock:
+            self.canceled = True
+
+
+class Prefetcher(object):
+    """Fetch data in background before it is actually requested.
+
+    `func` is the callable doing the actual work, for instance
+    `get_templates`.
+
+    Call `prefetch()` as soon as you know what will be requested
+    soon. When the data is actually needed, call `fetch()` with the
+    same arguments. If a prefetch with these arguments is running or
+    done, its result is reused instead of calling `func` again.
+
+    Only one prefetch is kept at a time. Starting a prefetch with
+    different arguments cancels the current one. Running calls cannot
+    be aborted, but results of canceled prefetches are discarded.
+
+    `hits`, `misses` and `saved_time` (the number of seconds callers
+    did not have to wait thanks to prefetching) provide statistics.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+        self._current = None
+        self._lock = threading.Lock()
+
+    def prefetch(self, *args):
+        """Start calling `func` with `args` in background.
+        """
+        with self._lock:
+            if self._current is not None and self._current['args'] == args:
+                return
+            self._cancel()
+            entry = dict(
+                args=args, started=time.time(), finished=None,
+                result=None, callbacks=[], canceled=False)
+            self._current = entry
+        call_in_background(
+            self.func, args=args,
+            callback=functools.partial(self._finished, entry))
+
+    def _finished(self, entry, result):
+        with self._lock:
+            if entry['canceled']:
+                return
+            entry['finished'] = time.time()
+            entry['result'] = result
+            callbacks, entry['callbacks'] = entry['callbacks'], []
+        for callback in callbacks:
+            callback(result)
+
+    def fetch(self, args, callback):
+        """Get the result of calling `func` with `args`.
+
+        `callback` is called with the result. If a matching prefetch
+        exists, it is consumed and `callback` is called as soon as
+        the prefetch finished, i.e. maybe immediately. Otherwise `func`
+        is called in background.
+        """
+        args = tuple(args)
+        with self._lock:
+            entry = self._current
+            if entry is None or entry['args'] != args:
+                self.misses += 1
+                entry = None
+            else:
+                self._current = None
+                self.hits += 1
+                now = time.time()
+                self.saved_time += min(
+                    now, entry['finished'] or now) - entry['started']
+                if entry['finished'] is None:
+                    entry['callbacks'].append(callback)
+                    return
+        if entry is None:
+            call_in_background(self.func, args=args, callback=callback)
+        else:
+            callback(entry['result'])
+
+    def _cancel(self):
+        if self._current is not None:
+            self._current['canceled'] = True
+            self._current = None
+
+    def cancel(self):
+        """Discard any prefetched data.
+        """
+        with self._lock:
+            self._cancel()
+
+    def get_stats(self):
+        """Get a dict with hits, misses, hit rate and saved time.
+        """
+        requests = self.hits + self.misses
+        return dict(
+            hits=self.hits, misses=self.misses,
+            hit_rate=float(self.hits) / requests if requests else 0.0,
+            saved_time=self.saved_time)
+
+
+class EnrollmentSession(object):
+    """Capture several fingers of a student for a single upload.
+
+    `student_id` is the id of the student to enroll and `fingers` the
+    numbers of fingers to capture, in the order they should be
+    captured.
+
+    Each capture is validated in background via `add_capture()`, so
+    the next finger can be captured meanwhile. Captures that turn out
+    to be invalid are requested again by `next_finger()`.
+
+    Validated fingerprints are kept in `fingerprints`, a dict mapping
+    finger numbers to fingerprint data. Captures read into buffers
+    from `get_buffer()` are kept as `memoryview`, i.e. they are not
+    copied.
+    """
+    def __init__(self, student_id, fingers=(1, )):
+        self.student_id = student_id
+        self.fingers = list(fingers)
+        self.fingerprints = dict()
+        self.errors = dict()
+        self.started = time.time()
+        self.spool_path = None
+        self._captured = set()
+        self._pending = set()
+        self._callbacks = []
+        self._buffers = dict()
+        self._lock = threading.Lock()
+
+    def get_buffer(self, finger_num):
+        """Get a `TemplateBuffer` to capture `finger_num` into.
+
+        The same buffer is returned for the same finger, so retakes
+        reuse it. Any fingerprint kept from an earlier capture of this
+        finger is dropped.
+        """
+        with self._lock:
+            data = self.fingerprints.pop(finger_num, None)
+        if isinstance(data, memoryview):
+            data.release()
+        if finger_num not in self._buffers:
+            self._buffers[finger_num] = TemplateBuffer()
+        return self._buffers[finger_num]
+
+    def next_finger(self):
+        """Get the number of the next finger to capture.
+
+        Returns `None` if all fingers were captured already.
+        """
+        with self._lock:
+            for finger_num in self.fingers:
+                if finger_num not in self._captured:
+                    return finger_num
+        return None
+
+    def add_capture(self, finger_num, capture):
+        """Add the capture of `finger_num`.
+
+        `capture` is a `TemplateBuffer` or the path of an `.fpm`
+        file. The capture is validated (and the file read) in
+        background.
+        """
+        with self._lock:
+            self._captured.add(finger_num)
+            self._pending.add(finger_num)
+            self.errors.pop(finger_num, None)
+        thread = threading.Thread(
+            target=self._validate, args=(finger_num, capture), daemon=True)
+        thread.start()
+        return thread
+
+    def _validate(self, finger_num, capture):
+        try:
+            if isinstance(capture, TemplateBuffer):
+                data, error = capture.validate(), None
+            else:
+                data, error = read_fpm_file(capture), None
+        except (IOError, ValueError) as err:
+            data, error = None, "%s" % err
+        with self._lock:
+            self._pending.discard(finger_num)
+            if error is None:
+                self.fingerprints[finger_num] = data
+            else:
+                self.errors[finger_num] = error
+                self._captured.discard(finger_num)
+            callbacks = []
+            if not self._pending:
+                callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def when_validated(self, callback):
+        """Call `callback` when all captures are validated.
+
+        `callback` is called with the session as only argument, maybe
+        immediately. Afterwards `errors` tells about invalid captures.
+        """
+        with self._lock:
+            if self._pending:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def save(self, spool_dir=None):
+        """Write all captured fingerprints to `spool_dir`.
+
+        They are uploaded later by `upload_spooled`. Returns the path
+        written, which is also kept in `spool_path`.
+        """
+        self.spool_path = spool_fingerprints(
+            self.student_id, self.fingerprints, spool_dir)
+        return self.spool_path
+
+
+#: Number of enroll and verify results kept in the activity list.
+ACTIVITY_SIZE = 500
+
+
+class ActivityLog(object):
+    """The most recent `size` enroll and verify results.
+
+    Entries can be added from any thread. `on_change`, if given, is
+    called after each `add()` in the adding thread. Pass a `Clock`
+    trigger to refresh the UI at most once per frame.
+    """
+    def __init__(self, size=ACTIVITY_SIZE, on_change=None):
+        self.entries = collections.deque(maxlen=size)
+        self.on_change = on_change
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def add(self, kind, student_id, message, ok=True):
+        """Add an entry of `kind` (``enroll``, ``verify`` or ``resend``).
+        """
+        with self._lock:
+            self.entries.appendleft(
+                (time.time(), kind, student_id, message, ok))
+            self.total += 1
+        if self.on_change is not None:
+            self.on_change()
+
+    def get_rows(self):
+        """Get entries, newest first, as data for an `ActivityList`.
+        """
+        with self._lock:
+            entries = list(self.entries)
+        return [dict(
+            text="%s  %-6s  %s: %s" % (
+                time.strftime('%H:%M:%S', time.localtime(timestamp)),
+                kind, student_id, message),
+            color=(.6, .6, .6, 1) if ok else (1, .4, .4, 1))
+            for timestamp, kind, student_id, message, ok in entries]
+
+
+class ActivityRow(Label):
+    """A row of an `ActivityList`.
+    """
+
+
+class ActivityList(ScrollView):
+    """A scrollable, virtualized list showing rows of an `ActivityLog`.
+
+    `data` is a list of dicts with ``text`` and ``color`` of each row,
+    as returned by `ActivityLog.get_rows`. The list holds a spacer as
+    high as all rows together and a fixed pool of row labels, just
+    enough to fill the viewport. When `data` changes or the list is
+    scrolled, only the visible slice of `data` is assigned to the
+    pooled labels.
+    """
+    data = ListProperty([])
+
+    #: Height of each row in pixels.
+    row_height = NumericProperty(dp(24))
+
+    def __init__(self, **kwargs):
+        self.spacer = RelativeLayout(size_hint_y=None, height=0)
+        self.rows = []
+        super(ActivityList, self).__init__(**kwargs)
+        self.add_widget(self.spacer)
+        self.bind(
+            data=self.update_rows, scroll_y=self.update_rows,
+            height=self.update_rows, row_height=self.update_rows)
+        self.spacer.bind(width=self.update_rows)
+
+    def get_visible_range(self):
+        """Get index of first visible row and number of pooled rows.
+        """
+        pool_size = int(math.ceil(self.height / self.row_height)) + 1
+        hidden = max(self.spacer.height - self.height, 0)
+        offset = (1.0 - min(max(self.scroll_y, 0.0), 1.0)) * hidden
+        first = int(offset // self.row_height)
+        return first, pool_size
+
+    def update_rows(self, *args):
+        """Assign the visible slice of `data` to the pooled labels.
+        """
+        data = self.data
+        self.spacer.height = len(data) * self.row_height
+        first, pool_size = self.get_visible_range()
+        while len(self.rows) < pool_size:
+            label = ActivityRow(size_hint=(None, None))
+            self.rows.append(label)
+            self.spacer.add_widget(label)
+        while len(self.rows) > pool_size:
+            self.spacer.remove_widget(self.rows.pop())
+        for num, label in enumerate(self.rows, first):
+            label.size = self.spacer.width, self.row_height
+            if num < len(data):
+                label.y = self.spacer.height - (num + 1) * self.row_height
+                label.text, label.color = (
+                    data[num]['text'], data[num]['color'])
+                label.opacity = 1
+            else:
+                label.text = ''
+                label.opacity = 0
+
+
+#: Seconds without user activity before the app goes idle.
+IDLE_TIMEOUT = 120
+
+#: Frames per second while idle.
+IDLE_FPS = 2
+
+
+class IdleMode(object):
+    """Lower the frame rate while nobody uses the app.
+
+    After `timeout` seconds without activity the kivy `clock` runs at
+    `idle_fps` frames per second instead of its configured maximum,
+    leaving CPU to `fpscan` and network threads. A `timeout` of zero
+    disables idle mode. While `busy()` returns true, the app is
+    considered active.
+
+    `poke()` notes activity and restores the frame rate. `check()`
+    must be called regularly. Both must be called from the main
+    thread. `callback`, if given, is called with the idle state
+    whenever it changes.
+
+    Wall and CPU time spent in both states are counted to measure the
+    savings.
+    """
+    def __init__(self, timeout=IDLE_TIMEOUT, idle_fps=IDLE_FPS, clock=None,
+                 busy=None, callback=None):
+        self.timeout = timeout
+        self.idle_fps = idle_fps
+        self.clock = clock or Clock
+        self.busy = busy
+        self.callback = callback
+        self.idle = False
+        self.active_fps = None
+        self.last_activity = time.monotonic()
+        self.times = dict(active=[0.0, 0.0], idle=[0.0, 0.0])
+        self._mark = (time.monotonic(), time.process_time())
+
+    def _account(self):
+        # add wall and CPU time passed to the current state
+        mark = (time.monotonic(), time.process_time())
+        times = self.times['idle' if self.idle else 'active']
+        times[0] += mark[0] - self._mark[0]
+        times[1] += mark[1] - self._mark[1]
+        self._mark = mark
+
+    def set_idle(self, idle):
+        """Enter (`idle` is true) or leave idle mode.
+        """
+        if idle == self.idle:
+            return
+        self._account()
+        self.idle = idle
+        # kivy offers no public API to change the frame rate at runtime
+        if idle:
+            self.active_fps = self.clock._max_fps
+            self.clock._max_fps = float(self.idle_fps)
+        else:
+            self.clock._max_fps = self.active_fps
+        Logger.debug("waeup.identifier: %s idle mode" % (
+            'entering' if idle else 'leaving'))
+        if self.callback is not None:
+            self.callback(self, idle)
+
+    def poke(self, *args):
+        """Note user activity, scanner events or background results.
+
+        Can be bound to window events. Never consumes them.
+        """
+        self.last_activity = time.monotonic()
+        self.set_idle(False)
+
+    def check(self, dt=None, now=None):
+        """Enter idle mode if there was no activity for long enough.
+
+        Returns the idle state.
+        """
+        now = now or time.monotonic()
+        if self.busy is not None and self.busy():
+            self.last_activity = now
+        if self.timeout > 0 and now - self.last_activity >= self.timeout:
+            self.set_idle(True)
+        return self.idle
+
+    def get_stats(self):
+        """Get a dict with wall time (seconds) and CPU load (percent)
+        for both, active and idle state.
+        """
+        self._account()
+        result = dict()
+        for state, (wall, cpu) in self.times.items():
+            result['%s_time' % state] = wall
+            result['%s_cpu' % state] = cpu * 100.0 / wall if wall else 0.0
+        return result
+
+    def format(self):
+        """Get a one-line summary suitable for logs.
+        """
+        return (
+            "idle %(idle_time).0fs at %(idle_cpu).1f%% CPU, "
+            "active %(active_time).0fs at %(active_cpu).1f%% CPU" % (
+                self.get_stats()))
+
+
+class ThroughputCounter(object):
+    """Compute throughput (jobs per minute) over a sliding window.
+
+    Each finished job is recorded with its start time. The throughput
+    is the number of jobs finished during the last `window` seconds
+    divided by the time passed since the earliest of them started.
+    """
+    def __init__(self, window=600.0):
+        self.window = window
+        self.total = 0
+        self.jobs = collections.deque()
+
+    def record(self, started, finished=None):
+        """Record a job started at `started` and finished at `finished`.
+
+        Both are timestamps as returned by `time.time()`. `finished`
+        defaults to now.
+        """
+        finished = finished or time.time()
+        self.jobs.append((started, finished))
+        self.total += 1
+
+    def per_minute(self, now=None):
+        """Get the number of jobs finished per minute.
+        """
+        now = now or time.time()
+        while self.jobs and self.jobs[0][1] < now - self.window:
+            self.jobs.popleft()
+        if not self.jobs:
+            return 0.0
+        elapsed = now - min(started for started, finished in self.jobs)
+        if elapsed <= 0:
+            return 0.0
+        return len(self.jobs) * 60.0 / elapsed
+
+
+class BlockingMeter(object):
+    """Measure how long actions block the main thread.
+
+    Actions taking longer than `budget` seconds delay the next frame
+    and are logged.
+    """
+    def __init__(self, budget=FRAME_BUDGET):
+        self.budget = budget
+        self.stats = dict()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Measure the time the `with` block named `name` takes.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            count, total, maximum, over = self.stats.get(
+                name, (0, 0.0, 0.0, 0))
+            if elapsed > self.budget:
+                over += 1
+                Logger.warning(
+                    "waeup.identifier: %s blocked main thread for "
+                    "%.1f ms" % (name, elapsed * 1000))
+            self.stats[name] = (
+                count + 1, total + elapsed, max(maximum, elapsed), over)
+
+    def get_stats(self):
+        """Get a dict mapping action names to dicts with `count`,
+        `avg` and `max` blocking time and the number of calls
+        `over_budget`.
+        """
+        return dict(
+            (name, dict(count=count, avg=total / count, max=maximum,
+                        over_budget=over))
+            for name, (count, total, maximum, over) in self.stats.items())
+
+
+def measure_blocking(func):
+    """Decorate `FPScanApp` methods to measure their blocking time.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.blocking_meter.measure(func.__name__):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class Warmup(object):
+    """Run preparation stages in background.
+
+    `stages` is a list of tuples ``(<NAME>, <CALLABLE>)``. The stages
+    are run one after another in a background thread. Each callable is
+    called with the `results` dict of stages run before and returns
+    the result of its stage. Exceptions raised mark a stage as failed.
+
+    `callback`, if given, is called with the warmup instance and the
+    stage name whenever a stage is done.
+
+    Results are kept in `results`, error messages of failed stages in
+    `errors` and the seconds each stage needed in `durations`.
+    """
+    def __init__(self, stages, callback=None):
+        self.stages = list(stages)
+        self.callback = callback
+        self.results = dict()
+        self.errors = dict()
+        self.durations = dict()
+        self.running = False
+
+    def start(self, names=None):
+        """Run stages named in `names` (all by default) in background.
+
+        Returns the thread started.
+        """
+        self.running = True
+        thread = threading.Thread(
+            target=self.run, args=(names, ), daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, names=None):
+        for name, func in self.stages:
+            if names is not None and name not in names:
+                continue
+            start = time.time()
+            self.errors.pop(name, None)
+            try:
+                self.results[name] = func(self.results)
+            except Exception as err:
+                self.results.pop(name, None)
+                self.errors[name] = "%s" % err
+            self.durations[name] = time.time() - start
+            if self.callback is not None:
+                self.callback(self, name)
+        self.running = False
+
+    @property
+    def ready(self):
+        """Tell whether all stages were run successfully.
+        """
+        return not self.errors and len(self.results) == len(self.stages)
+
+
 class StudentIdInput(TextInput):
     """A `TextInput` turning input into upper case.
 
     Apart from that we allow only `[A-Z0-9]` as chars.
+
+    If a `roster` is set, `suggestions` holds the student ids in it
+    starting with the text entered so far.
     """
+    roster = ObjectProperty(None, allownone=True)
+    suggestions = ListProperty([])
+
+    def on_text(self, instance, value):
+        if self.roster is None or not value:
+            self.suggestions = []
+        else:
+            self.suggestions = self.roster.complete(value)
+
     def insert_text(self, substring, from_undo=False):
         s = substring.upper()
         s = ''.join(
@@ -288,6 +1264,30 @@ class StudentIdInput(TextInput):
         return super(StudentIdInput, self).insert_text(s, from_undo=from_undo)
 
 
+class SuggestionButton(Button):
+    """A button of a `SuggestionBar`.
+    """
+
+
+class SuggestionBar(BoxLayout):
+    """Buttons for the student ids suggested by a `StudentIdInput`.
+
+    There is one `SuggestionButton` for each entry of `suggestions`.
+    Buttons are reused when `suggestions` change.
+    """
+    suggestions = ListProperty([])
+
+    def on_suggestions(self, instance, suggestions):
+        buttons = list(reversed(self.children))
+        for button in buttons[len(suggestions):]:
+            self.remove_widget(button)
+        for num, student_id in enumerate(suggestions):
+            if num < len(buttons):
+                buttons[num].text = student_id
+            else:
+                self.add_widget(SuggestionButton(text=student_id))
+
+
 class FPScanPopup(Popup):
     """A popup in the `FPScanApp` application.
 
@@ -339,15 +1339,58 @@ class FPScanApp(App):
     detected_scanners = []
     chosen_scanner = None
     icon = '%s/fingerprint-gui_24x24.png' % IMAGES_PATH
-    creds_icon = '%s/emblem-readonly.png' % IMAGES_PATH
+    bar_icon = '%s/fingerprint-gui_24x24' % ICONS_ATLAS
+    creds_icon = '%s/emblem-readonly' % ICONS_ATLAS
     prevent_scanning = BooleanProperty(True)
+    server_available = BooleanProperty(True)
+    readiness = StringProperty('Starting...')
+    enroll_status = StringProperty('')
+    throughput = StringProperty('')
+    endpoint_stats = StringProperty('')
+    activity_data = ListProperty([])
+    roster = ObjectProperty(None, allownone=True)
     cmd_running = None
+    verify_join = None
+    enroll_session = None
+    capture_finger = None
+    arming_token = None
     scan_canceled = False
     mode = StringProperty('main')
     old_mode = 'main'
     last_screen = 'screen_main'
     waeup_username = ''
     waeup_password = ''
+    spool_running = False
+    downloaded_photo = None
+    snapshot = None
+    config_watcher = None
+    config_reloading = None
+
+    def __init__(self, **kwargs):
+        super(FPScanApp, self).__init__(**kwargs)
+        self.circuit_breaker = CircuitBreaker()
+        self.circuit_breaker.add_listener(self.on_server_state)
+        self.router = Router(Route('', '', self.circuit_breaker))
+        self.prober = Prober(self.get_probe_targets, callback=self.probes_done)
+        self.prefetcher = Prefetcher(self.fetch_templates)
+        self.enroll_stats = ThroughputCounter()
+        self.enroll_results = collections.deque(maxlen=5)
+        self.activity = ActivityLog(
+            on_change=Clock.create_trigger(self.refresh_activity))
+        self.uploads_running = 0
+        self.photo_loader = PhotoLoader(self.fetch_photo)
+        self.started = time.time()
+        self.first_scan_time = None
+        self.blocking_meter = BlockingMeter()
+        self.stall_detector = StallDetector()
+        self.beat_event = None
+        self.idle_mode = IdleMode(busy=self.is_busy, callback=self.on_idle)
+        self.profiler = SamplingProfiler(get_profile_dir())
+        self.warmup = Warmup([
+            ('fpscan', self.warmup_fpscan),
+            ('scanners', self.warmup_scanners),
+            ('server', self.warmup_server),
+            ], callback=self.warmup_stage_done)
 
     def build(self):
         from kivy.uix.settings import Settings
@@ -355,8 +1398,158 @@ class FPScanApp(App):
         Logger.debug("waeup.identifier: Icon path set to %s" % self.icon)
         result = super(FPScanApp, self).build()
         self.screen_manager = self.get_screen_manager()
+        self.set_wire_codec(self.snapshot.wire_codec)
+        self.set_routes()
+        self.set_idle_mode()
+        self.set_roster()
         return result
 
+    def on_start(self):
+        """The application started.
+
+        Warm up in background and preload images. Start watching the
+        UI for stalls and for user activity and the config file for
+        changes.
+        """
+        from kivy.core.window import Window
+        self.warmup.start()
+        Clock.schedule_once(self.preload_images)
+        self.beat_event = Clock.schedule_interval(self.stall_detector.beat, 0)
+        Clock.schedule_interval(self.stall_detector.log_stats, 60)
+        Clock.schedule_interval(self.idle_mode.check, 1)
+        Window.bind(
+            on_touch_down=self.idle_mode.poke, on_key_down=self.idle_mode.poke)
+        self.stall_detector.start()
+        self.prober.start()
+        self.set_profiling(profiling_requested() or self.snapshot.profiling)
+        self.config_watcher = ConfigWatcher(
+            self.get_application_config(), self.config_file_changed)
+        self.config_watcher.start()
+
+    def on_stop(self):
+        """The application stops.
+        """
+        self.stall_detector.stop()
+        self.stall_detector.log_stats()
+        self.profiler.stop()
+        self.prober.stop()
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
+        Logger.info("waeup.identifier: %s" % self.idle_mode.format())
+
+    def set_profiling(self, enabled):
+        """Start or stop the sampling profiler.
+        """
+        if enabled:
+            self.profiler.start()
+        else:
+            self.profiler.stop()
+
+    def set_idle_mode(self):
+        """Set idle timeout and frame rate from config.
+        """
+        self.idle_mode.timeout = self.snapshot.idle_timeout
+        self.idle_mode.idle_fps = max(self.snapshot.idle_fps, 1.0)
+        self.idle_mode.poke()
+
+    def is_busy(self):
+        """Tell whether a scan or upload is running.
+        """
+        return self.cmd_running is not None or self.uploads_running > 0
+
+    def on_idle(self, idle_mode, idle):
+        """The app entered or left idle mode.
+
+        Frames are rare while idle. Stall detection is paused meanwhile.
+        """
+        if self.beat_event is None:
+            return
+        if idle:
+            self.beat_event.cancel()
+            self.stall_detector.pause()
+        else:
+            self.beat_event()
+
+    def warmup_fpscan(self, results):
+        """Warmup stage: find and check the `fpscan` binary.
+        """
+        path = self.snapshot.fpscan_path
+        return get_backend().check(find_fpscan_binary(path) or path)
+
+    def warmup_scanners(self, results):
+        """Warmup stage: detect scanner devices.
+        """
+        if 'fpscan' not in results:
+            raise ValueError("No fpscan binary")
+        scanners = find_scanners(results['fpscan'])
+        if not scanners:
+            raise ValueError("No scanner found")
+        return scanners
+
+    def warmup_server(self, results):
+        """Warmup stage: contact and authenticate at Kofa servers.
+
+        We ping all routed servers and learn about the methods they
+        support. Returns the methods of the default server.
+        """
+        result = None
+        for route in self.router.routes:
+            if not (self.waeup_username or route.has_credentials()):
+                raise ValueError("No credentials")
+            url = route.get_url(
+                self.waeup_username, self.waeup_password, write=True)
+            try:
+                call_kofa(url, 'ping', ('waeup.identifier', ), retries=0,
+                          breaker=route.breaker)
+                methods = get_server_methods(url, breaker=route.breaker)
+            except Exception as err:
+                raise ValueError(get_error_message(err))
+            if result is None:
+                result = methods
+        return result
+
+    @mainthread
+    def warmup_stage_done(self, warmup, name):
+        """Warmup stage `name` is done.
+
+        This is a callback function which might be called from a
+        separate thread.
+        """
+        Logger.info(
+            "waeup.identifier: warmup stage %s done in %.3f secs: %s" % (
+                name, warmup.durations[name],
+                warmup.errors.get(name, 'ok')))
+        if name == 'scanners' and name in warmup.results:
+            self.detected_scanners = warmup.results[name]
+        if name == 'server' and name in warmup.results:
+            self.resend_spooled()
+        if warmup.ready:
+            self.readiness = 'Ready'
+        elif warmup.running:
+            self.readiness = 'Starting...'
+        else:
+            self.readiness = 'Not ready: %s' % ', '.join(
+                '%s (%s)' % (key, warmup.errors[key])
+                for key in sorted(warmup.errors))
+
+    def preload_images(self, dt=None):
+        """Load the icons atlas into the kivy image cache.
+
+        All icons are uploaded as a single texture.
+        """
+        from kivy.core.image import Image as CoreImage
+        CoreImage(self.creds_icon)
+
+    def set_wire_codec(self, name):
+        """Set the wire codec used to talk to Kofa servers.
+        """
+        try:
+            set_default_codec(name)
+        except ValueError:
+            Logger.warning("waeup.identifier: invalid wire codec: %s" % name)
+            return
+        Logger.debug("waeup.identifier: wire codec set to %s" % name)
+
     def get_application_config(self):
         """Get path of app configuration file.
 
@@ -375,6 +1568,30 @@ class FPScanApp(App):
             if isinstance(widget, ScreenManager):
                 return widget
 
+    def get_screen(self, name):
+        """Get the screen called `name`.
+
+        Screens in `LAZY_SCREENS` are created when requested first.
+        """
+        screen_mgr = self.screen_manager
+        if not screen_mgr.has_screen(name) and name in LAZY_SCREENS:
+            start = time.perf_counter()
+            screen_mgr.add_widget(getattr(Factory, LAZY_SCREENS[name])())
+            Logger.debug(
+                "waeup.identifier: built %s in %.1f ms" % (
+                    name, (time.perf_counter() - start) * 1000))
+        return screen_mgr.get_screen(name)
+
+    def show_screen(self, name, direction=None):
+        """Switch to screen `name`, building it if needed.
+
+        `direction` sets the direction of the transition.
+        """
+        self.get_screen(name)
+        if direction is not None:
+            self.screen_manager.transition.direction = direction
+        self.screen_manager.current = name
+
     def get_widget_by_id(self, kv_id):
         """Lookup widget with kv id `kv_id`.
 
@@ -386,7 +1603,13 @@ class FPScanApp(App):
 
     def kill_running_cmd(self):
         """Kill any running subprocess.
+
+        Pending verify preparations are canceled as well.
         """
+        if self.verify_join is not None:
+            self.verify_join.cancel()
+            self.verify_join = None
+        self.arming_token = None
         if self.cmd_running is None:
             return
         Logger.debug("waeup.identifier: kill running subprocess...")
@@ -395,6 +1618,16 @@ class FPScanApp(App):
         Logger.debug("waeup.identifier: done.")
         self.cmd_running = None
 
+    def load_config(self):
+        """Load the config and take a snapshot of it.
+
+        The snapshot is renewed whenever config values change.
+        """
+        config = super(FPScanApp, self).load_config()
+        self.snapshot = get_snapshot(config)
+        config.add_callback(self.config_changed)
+        return config
+
     def build_config(self, config):
         for key, conf_dict in get_default_settings():
             config.setdefaults(key, conf_dict)
@@ -413,47 +1646,304 @@ class FPScanApp(App):
             "waeup.identifier: config change: {0}, {1}, {2}, {3}".format(
                 config, section, key, value))
 
+    def config_changed(self, section, key, value):
+        """A config value changed.
+
+        Called for changes made in settings, in code or by reloading
+        the config file. While reloading, changes are collected and
+        applied at once afterwards.
+        """
+        if self.config_reloading is not None:
+            self.config_reloading.append((section, key))
+            return
+        self.apply_config_changes([(section, key)])
+
+    def apply_config_changes(self, changes):
+        """Renew the config snapshot and apply `changes`.
+
+        `changes` is a list of tuples (<SECTION>, <KEY>).
+        """
+        self.snapshot = get_snapshot(self.config)
+        changes = set(changes)
+        if ('Server', 'wire_codec') in changes:
+            self.set_wire_codec(self.snapshot.wire_codec)
+        if changes & set([('Server', 'waeup_url'), ('Server', 'routes')]):
+            self.set_routes()
+        if any(section == 'Idle' for section, key in changes):
+            self.set_idle_mode()
+        if ('Students', 'roster_path') in changes:
+            self.set_roster()
+        if ('Diagnostics', 'profiling') in changes:
+            self.set_profiling(self.snapshot.profiling)
+
+    @mainthread
+    def config_file_changed(self, path):
+        """The config file at `path` changed on disk.
+
+        This is a callback function called from a separate thread. The
+        file is read again and changed values are applied.
+        """
+        self.config_reloading = []
+        try:
+            self.config.read(path)
+        except (configparser.Error, IOError) as err:
+            Logger.warning(
+                "waeup.identifier: cannot reload config: %s" % err)
+        finally:
+            changes, self.config_reloading = self.config_reloading, None
+        Logger.info(
+            "waeup.identifier: config reloaded, %s values changed" % (
+                len(changes)))
+        if changes:
+            self.apply_config_changes(changes)
+
+    @mainthread
+    def on_server_state(self, breaker, state):
+        """The state of the Kofa server circuit breaker changed.
+
+        This is a callback function which might be called from a
+        separate thread. `state` is one of the `CircuitBreaker` states.
+        While the circuit is open, the server is considered
+        unavailable.
+        """
+        Logger.info("waeup.identifier: server circuit %s" % state)
+        self.server_available = not any(
+            route.breaker.state == CircuitBreaker.OPEN
+            for route in self.router.routes)
+        if state == CircuitBreaker.CLOSED:
+            self.resend_spooled()
+
+    def set_routes(self):
+        """Set up the routing of students to servers from config.
+
+        An invalid routing table is logged and ignored. All students
+        are then served by the default server.
+        """
+        default = Route('', self.snapshot.waeup_url, self.circuit_breaker)
+        try:
+            routes = parse_routes(self.snapshot.routes)
+        except ValueError as err:
+            Logger.warning("waeup.identifier: %s" % err)
+            routes = []
+        self.router = Router(default, routes)
+        for route in self.router.routes:
+            for endpoint in route.endpoints:
+                if endpoint.breaker is not self.circuit_breaker:
+                    endpoint.breaker.add_listener(self.on_server_state)
+        Logger.info(
+            "waeup.identifier: routes set: %r" % self.router.routes)
+
+    def set_roster(self):
+        """Load the student roster from the configured file.
+
+        The file is read in background. Without roster, all student ids
+        matching `RE_STUDENT_ID` are accepted.
+        """
+        path = self.snapshot.roster_path
+        if not path:
+            self.roster = None
+            return
+        call_in_background(
+            self.read_roster, args=(path, ),
+            callback=functools.partial(self.roster_loaded, path))
+
+    def read_roster(self, path):
+        """Read the roster file in `path`.
+
+        Returns a `Roster` or `None` if the file cannot be read.
+        """
+        start = time.perf_counter()
+        try:
+            roster, skipped = read_roster_file(path, RE_STUDENT_ID)
+        except (IOError, UnicodeError) as err:
+            Logger.warning("waeup.identifier: cannot read roster: %s" % err)
+            return None
+        Logger.info(
+            "waeup.identifier: roster with %s ids (%s KB) loaded in "
+            "%.0f ms, %s invalid ids skipped" % (
+                len(roster), roster.nbytes // 1024,
+                (time.perf_counter() - start) * 1000, skipped))
+        return roster
+
+    @mainthread
+    def roster_loaded(self, path, roster):
+        """The roster from `path` was read.
+
+        This is a callback function called from a separate thread.
+        Rosters of outdated paths are dropped.
+        """
+        if path == self.snapshot.roster_path:
+            self.roster = roster
+
+    def get_breaker(self, student_id=None):
+        """Get the circuit breaker of the primary server of `student_id`.
+        """
+        return self.router.get_route(student_id).breaker
+
+    def get_probe_targets(self):
+        """Get tuples (<ENDPOINT>, <URL>) of all endpoints to probe.
+
+        Endpoints we have no credentials for are skipped.
+        """
+        return [
+            (endpoint, endpoint.get_url(
+                self.waeup_username, self.waeup_password))
+            for route in self.router.routes for endpoint in route.endpoints
+            if self.waeup_username or endpoint.has_credentials()]
+
+    @mainthread
+    def probes_done(self, prober):
+        """All endpoints were probed. Show their stats.
+
+        This is a callback function which might be called from a
+        separate thread.
+        """
+        lines = []
+        for route in self.router.routes:
+            for endpoint in route.endpoints:
+                stats = endpoint.get_stats()
+                if not stats['healthy']:
+                    state = stats['last_error'] or "down"
+                elif stats['latency'] is None:
+                    state = "not probed"
+                else:
+                    state = "%.0f ms" % (stats['latency'] * 1000)
+                lines.append("%s%s: %s" % (
+                    route.prefix and route.prefix + ' ', stats['name'],
+                    state))
+        self.endpoint_stats = '\n'.join(lines)
+
+    def read_with_failover(self, func, url, student_id):
+        """Call `func` with `url` and `student_id` to read data.
+
+        `func` is called like `webservice.get_templates` with
+        ``raise_unreachable=True``: it raises if the server cannot be
+        reached and returns anything else, including error messages
+        of servers that answered. Then we try the other available
+        endpoints of the route of `student_id`, fastest first. Failed
+        endpoints are marked unhealthy until the next successful
+        probe.
+
+        Might be called from any thread.
+        """
+        creds = (self.waeup_username, self.waeup_password)
+        endpoints = sorted(
+            self.router.get_route(student_id).get_read_endpoints(),
+            key=lambda x: x.get_url(*creds) != url)
+        result = "Error: no server available"
+        for endpoint in endpoints:
+            try:
+                return func(
+                    endpoint.get_url(*creds), student_id,
+                    breaker=endpoint.breaker, raise_unreachable=True)
+            except Exception as err:
+                result = get_error_message(err)
+            endpoint.record_failure(result)
+            Logger.warning(
+                "waeup.identifier: %s failed, failing over: %s" % (
+                    endpoint.get_name(), result))
+        return result
+
+    def fetch_templates(self, student_id):
+        """Get fingerprints of `student_id`.
+
+        The server is chosen when the call starts, so prefetches are
+        keyed by student id only and stay valid if the fastest read
+        endpoint changes meanwhile.
+
+        Might be called from any thread.
+        """
+        return self.read_with_failover(
+            get_templates, self.get_server_url(student_id), student_id)
+
+    def fetch_photo(self, url, student_id):
+        """Get the photo of `student_id` from server `url`.
+
+        Might be called from any thread.
+        """
+        return self.read_with_failover(get_photo, url, student_id)
+
+    @measure_blocking
     def on_stud_id_entered(self, instance):
         """A student id was entered.
         """
         entered_text = instance[0].text
-        prevent = RE_STUDENT_ID.match(entered_text) is None
+        message = None
+        if RE_STUDENT_ID.match(entered_text) is None:
+            message = "The entered student id is not valid"
+        elif self.roster is not None and entered_text not in self.roster:
+            message = "The entered student id is unknown"
+        prevent = message is not None
         self.prevent_scanning = prevent
         if entered_text and prevent:
-            popup = FPScanPopup(
-                title="Invalid Student Id",
-                message="The entered student id is not valid"
-                )
+            popup = FPScanPopup(title="Invalid Student Id", message=message)
             popup.open()
+        if entered_text != self.root.f_student_id:
+            self.enroll_session = None
         self.root.f_student_id = entered_text
         Logger.debug("waeup.identifier: stud_id changed: %s" % entered_text)
+        if prevent or self.mode != 'verify':
+            self.prefetcher.cancel()
+        else:
+            # we will need the stored fingerprint soon.
+            self.prefetcher.prefetch(entered_text)
+        if (not prevent and self.mode == 'scan' and self.is_continuous() and
+                self.cmd_running is None and self.arming_token is None):
+            # arm the scanner right away
+            self.prepare_scan()
+
+    def choose_student_id(self, student_id):
+        """A suggested `student_id` was chosen.
+        """
+        student_id_input = self.get_widget_by_id('student_id_input')
+        student_id_input.text = student_id
+        self.on_stud_id_entered((student_id_input, ))
 
+    @measure_blocking
     def on_mode(self, instance, value):
         """This should be called whenever `mode` changes.
         """
         Logger.debug(
             "waeup.identifier: mode change %r -> %r" % (self.old_mode, value))
-        stud_id_label = self.get_widget_by_id('label_stud_id')
         self.root.f_student_id = ''
+        if value in ("scan", "verify"):
+            self.get_screen('screen_scan')
+        stud_id_label = self.get_widget_by_id('label_stud_id')
+        photo = self.get_widget_by_id('image_student_photo')
+        if photo is not None:
+            photo.texture = None
         if value == "scan":
             self.root.btn_scan_text = 'Scan'
             self.root.prevent_scanning = True
             stud_id_label.text = (
                 "Student ID:\n[color=999]of student to register[/color]")
+            self.retry_warmup()
         elif value == "verify":
             self.root.btn_scan_text = 'Verify'
             self.root.prevent_scanning = True
             stud_id_label.text = (
                 "Student ID:\n[color=999]of student to verify[/color]")
+            self.retry_warmup()
         elif value == "creds":
             Logger.debug("waeup.identifier: enter creds mode")
         elif value == "main":
+            self.prefetcher.cancel()
+            self.enroll_session = None
             self.kill_running_cmd()
             self.scan_canceled = False
         self.old_mode = value
         if self.screen_manager.current != self.last_screen:
             self.last_screen = str(self.screen_manager.current)
 
+    def retry_warmup(self):
+        """Run failed warmup stages again.
+
+        Credentials or devices might be available now.
+        """
+        if self.warmup.running or not self.warmup.errors:
+            return
+        self.warmup.start(names=list(self.warmup.errors))
+
     def quit_app(self):
         """Quit application on user request.
 
@@ -473,45 +1963,192 @@ class FPScanApp(App):
         self.scan_canceled = True
         self.mode = "main"
 
+    @measure_blocking
     def prepare_scan(self):
         Logger.debug("waeup.identifier: preparing scan")
+        route = self.router.get_route(self.root.f_student_id)
+        if not route.is_available(write=self.mode != 'verify'):
+            FPScanPopup(
+                title="Server unavailable",
+                message=(
+                    "The Kofa server is currently not reachable.\n"
+                    "Please retry later."),
+            ).open()
+            return
         if self.mode == 'verify':
-            self.download_fingerprint(get_fpm_path())
+            self.start_verify()
         else:
-            self.start_scan()
+            self.start_enrollment()
 
-    def start_scan(self):
-        """Start a fingerprint scan.
+    def get_enroll_fingers(self):
+        """Get the list of finger numbers to capture per student.
         """
-        Logger.debug("waeup.identifier: start scan")
-        path = self.config.get('fpscan', 'fpscan_path')
-        Logger.debug("waeup.identifier: `fpscan` at %s" % path)
-        if not os.path.isfile(path):
+        num = self.snapshot.enroll_fingers
+        return list(range(1, min(max(num, 1), 10) + 1))
+
+    def is_continuous(self):
+        """Tell whether continuous enrollment is enabled.
+
+        In continuous mode the next student can be enrolled while the
+        fingerprints of the last one are still uploaded. Upload results
+        are shown in a status list instead of popups.
+        """
+        return self.snapshot.continuous
+
+    def add_enroll_result(self, student_id, message):
+        """Add a line to the status list shown in continuous mode.
+        """
+        self.enroll_results.appendleft(
+            "%s  %s: %s" % (time.strftime('%H:%M:%S'), student_id, message))
+        self.enroll_status = "\n".join(self.enroll_results)
+
+    def refresh_activity(self, dt=None):
+        """Show the current activity log.
+
+        Triggered at most once per frame, however many entries were
+        added meanwhile.
+        """
+        self.activity_data = self.activity.get_rows()
+
+    def update_throughput(self):
+        """Update and log the enrollment throughput.
+        """
+        per_minute = self.enroll_stats.per_minute()
+        self.throughput = "%.1f students/min (%s uploading)" % (
+            per_minute, self.uploads_running)
+        Logger.info(
+            "waeup.identifier: enrollment throughput: "
+            "%.2f students per minute" % per_minute)
+
+    def start_enrollment(self):
+        """Start capturing the fingers of the current student.
+
+        All fingers are captured in a row and then uploaded at once. An
+        already running session for the same student is continued.
+        """
+        student_id = self.root.f_student_id
+        session = self.enroll_session
+        if session is None or session.student_id != student_id:
+            self.enroll_session = EnrollmentSession(
+                student_id, self.get_enroll_fingers())
+        self.start_scan(scanners=self.detected_scanners or None)
+
+    def start_verify(self):
+        """Start a verification.
+
+        Downloading the stored fingerprint of the current student and
+        detecting scanner devices is done concurrently. The comparing
+        scan is started in `verify_prepared` as soon as both jobs are
+        finished.
+
+        `fpscan` loads the stored fingerprint on start, so the scanner
+        cannot be armed before the download finished.
+        """
+        Logger.debug("waeup.identifier: start verify")
+        path = self.snapshot.fpscan_path
+        if not get_backend().exists(path):
             Logger.debug("waeup.identifier: fpscan path is invalid.")
             PopupInvalidFPScanPath().open()
             return
-        scanners = detect_scanners(path)
-        Logger.debug(
-            "waeup.identifier: detected scanners. result %s" % scanners)
-        if not scanners:
-            Logger.debug("waeup.identifier: no scanner detected. Aborted.")
-            PopupNoScanDevice().open()
+        self.prevent_scanning = True
+        self._verify_button_old_text = self.root.btn_scan_text
+        self.root.btn_scan_text = "Preparing..."
+        join = ResultJoin(['template', 'scanners'], self.verify_prepared)
+        self.verify_join = join
+        self.download_fingerprint(
+            get_fpm_path(), callback=join.result_setter('template'))
+        call_in_background(
+            callable=find_scanners, args=(path, ),
+            callback=join.result_setter('scanners'))
+
+    @mainthread
+    def verify_prepared(self, join):
+        """Fingerprint download and scanner detection finished.
+
+        This is a callback function called from a separate thread.
+        `join` is the `ResultJoin` that collected the results.
+        """
+        self.idle_mode.poke()
+        if join is not self.verify_join:
+            # canceled or outdated
+            return
+        Logger.debug("waeup.identifier: verify prepared")
+        self.verify_join = None
+        self.root.btn_scan_text = self._verify_button_old_text
+        self.prevent_scanning = False
+        if not self.store_template(join.results['template']):
             return
-        mode_opt = '-s'
+        self.start_scan(scanners=join.results['scanners'])
+
+    @measure_blocking
+    def start_scan(self, scanners=None):
+        """Start a fingerprint scan.
+
+        If a list of `scanners` is given, we do not detect scanner
+        devices again.
+
+        Checking the `fpscan` path and detecting scanners is done in
+        background. The scan starts in `scanner_armed`.
+        """
+        Logger.debug("waeup.identifier: start scan")
+        path = self.snapshot.fpscan_path
+        Logger.debug("waeup.identifier: `fpscan` at %s" % path)
+        params = ['-s']
+        prompt = "Please touch scanner..."
+        capture = None
         if self.mode == 'verify':
-            mode_opt = '-c'
-        self.cmd_running = FPScanCommand(
-            path=path, params=[mode_opt], callback=self.scan_finished)
+            params = ['-c']
+        elif self.enroll_session is not None:
+            self.capture_finger = self.enroll_session.next_finger()
+            capture = self.enroll_session.get_buffer(self.capture_finger)
+            prompt = "Please touch scanner (finger %s of %s)..." % (
+                self.capture_finger, len(self.enroll_session.fingers))
+        self.arming_token = token = object()
         self._scan_button_old_text = self.root.btn_scan_text
-        self.root.btn_scan_text = "Please touch scanner..."
+        self.root.btn_scan_text = "Arming scanner..."
         self.prevent_scanning = True
+        call_in_background(
+            arm_scanner, args=(path, params, capture, scanners),
+            kwargs=dict(callback=self.scan_finished),
+            callback=functools.partial(self.scanner_armed, token, prompt))
+
+    @mainthread
+    @measure_blocking
+    def scanner_armed(self, token, prompt, result):
+        """The scan command was prepared in background.
+
+        `result` is the result of `arm_scanner`. If the scan was
+        canceled meanwhile, `token` is outdated and we do nothing.
+        """
+        self.idle_mode.poke()
+        if token is not self.arming_token:
+            return
+        self.arming_token = None
+        error, scanners, cmd = result
+        Logger.debug(
+            "waeup.identifier: detected scanners. result %s" % scanners)
+        if error is not None:
+            self.root.btn_scan_text = self._scan_button_old_text
+            self.prevent_scanning = False
+            if error == 'invalid-path':
+                Logger.debug("waeup.identifier: fpscan path is invalid.")
+                PopupInvalidFPScanPath().open()
+            else:
+                Logger.debug(
+                    "waeup.identifier: no scanner detected. Aborted.")
+                PopupNoScanDevice().open()
+            return
+        self.detected_scanners = scanners
+        self.cmd_running = cmd
+        self.root.btn_scan_text = prompt
         Logger.debug(
             (
                 'waeup.identifier: initialized scan, awaiting finger '
-                'touch (mode %s)' % mode_opt))
+                'touch (mode %s)' % cmd.cmd[1]))
         self.cmd_running.start()
 
     @mainthread
+    @measure_blocking
     def scan_finished(self, scan_command):
         """A scan has been finished.
 
@@ -520,13 +2157,28 @@ class FPScanApp(App):
 
         `scan_command` is the calling `FPScanCommand`.
         """
+        self.idle_mode.poke()
         Logger.info("waeup.identifier: scan finished.")
+        if self.first_scan_time is None:
+            self.first_scan_time = time.time() - self.started
+            Logger.info(
+                "waeup.identifier: time to first scan: %.2f secs" % (
+                    self.first_scan_time))
         self.cmd_running = None
         if self.scan_canceled:
             self.scan_canceled = False
             return
         self.root.btn_scan_text = self._scan_button_old_text
         self.prevent_scanning = False
+        capture = scan_command.capture
+        if capture is not None:
+            if not capture.length:
+                # Scan failed
+                Logger.warn("waeup.identifier: no fingerprint captured")
+                PopupScanFailed().open()
+                return
+            self.capture_finished(capture)
+            return
         path = get_fpm_path()
         if not os.path.isfile(path):
             # Scan failed
@@ -536,64 +2188,218 @@ class FPScanApp(App):
         if self.mode == 'verify':
             self.handle_verify(scan_command.get_result())
             return
-        self.upload_fingerprint(path)
+        self.capture_finished(path)
+
+    def capture_finished(self, capture):
+        """A finger of the current enrollment session was captured.
 
-    def get_server_url(self):
+        `capture` is the `TemplateBuffer` holding the fingerprint (or
+        the path to an `.fpm` file). While the capture is validated in
+        background, the scanner is armed again for the next finger.
+        When all fingers are done, we upload them.
+        """
+        session = self.enroll_session
+        session.add_capture(self.capture_finger, capture)
+        if session.next_finger() is not None:
+            self.start_scan(scanners=self.detected_scanners)
+            return
+        self.prevent_scanning = True
+        session.when_validated(self.enrollment_validated)
+
+    @mainthread
+    def enrollment_validated(self, session):
+        """All captures of `session` were validated.
+
+        This is a callback function which might be called from a
+        separate thread. Invalid captures are taken again, otherwise
+        all fingerprints are uploaded.
+        """
+        self.idle_mode.poke()
+        if session is not self.enroll_session:
+            # canceled
+            return
+        self.prevent_scanning = False
+        if session.next_finger() is not None:
+            Logger.warning(
+                "waeup.identifier: invalid captures: %r" % session.errors)
+            PopupScanFailed().open()
+            return
+        self.upload_fingerprints(session)
+
+    def get_server_url(self, student_id=None, write=False):
         """Create the URL to communicate with the Kofa server.
+
+        If `student_id` is given, we get the URL of the server
+        responsible for this student. Otherwise the default server.
+        Reads go to the fastest available endpoint, writes to the
+        primary.
         """
-        netloc = self.config.get('Server', 'waeup_url')
-        return get_url(netloc, self.waeup_username, self.waeup_password)
+        return self.router.get_route(student_id).get_url(
+            self.waeup_username, self.waeup_password, write=write)
 
-    def upload_fingerprint(self, path):
+    def upload_fingerprints(self, session):
         """Do the actual upload.
 
-        `path` is the path to the `.fpm` file to be uploaded.
+        `session` is the `EnrollmentSession` whose fingerprints should
+        be uploaded. All fingerprints are sent in a single request.
+
+        In continuous mode the upload runs while the next student is
+        enrolled.
         """
-        student_id = self.root.f_student_id
         Logger.info(
-            "waeup.identifier: uploading fingerprint for '%s'" % student_id)
+            "waeup.identifier: uploading fingerprints %s for '%s'" % (
+                sorted(session.fingerprints), session.student_id))
+        self.uploads_running += 1
+        self.prevent_scanning = True
+        if self.is_continuous():
+            # ready for next student
+            self.enroll_session = None
+            self.root.f_student_id = ''
+            self.add_enroll_result(session.student_id, "uploading")
+            self.update_throughput()
         call_in_background(
-            callable=store_fingerprint,
-            args=(self.get_server_url(), student_id, 1, path),
-            callback=self.upload_finished)
+            callable=self.store_enrollment, args=(session, ),
+            callback=functools.partial(self.upload_finished, session))
+
+    def store_enrollment(self, session):
+        """Upload the fingerprints of enrollment `session`.
+
+        Fingerprints spooled for the same student before are dropped,
+        as they are outdated. If the server cannot be reached, the
+        fingerprints are spooled for a later upload (see
+        `resend_spooled`). Returns ``True`` or an error message, like
+        `webservice.store_fingerprints`.
+
+        Runs in background.
+        """
+        student_id = session.student_id
+        discard_spooled(student_id)
+        try:
+            return store_fingerprints(
+                self.get_server_url(student_id, write=True), student_id,
+                session.fingerprints, breaker=self.get_breaker(student_id),
+                raise_unreachable=True)
+        except Exception as err:
+            Logger.info(
+                "waeup.identifier: captures saved: %s" % session.save())
+            return get_error_message(err)
 
     @mainthread
-    def upload_finished(self, upload_result):
-        """Callback for fingerprint file upload.
+    def upload_finished(self, session, upload_result):
+        """Callback for fingerprint upload of enrollment `session`.
         """
+        self.idle_mode.poke()
         Logger.info(
             "waeup.identifier: fingerprint upload finished: %r" %
             upload_result)
+        self.uploads_running -= 1
+        if session is self.enroll_session:
+            self.enroll_session = None
+        self.activity.add(
+            'enroll', session.student_id,
+            "ok" if upload_result is True else upload_result,
+            ok=upload_result is True)
+        if upload_result is True:
+            self.enroll_stats.record(session.started)
+            self.resend_spooled()
+        self.update_throughput()
+        if self.is_continuous():
+            self.add_enroll_result(
+                session.student_id,
+                "ok" if upload_result is True else upload_result)
+            return
+        self.prevent_scanning = False
         if upload_result is not True:
             # upload failed
-            FPScanPopup(
-                title="Data upload failed",
-                message=(
-                    "Fingerprint upload to server failed.\n"
-                    "Error message:\n%s" % upload_result),
-            ).open()
+            message = (
+                "Fingerprint upload to server failed.\n"
+                "Error message:\n%s" % upload_result)
+            if session.spool_path is not None:
+                message += (
+                    "\nFingerprints were saved and will be uploaded later.")
+            FPScanPopup(title="Data upload failed", message=message).open()
             return
         # upload succeeded
         PopupUploadSuccessful().open()
-        screen_mgr = self.get_screen_manager()
-        screen_mgr.transition.direction = "right"
-        screen_mgr.current = "screen_main"
+        self.show_screen("screen_main", "right")
         self.mode = 'main'
 
-    def download_fingerprint(self, path):
+    def resend_spooled(self):
+        """Upload fingerprints of failed enrollments in background.
+
+        Called whenever the server seems to be reachable again.
+        Returns the upload thread or `None` if there is nothing to do.
+        """
+        if self.spool_running or not get_spooled():
+            return None
+        self.spool_running = True
+
+        def upload(student_id, fingerprints):
+            return store_fingerprints(
+                self.get_server_url(student_id, write=True), student_id,
+                fingerprints, breaker=self.get_breaker(student_id),
+                raise_unreachable=True)
+        return call_in_background(
+            upload_spooled, args=(upload, ), callback=self.spooled_uploaded)
+
+    @mainthread
+    def spooled_uploaded(self, result):
+        """Fingerprints of failed enrollments were uploaded again.
+
+        This is a callback function called from a separate thread.
+        `result` is the result of `upload_spooled`.
+        """
+        self.spool_running = False
+        uploaded, failed, rejected = result
+        for student_id in uploaded:
+            self.activity.add('resend', student_id, "ok")
+        for student_id, error in sorted(rejected.items()):
+            self.activity.add(
+                'resend', student_id, "rejected: %s" % error, ok=False)
+        if rejected:
+            Logger.warning(
+                "waeup.identifier: %s enrollments rejected, moved to %s" % (
+                    len(rejected), get_rejected_dir()))
+        if failed:
+            # no rows in the activity list, we will try again anyway
+            Logger.warning(
+                "waeup.identifier: %s enrollments still waiting for "
+                "upload in %s" % (len(failed), get_spool_dir()))
+
+    def download_fingerprint(self, path, callback=None):
+        """Download the fingerprint of the current student.
+
+        `callback` is called with the download result. By default
+        this is `download_finished`.
+        """
         student_id = self.root.f_student_id
         Logger.info(
             "waeup.identifier: downloading fingerprint of '%s'" % student_id)
-        call_in_background(
-            callable=get_fingerprints,
-            args=(self.get_server_url(), student_id),
-            callback=self.download_finished)
+        self.prefetcher.fetch(
+            (student_id, ), callback=callback or self.download_finished)
+        Logger.info(
+            "waeup.identifier: prefetch stats: %(hits)s hits, "
+            "%(misses)s misses, hit rate %(hit_rate).2f, "
+            "%(saved_time).3f secs saved" % self.prefetcher.get_stats())
 
     @mainthread
     def download_finished(self, download_result):
+        self.idle_mode.poke()
         Logger.debug(
             "waeup.identifier: download finished. Result: %r" % (
                 download_result))
+        if not self.store_template(download_result):
+            return
+        if self.mode == 'verify':
+            self.start_scan()
+
+    def store_template(self, download_result):
+        """Store the fingerprint from `download_result` locally.
+
+        `download_result` is the result of a `get_templates` call.
+        Returns `True` if the fingerprint could be stored. Otherwise
+        the user is informed by a popup and we return `False`.
+        """
         if not isinstance(download_result, dict):
             # download failed: connection problem
             FPScanPopup(
@@ -602,23 +2408,31 @@ class FPScanApp(App):
                     "Could not get comparison data from server.\n"
                     "Error message:\n%s" % download_result),
                 ).open()
-            return
+            return False
         fingerprint = download_result.get('fingerprints', {}).get('1', '')
         if not fingerprint:
             FPScanPopup(
                 title="No fingerprints available",
                 message="For this student there are no fingerprints stored."
                 ).open()
-            return
+            return False
         path = get_fpm_path()
         with open(path, 'wb') as fd:
             fd.write(fingerprint.data)
-        if self.mode == 'verify':
-            self.start_scan()
+        self.downloaded_photo = None
+        if 'img' in download_result:
+            # the server sent the photo along, keep it for `handle_verify`
+            self.downloaded_photo = (
+                self.root.f_student_id, extract_photo(download_result))
+        return True
 
     def handle_verify(self, result):
         Logger.debug(
             "waeup.identifier: verification finished (%s)" % result)
+        self.activity.add(
+            'verify', self.root.f_student_id,
+            "match" if result == 'ok' else "FAILED (%s)" % result,
+            ok=result == 'ok')
         if result == 'ok':
             FPScanPopup(
                 title="Verification succeeded",
@@ -627,4 +2441,22 @@ class FPScanApp(App):
             FPScanPopup(
                 title="Verification failed",
                 message="Verification FAILED").open()
-        return
+        student_id, photo = self.root.f_student_id, None
+        if self.downloaded_photo and self.downloaded_photo[0] == student_id:
+            photo = self.downloaded_photo[1]
+        self.photo_loader.load(
+            self.get_server_url(student_id), student_id, self.show_photo,
+            photo=photo)
+
+    def show_photo(self, student_id, texture):
+        """Show `texture` as photo of student `student_id`.
+
+        This is a callback called by the photo loader in main thread.
+        """
+        Logger.debug(
+            "waeup.identifier: photo stats: %(decode_count)s decoded, "
+            "avg. decode time %(avg_decode_time).3f secs, "
+            "cache hit rate %(hit_rate).2f" % self.photo_loader.get_stats())
+        if student_id != self.root.f_student_id:
+            return  # outdated
+        self.get_widget_by_id('image_student_photo').texture = texture
@@ -0,0 +1,260 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Scanner backends.
+
+All access to fingerprint scanners goes through `fpscan` invocations
+like ``fpscan -s -o data.fpm``. A backend decides how such an
+invocation is executed:
+
+* `SubprocessBackend` runs a real `fpscan` binary. The default.
+
+* `SimulatedBackend` simulates `fpscan` in-process, with configurable
+  devices, latencies and outcomes. Useful for tests, benchmarks and
+  large-scale simulations, as no interpreter or binary is spawned.
+
+Backends create process-like objects (see `SimulatedProcess`) that
+behave like `subprocess.Popen` instances as far as we need it.
+"""
+import itertools
+import os
+import re
+import subprocess
+import threading
+
+
+#: The set of chars allowed in filenames we handle.
+#: Last char must not be slash.
+VALID_FILENAME = re.compile(r'^[a-zA-Z0-9/\._\-]+$')
+
+
+def check_path(path):
+    """Check a given path.
+
+    `path` must exist, be valid, and be executable. The returned path
+    will be a 'normalized' with illegal chars stripped.
+
+    Illegal chars are considered all except ``[a-zA-Z0-9_.-]`` as
+    written in the `VALID_FILENAME` regular expression.
+
+    If the path does not exist, contains illegal chars, or is not
+    executable, a `ValueError` is raised.
+    """
+    if path is None:
+        raise ValueError("Path must be a string, not None.")
+    path = os.path.abspath(path)
+    if not VALID_FILENAME.match(path):
+        raise ValueError("Path contains illegal chars: %s" % path)
+    if not (os.path.isfile(path) and os.access(path, os.X_OK)):
+        raise ValueError("Not a valid executable path: %s" % path)
+    return path
+
+
+class SubprocessBackend(object):
+    """Run a real `fpscan` binary in a subprocess.
+    """
+    name = 'subprocess'
+
+    def exists(self, path):
+        """Tell whether there is an `fpscan` at `path`.
+        """
+        return path is not None and os.path.isfile(path)
+
+    def check(self, path):
+        """Check `path` and get it normalized.
+
+        Raises `ValueError` if `path` is no valid executable. See
+        `check_path`.
+        """
+        return check_path(path)
+
+    def popen(self, cmd, pass_fds=()):
+        """Start `cmd`, a list with `fpscan` path and parameters.
+        """
+        return subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            pass_fds=pass_fds)
+
+
+#: Device descriptions printed by simulated `fpscan` detections.
+SIMULATED_DEVICES = (
+    "Digital Persona U.are.U 4000/4000B/4500\n  2 0 1 0 1 384 290", )
+
+
+class SimulatedProcess(object):
+    """A simulated `fpscan` run.
+
+    Parameters are understood like the real `fpscan` (and the
+    `fake_fpscan` script) does. The run happens in `communicate()`,
+    which waits `latency` seconds unless `kill()` is called.
+    """
+    def __init__(self, backend, params, pass_fds=()):
+        self.backend = backend
+        self.params = list(params)
+        self.returncode = None
+        self._killed = threading.Event()
+        # like a child process we get our own copies of passed fds
+        self._fds = dict((fd, os.dup(fd)) for fd in pass_fds)
+
+    def _get_param(self, name, default=None):
+        if name not in self.params:
+            return default
+        return self.params[self.params.index(name) + 1]
+
+    def _write_template(self, path):
+        data = self.backend.make_template()
+        if path.startswith('/dev/fd/') and (
+                int(path[8:]) in self._fds):
+            fd = self._fds.pop(int(path[8:]))
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            return
+        with open(path, 'wb') as fd:
+            fd.write(data)
+
+    def _run(self):
+        # returns (<RETURNCODE>, <STDOUT>, <STDERR>)
+        backend = self.backend
+        scan, compare = '-s' in self.params, '-c' in self.params
+        if not (scan or compare):
+            if not backend.devices:
+                return 0, '0\n', ''
+            return 0, ''.join('%s\n' % x for x in backend.devices), ''
+        if scan and compare:
+            return 1, "Usage of `-s' and `-c' is mutual exclusive.\n", ''
+        device = int(self._get_param('-d', '0'))
+        if device >= len(backend.devices):
+            return 1, '', "Invalid device number: %s.\n" % device
+        if scan:
+            outcome = backend.next_outcome('scan')
+            if outcome != 'ok':
+                return 1, "fail\n", ''
+            self._write_template(self._get_param('-o', 'data.fpm'))
+            return 0, "ok\n", ''
+        infile = self._get_param('-i', 'data.fpm')
+        if not os.path.exists(infile):
+            return 1, '', "Could not load data from file: %s.\n" % infile
+        outcome = backend.next_outcome('compare')
+        if outcome == 'fail':
+            return 1, "error: unknown reason\n", ''
+        return 0, "%s\n" % outcome, ''
+
+    def communicate(self):
+        """Run the simulation. Returns stdout and stderr data as bytes.
+        """
+        action = 'detect'
+        if '-s' in self.params:
+            action = 'scan'
+        elif '-c' in self.params:
+            action = 'compare'
+        try:
+            if self._killed.wait(self.backend.latency.get(action, 0.0)):
+                self.returncode = -9
+                return b'', b''
+            returncode, out, err = self._run()
+        finally:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = dict()
+        self.returncode = returncode
+        self.backend.record_run(action)
+        return out.encode('utf-8'), err.encode('utf-8')
+
+    def kill(self):
+        self._killed.set()
+
+
+class SimulatedBackend(object):
+    """Simulate `fpscan` in-process.
+
+    `devices` is the list of device descriptions detected. Without
+    devices, scans fail like with no scanner attached.
+
+    `latency` is a dict mapping the actions ``detect``, ``scan`` and
+    ``compare`` to the seconds they take.
+
+    `outcomes` is a dict mapping ``scan`` and ``compare`` to lists of
+    results, which are returned in turn. Scans can be ``ok`` or
+    ``fail``, comparisons ``ok``, ``no-match`` or ``fail``.
+
+    Simulated templates look like ``FP1<NUMBER>`` padded with zero
+    bytes to `template_size` bytes.
+    """
+    name = 'simulated'
+
+    def __init__(self, devices=SIMULATED_DEVICES, latency=None,
+                 outcomes=None, template_size=0):
+        self.devices = list(devices)
+        self.latency = dict(latency or {})
+        self.template_size = template_size
+        self.runs = dict(detect=0, scan=0, compare=0)
+        outcomes = dict(outcomes or {})
+        self._outcomes = dict(
+            (action, itertools.cycle(outcomes.get(action, ['ok'])))
+            for action in ('scan', 'compare'))
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_outcome(self, action):
+        """Get the next outcome of ``scan`` or ``compare`` `action`.
+        """
+        with self._lock:
+            return next(self._outcomes[action])
+
+    def record_run(self, action):
+        with self._lock:
+            self.runs[action] += 1
+
+    def make_template(self):
+        """Get the data of a new simulated template.
+        """
+        data = ('FP1%s' % next(self._counter)).encode('ascii')
+        return data.ljust(self.template_size, b'\0')
+
+    def exists(self, path):
+        return bool(path)
+
+    def check(self, path):
+        if not path:
+            raise ValueError("Path must be a string, not None.")
+        return path
+
+    def popen(self, cmd, pass_fds=()):
+        return SimulatedProcess(self, cmd[1:], pass_fds)
+
+
+#: The backend used if none is given explicitly.
+#: Change with `set_backend()`.
+default_backend = SubprocessBackend()
+
+
+def get_backend():
+    """Get the backend currently used by default.
+    """
+    return default_backend
+
+
+def set_backend(backend):
+    """Set the backend used by default for all `fpscan` invocations.
+
+    Returns the backend used before.
+    """
+    global default_backend
+    old, default_backend = default_backend, backend
+    return old
@@ -15,14 +15,25 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import collections
+import configparser
 import json
 import os
 import pkg_resources
+import threading
 from kivy.config import ConfigParser
+from kivy.logger import Logger
+try:
+    import inotify_simple
+except ImportError:                      # pragma: no cover
+    inotify_simple = None
 
 
 #: A list of valid configuration keys.
-CONF_KEYS = ['fpscan_path', 'waeup_url']
+CONF_KEYS = [
+    'fpscan_path', 'waeup_url', 'enroll_fingers', 'wire_codec',
+    'continuous', 'profiling', 'routes', 'idle_timeout', 'idle_fps',
+    'roster_path']
 
 CONF_SETTINGS = [
     {
@@ -37,11 +48,29 @@ CONF_SETTINGS = [
     {
         "type": "string",
         "title": "Server URL",
-        "desc": "URL of WAeUP server to connect to",
+        "desc": "URL of WAeUP server. Add read replicas like '|https://host2'",
         "section": "Server",
         "key": "waeup_url",
         "default": "https://localhost:8080",
     },
+    {
+        "type": "string",
+        "title": "Routes",
+        "desc": ("Servers by student id prefix, "
+                 "like 'AB=https://host1 CD=https://user:pw@host2'"),
+        "section": "Server",
+        "key": "routes",
+        "default": "",
+    },
+    {
+        "type": "options",
+        "title": "Wire format",
+        "desc": "Data format to talk to server. 'binary' needs support",
+        "section": "Server",
+        "key": "wire_codec",
+        "options": ["xmlrpc", "binary"],
+        "default": "xmlrpc",
+    },
     {
         "type": "title",
         "title": "fpscan Utility",
@@ -54,6 +83,72 @@ CONF_SETTINGS = [
         "key": "fpscan_path",
         "default": "<unset>",
     },
+    {
+        "type": "title",
+        "title": "Enrollment",
+    },
+    {
+        "type": "numeric",
+        "title": "Fingers per student",
+        "desc": "Number of fingers (1-10) to scan and upload per student",
+        "section": "Enrollment",
+        "key": "enroll_fingers",
+        "default": "1",
+    },
+    {
+        "type": "bool",
+        "title": "Continuous enrollment",
+        "desc": "Enroll next student while uploads are still running",
+        "section": "Enrollment",
+        "key": "continuous",
+        "default": "0",
+    },
+    {
+        "type": "title",
+        "title": "Students",
+    },
+    {
+        "type": "path",
+        "title": "Student roster",
+        "desc": "File listing known student ids, one per line. "
+                "Other ids are rejected",
+        "section": "Students",
+        "key": "roster_path",
+        "default": "",
+    },
+    {
+        "type": "title",
+        "title": "Idle Mode",
+    },
+    {
+        "type": "numeric",
+        "title": "Idle after",
+        "desc": "Seconds without activity before lowering the frame rate. "
+                "0 disables idle mode",
+        "section": "Idle",
+        "key": "idle_timeout",
+        "default": "120",
+    },
+    {
+        "type": "numeric",
+        "title": "Idle frame rate",
+        "desc": "Frames per second while idle",
+        "section": "Idle",
+        "key": "idle_fps",
+        "default": "2",
+    },
+    {
+        "type": "title",
+        "title": "Diagnostics",
+    },
+    {
+        "type": "bool",
+        "title": "Sampling profiler",
+        "desc": "Write profiles to ~/.waeupident-profiles periodically",
+        "section": "Diagnostics",
+        "key": "profiling",
+        "default": "0",
+    },
 ]
 
 
@@ -93,6 +188,10 @@ def get_conffile_location():
     return home_loc
 
 
+#: Binaries found by `find_fpscan_binary`, by $PATH searched.
+_fpscan_binaries = dict()
+
+
 def find_fpscan_binary(path=None):
     """Find the path to an fpscan binary.
 
@@ -100,13 +199,20 @@ def find_fpscan_binary(path=None):
     ``fpscan``.
 
     If `path` is given, we consider it first.
+
+    Binaries found are remembered. As long as a binary found before
+    still exists, $PATH is not searched again.
     """
     if path and os.path.exists(path):
         return path
-    paths = os.environ.get('PATH', '').split(':')
-    for path in paths:
+    env_path = os.environ.get('PATH', '')
+    cached = _fpscan_binaries.get(env_path)
+    if cached is not None and os.path.exists(cached):
+        return cached
+    for path in env_path.split(':'):
         bin_path = os.path.join(path, 'fpscan')
         if os.path.exists(bin_path):
+            _fpscan_binaries[env_path] = bin_path
             return bin_path
     return None
 
@@ -125,6 +231,14 @@ def get_config(path=None):
     conf['DEFAULT'] = {
         'waeup_url': 'localhost:8080',
         'save_passwd': '0',
+        'enroll_fingers': '1',
+        'wire_codec': 'xmlrpc',
+        'continuous': '0',
+        'profiling': '0',
+        'routes': '',
+        'idle_timeout': '120',
+        'idle_fps': '2',
+        'roster_path': '',
         }
     if fpscan_path is not None:
         conf['DEFAULT'].update(fpscan_path=fpscan_path)
@@ -134,3 +248,139 @@ def get_config(path=None):
         conffile_location = get_conffile_location()
     conf.read(conffile_location)
     return conf
+
+
+def _to_bool(value):
+    return str(value).lower() in ('1', 'yes', 'true', 'on')
+
+
+#: Settings in a `ConfigSnapshot`: tuples (<SECTION>, <KEY>, <TYPE>).
+SNAPSHOT_FIELDS = [
+    ('fpscan', 'fpscan_path', str),
+    ('Server', 'waeup_url', str),
+    ('Server', 'routes', str),
+    ('Server', 'wire_codec', str),
+    ('Enrollment', 'enroll_fingers', int),
+    ('Enrollment', 'continuous', _to_bool),
+    ('Diagnostics', 'profiling', _to_bool),
+    ('Idle', 'idle_timeout', float),
+    ('Idle', 'idle_fps', float),
+    ('Students', 'roster_path', str),
+    ]
+
+
+#: An immutable copy of the settings, safe to share between threads.
+ConfigSnapshot = collections.namedtuple(
+    'ConfigSnapshot', [key for section, key, convert in SNAPSHOT_FIELDS])
+
+
+def get_snapshot(config, settings=CONF_SETTINGS):
+    """Get a `ConfigSnapshot` of the values in `config`.
+
+    Values are converted to their types. Missing or invalid values
+    are replaced by their defaults from `settings`.
+    """
+    defaults = dict(
+        (setting['key'], setting['default']) for setting in settings
+        if 'default' in setting)
+    values = []
+    for section, key, convert in SNAPSHOT_FIELDS:
+        try:
+            value = convert(config.get(section, key))
+        except (ValueError, configparser.Error) as err:
+            Logger.warning(
+                "waeup.identifier: invalid setting %s/%s: %s" % (
+                    section, key, err))
+            value = convert(defaults[key])
+        values.append(value)
+    return ConfigSnapshot(*values)
+
+
+class ConfigWatcher(object):
+    """Watch a config file for changes.
+
+    `callback` is called in a separate thread with `path` as argument
+    whenever the file at `path` was written, replaced or created. This
+    also catches files replaced by renaming, as done by config
+    management tools.
+
+    Changes are noticed via inotify if `inotify_simple` is installed
+    and otherwise by checking `path` every `interval` seconds.
+    """
+    def __init__(self, path, callback, interval=2.0):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self._state = self.get_state()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get_state(self):
+        """Get a tuple telling the file identity, mtime and size.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def check(self):
+        """Call `callback` if the file changed since the last check.
+
+        Returns whether it changed. Removed files are not reported.
+        """
+        state = self.get_state()
+        changed = state is not None and state != self._state
+        self._state = state
+        if changed:
+            self.callback(self.path)
+        return changed
+
+    def get_inotify(self):
+        # get an inotify instance watching the config dir, if possible
+        if inotify_simple is None:
+            return None
+        flags = inotify_simple.flags
+        inotify = inotify_simple.INotify()
+        try:
+            inotify.add_watch(
+                os.path.dirname(os.path.abspath(self.path)),
+                flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+        except OSError as err:
+            Logger.warning(
+                "waeup.identifier: cannot watch config: %s" % err)
+            inotify.close()
+            return None
+        return inotify
+
+    def run(self):
+        inotify = self.get_inotify()
+        name = os.path.basename(self.path)
+        try:
+            while not self._stop.is_set():
+                if inotify is None:
+                    self._stop.wait(self.interval)
+                    self.check()
+                    continue
+                events = inotify.read(timeout=int(self.interval * 1000))
+                if any(event.name == name for event in events):
+                    self.check()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def start(self):
+        """Start watching in a separate thread.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Stop watching.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,350 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""A single-file store for fingerprint templates.
+
+A gallery file holds the fingerprint templates (`.fpm` data) of many
+students. It consists of
+
+* a fixed size header,
+
+* a sorted index with one fixed size entry per (student id, finger
+  number) pair,
+
+* the template data of all indexed entries, stored contiguously, and
+
+* a tail of appended records, each carrying its own small header.
+
+New templates are appended to the tail and can therefore be added
+without rewriting the whole file. Readers look up the tail first, so
+appended records override indexed ones. :func:`compact_gallery` merges
+the tail into the sorted index and drops overridden records.
+
+Gallery files are read via `mmap`. Lookups return `memoryview`
+instances pointing into the mapped file, i.e. no data is copied and
+caching is left to the OS page cache.
+"""
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+
+
+#: The magic bytes every gallery file starts with.
+MAGIC = b'WFPG'
+
+#: The gallery format version we write and understand.
+VERSION = 1
+
+#: Header: magic, version, flags, number of index entries, end of data.
+HEADER = struct.Struct('>4sHHQQ')
+
+#: Index entry: student id, finger number, offset and length of data.
+INDEX_ENTRY = struct.Struct('>16sHxxQI')
+
+#: Tail record header: student id, finger number, length of data.
+TAIL_RECORD = struct.Struct('>16sHxxI')
+
+#: Number of leading bytes of an index entry used as sort key.
+KEY_SIZE = 18
+
+#: Maximum length of student ids (in bytes).
+MAX_ID_LEN = 16
+
+
+def make_key(student_id, finger_num):
+    """Get the binary sort key for `student_id` and `finger_num`.
+
+    The key is the student id, padded with zero bytes to
+    `MAX_ID_LEN` bytes, followed by the finger number as big endian
+    unsigned short. Comparing keys bytewise therefore sorts by student
+    id first and by finger number second.
+
+    A `ValueError` is raised if the student id cannot be stored.
+    """
+    raw_id = student_id.encode('ascii')
+    if not raw_id or len(raw_id) > MAX_ID_LEN or b'\x00' in raw_id:
+        raise ValueError("Invalid student id: %r" % student_id)
+    return raw_id.ljust(MAX_ID_LEN, b'\x00') + struct.pack(
+        '>H', int(finger_num))
+
+
+def split_key(key):
+    """Turn a binary key back into a tuple (student id, finger number).
+    """
+    raw_id, finger_num = key[:MAX_ID_LEN], key[MAX_ID_LEN:KEY_SIZE]
+    return (
+        bytes(raw_id).rstrip(b'\x00').decode('ascii'),
+        struct.unpack('>H', finger_num)[0])
+
+
+def write_gallery(path, entries):
+    """Write a compacted gallery with `entries` to `path`.
+
+    `entries` is an iterable of tuples ``(<STUDENT_ID>, <FINGER_NUM>,
+    <DATA>)`` with ``<DATA>`` being a bytes-like object. If an entry
+    appears more than once, the last one wins.
+
+    The file is written to a temporary file first and then moved to
+    `path`, so readers never see half-written galleries.
+
+    Returns the number of entries written.
+    """
+    records = dict()
+    for student_id, finger_num, data in entries:
+        records[make_key(student_id, finger_num)] = data
+    keys = sorted(records)
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.gallery-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            offset = HEADER.size + len(keys) * INDEX_ENTRY.size
+            index = bytearray()
+            for key in keys:
+                length = len(records[key])
+                student_id, finger_num = split_key(key)
+                index += INDEX_ENTRY.pack(
+                    key[:MAX_ID_LEN], finger_num, offset, length)
+                offset += length
+            out.write(HEADER.pack(MAGIC, VERSION, 0, len(keys), offset))
+            out.write(index)
+            for key in keys:
+                out.write(records[key])
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(keys)
+
+
+def append_to_gallery(path, student_id, finger_num, data):
+    """Append a single template to the gallery in `path`.
+
+    The gallery is created if it does not exist yet. The record is
+    added to the tail of the gallery and overrides any older record
+    for the same `student_id` and `finger_num`.
+    """
+    key = make_key(student_id, finger_num)
+    if not os.path.exists(path):
+        write_gallery(path, [])
+    with open(path, 'ab') as fd:
+        fd.write(TAIL_RECORD.pack(
+            key[:MAX_ID_LEN], int(finger_num), len(data)) + bytes(data))
+
+
+class GalleryReader(object):
+    """Read-only access to a gallery file.
+
+    The file in `path` is mapped into memory. All templates returned
+    are `memoryview` instances pointing into that mapping. They must be
+    released (or simply be dropped) before the reader is closed.
+
+    Readers can be used as context managers::
+
+      with GalleryReader('students.fpg') as gallery:
+          fpm_data = bytes(gallery.get('AA11111', 1))
+
+    A `ValueError` is raised if `path` is not a valid gallery file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+        with open(path, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError("Not a fingerprint gallery: %s" % path)
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic, version, flags, count, data_end = HEADER.unpack_from(
+            self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("Not a fingerprint gallery: %s" % path)
+        if version != VERSION:
+            self.close()
+            raise ValueError("Unsupported gallery version: %s" % version)
+        self.index_count = count
+        self.data_end = data_end
+        self._tail = self._read_tail()
+
+    def _read_tail(self):
+        """Get a dict of all records in tail.
+
+        Maps keys to tuples ``(<OFFSET>, <LENGTH>)``. A truncated last
+        record (from an interrupted append) is ignored.
+        """
+        result = dict()
+        pos, size = self.data_end, len(self._mmap)
+        while pos + TAIL_RECORD.size <= size:
+            raw_id, finger_num, length = TAIL_RECORD.unpack_from(
+                self._mmap, pos)
+            start = pos + TAIL_RECORD.size
+            if start + length > size:
+                break
+            result[raw_id + struct.pack('>H', finger_num)] = (start, length)
+            pos = start + length
+        return result
+
+    def _index_key(self, num):
+        offset = HEADER.size + num * INDEX_ENTRY.size
+        return self._mmap[offset:offset + KEY_SIZE]
+
+    def _bisect(self, key):
+        """Get the number of the first index entry not lower than `key`.
+        """
+        lo, hi = 0, self.index_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._index_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _index_entry(self, num):
+        """Get key, offset and length of index entry number `num`.
+        """
+        raw_id, finger_num, offset, length = INDEX_ENTRY.unpack_from(
+            self._mmap, HEADER.size + num * INDEX_ENTRY.size)
+        return raw_id + struct.pack('>H', finger_num), offset, length
+
+    def _lookup(self, key):
+        if key in self._tail:
+            return self._tail[key]
+        num = self._bisect(key)
+        if num < self.index_count:
+            found_key, offset, length = self._index_entry(num)
+            if found_key == key:
+                return offset, length
+        return None
+
+    def get(self, student_id, finger_num=1):
+        """Get the template of `finger_num` of student `student_id`.
+
+        Returns a `memoryview` or `None` if no such template exists.
+        """
+        found = self._lookup(make_key(student_id, finger_num))
+        if found is None:
+            return None
+        offset, length = found
+        return self._view[offset:offset + length]
+
+    def fingerprints(self, student_id):
+        """Get all templates of student `student_id`.
+
+        Returns a dict mapping finger numbers (as strings) to
+        templates, like the `fingerprints` dict we get from Kofa.
+        """
+        start_key = make_key(student_id, 0)
+        prefix = start_key[:MAX_ID_LEN]
+        found = dict()
+        num = self._bisect(start_key)
+        while num < self.index_count:
+            key, offset, length = self._index_entry(num)
+            if key[:MAX_ID_LEN] != prefix:
+                break
+            found[key] = (offset, length)
+            num += 1
+        for key, value in self._tail.items():
+            if key[:MAX_ID_LEN] == prefix:
+                found[key] = value
+        return dict(
+            ("%s" % split_key(key)[1],
+             self._view[offset:offset + length])
+            for key, (offset, length) in found.items())
+
+    def keys(self):
+        """Get a sorted list of all (student id, finger num) tuples.
+        """
+        keys = set(self._tail)
+        for num in range(self.index_count):
+            keys.add(self._index_key(num))
+        return [split_key(key) for key in sorted(keys)]
+
+    def items(self):
+        """Iterate over all live entries, sorted by key.
+
+        Yields tuples ``(<STUDENT_ID>, <FINGER_NUM>, <DATA>)`` with
+        ``<DATA>`` being a `memoryview`.
+        """
+        for student_id, finger_num in self.keys():
+            yield student_id, finger_num, self.get(student_id, finger_num)
+
+    def __len__(self):
+        num_new = 0
+        for key in self._tail:
+            num = self._bisect(key)
+            if num >= self.index_count or self._index_key(num) != key:
+                num_new += 1
+        return self.index_count + num_new
+
+    def __contains__(self, student_id):
+        return bool(self.fingerprints(student_id))
+
+    def close(self):
+        """Unmap the gallery file.
+        """
+        if self._mmap is None:
+            return
+        if getattr(self, '_view', None) is not None:
+            self._view.release()
+            self._view = None
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compact_gallery(path, out_path=None):
+    """Merge the tail of gallery in `path` into its index.
+
+    Overridden records are dropped. The result is written to
+    `out_path` or, if this is not given, replaces the gallery in
+    `path`.
+
+    Returns a tuple ``(<NUM_ENTRIES>, <OLD_SIZE>, <NEW_SIZE>)``.
+    """
+    out_path = out_path or path
+    old_size = os.path.getsize(path)
+    with GalleryReader(path) as reader:
+        num = write_gallery(out_path, reader.items())
+    return num, old_size, os.path.getsize(out_path)
+
+
+def compact_gallery_main(argv=None):
+    """Entry point to compact galleries on commandline.
+
+    Options must be given after a double dash ``--``, which tells
+    `kivy` not to care for them::
+
+      $ waeup_gallery_compact -- students.fpg
+    """
+    parser = argparse.ArgumentParser(
+        description="Compact a waeup.identifier fingerprint gallery.")
+    parser.add_argument('path', help="Gallery file to compact.")
+    parser.add_argument(
+        '-o', '--outfile', default=None,
+        help="Write result to OUTFILE instead of replacing PATH.")
+    args = parser.parse_args(argv)
+    num, old_size, new_size = compact_gallery(args.path, args.outfile)
+    print("Compacted %s: %s entries, %s -> %s bytes" % (
+        args.path, num, old_size, new_size))
@@ -0,0 +1,472 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Watch the UI for stalls and profile running apps.
+
+The main thread sends a heartbeat with every frame rendered. A
+watchdog thread notices when heartbeats stop for longer than a
+threshold and records what the main thread is doing at that moment.
+Frame intervals are collected in a rolling histogram.
+
+A sampling profiler takes the stacks of all threads at regular
+intervals and dumps them in "folded" format, which can be turned into
+flamegraphs by tools like `flamegraph.pl` or `speedscope`.
+
+A resource tracker records memory, threads and open files over time
+to find leaks in long running processes.
+"""
+import collections
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from kivy.logger import Logger
+
+
+#: Main thread stalls longer than this (in seconds) are reported.
+STALL_THRESHOLD = 0.25
+
+#: Upper bounds (in seconds) of frame interval histogram buckets.
+HISTOGRAM_BOUNDS = (0.017, 0.033, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class FrameHistogram(object):
+    """A histogram of the last `size` frame intervals.
+    """
+    def __init__(self, size=3600, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.intervals = collections.deque(maxlen=size)
+
+    def add(self, interval):
+        self.intervals.append(interval)
+
+    def get_buckets(self):
+        """Get a list of tuples ``(<UPPER_BOUND>, <COUNT>)``.
+
+        The last bucket has upper bound `None` and counts all
+        intervals exceeding the largest bound.
+        """
+        counts = [0] * (len(self.bounds) + 1)
+        for interval in self.intervals:
+            for num, bound in enumerate(self.bounds):
+                if interval <= bound:
+                    counts[num] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return list(zip(tuple(self.bounds) + (None, ), counts))
+
+    def percentile(self, percent):
+        """Get the frame interval below which `percent` % of frames are.
+        """
+        if not self.intervals:
+            return 0.0
+        values = sorted(self.intervals)
+        num = min(int(len(values) * percent / 100.0), len(values) - 1)
+        return values[num]
+
+    def format(self):
+        """Get a one-line summary suitable for logs.
+        """
+        buckets = ' '.join(
+            '%s:%s' % ('<=%dms' % (bound * 1000) if bound else 'more', count)
+            for bound, count in self.get_buckets())
+        return "frames: %s, p50 %.1f ms, p99 %.1f ms, max %.1f ms [%s]" % (
+            len(self.intervals), self.percentile(50) * 1000,
+            self.percentile(99) * 1000,
+            max(self.intervals or [0.0]) * 1000, buckets)
+
+
+class StallDetector(object):
+    """Detect main thread stalls.
+
+    `beat()` must be called from the main thread with every frame,
+    for instance via ``Clock.schedule_interval(detector.beat, 0)``.
+    A watchdog thread started by `start()` checks every
+    `threshold` / 2 seconds whether the last beat is older than
+    `threshold`. If so, the stack of the main thread is captured and
+    logged, once per stall.
+
+    Recent stalls are kept in `stalls` as dicts with keys `started`,
+    `duration` (as far as known when the stack was taken) and `stack`.
+    """
+    def __init__(self, threshold=STALL_THRESHOLD, histogram=None,
+                 max_stalls=50):
+        self.threshold = threshold
+        self.histogram = histogram or FrameHistogram()
+        self.stalls = collections.deque(maxlen=max_stalls)
+        self.main_ident = threading.main_thread().ident
+        self.last_beat = None
+        self._reported_beat = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def beat(self, dt=None):
+        """Note that the main thread is alive.
+        """
+        now = time.perf_counter()
+        if self.last_beat is not None:
+            self.histogram.add(now - self.last_beat)
+        self.last_beat = now
+
+    def pause(self):
+        """Stop watching until the next beat.
+
+        Call this before stopping beats on purpose, for instance while
+        the app is idle. The gap is neither reported nor counted.
+        """
+        self.last_beat = None
+
+    def check(self, now=None):
+        """Check for a stall. Called by the watchdog thread.
+
+        Returns the stall found or `None`.
+        """
+        last_beat = self.last_beat
+        now = now or time.perf_counter()
+        if last_beat is None or now - last_beat < self.threshold:
+            return None
+        if self._reported_beat == last_beat:
+            return None  # already reported
+        self._reported_beat = last_beat
+        frame = sys._current_frames().get(self.main_ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        stall = dict(
+            started=time.time() - (now - last_beat),
+            duration=now - last_beat, stack=stack)
+        self.stalls.append(stall)
+        Logger.warning(
+            "waeup.identifier: UI stalled for %.0f ms in:\n%s" % (
+                stall['duration'] * 1000, stack))
+        return stall
+
+    def run(self):
+        while not self._stop.wait(self.threshold / 2.0):
+            self.check()
+
+    def start(self):
+        """Start the watchdog thread.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Stop the watchdog thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def log_stats(self, dt=None):
+        """Log frame interval statistics.
+        """
+        Logger.info(
+            "waeup.identifier: %s, %s stalls" % (
+                self.histogram.format(), len(self.stalls)))
+
+
+#: Environment variable to enable the sampling profiler with.
+PROFILE_ENV_VAR = 'WAEUP_IDENTIFIER_PROFILE'
+
+#: Seconds between two samples of the sampling profiler.
+SAMPLE_INTERVAL = 0.02
+
+#: Seconds between two dumps of the sampling profiler.
+DUMP_INTERVAL = 60.0
+
+#: Maximum number of stack frames sampled per thread.
+MAX_DEPTH = 48
+
+
+def get_profile_dir():
+    """Get the directory where profiles are dumped.
+    """
+    return os.path.join(os.path.expanduser('~'), '.waeupident-profiles')
+
+
+def profiling_requested(environ=os.environ):
+    """Tell whether the sampling profiler was enabled via environment.
+    """
+    return environ.get(PROFILE_ENV_VAR, '0').lower() in (
+        '1', 'yes', 'true', 'on')
+
+
+def get_thread_label(thread):
+    """Get a label for `thread` shared by threads doing the same work.
+
+    Numeric suffixes are removed from thread names (``Worker-12``
+    becomes ``Worker``). Threads with generic names (``Thread-3``) are
+    labeled by their target instead, like
+    ``Thread (call_in_background.<locals>.run)``.
+    """
+    name = re.sub(r'-\d+( \(.*\))?$', '', thread.name)
+    if name != 'Thread':
+        return name
+    target = getattr(thread, '_target', None)
+    if target is None:
+        return type(thread).__name__
+    return "Thread (%s)" % getattr(
+        target, '__qualname__', type(target).__name__)
+
+
+class SamplingProfiler(object):
+    """Sample the stacks of all threads in a background thread.
+
+    Every `interval` seconds the stacks of all other threads are
+    taken and counted. Every `dump_interval` seconds the counts are
+    written to a new file in `path` in folded format, one stack per
+    line::
+
+      MainThread;run (app.py);on_mode (app.py) 12
+
+    Only the newest `max_files` dumps are kept. Stacks start with a
+    label of their thread from `get_thread_label`, so samples of
+    `BackgroundCommand` threads, `call_in_background` workers, etc.
+    are grouped, but kept apart from each other.
+    """
+    def __init__(self, path, interval=SAMPLE_INTERVAL,
+                 dump_interval=DUMP_INTERVAL, max_files=30,
+                 max_depth=MAX_DEPTH):
+        self.path = path
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.max_files = max_files
+        self.max_depth = max_depth
+        self.counts = collections.Counter()
+        self.num_samples = 0
+        self.num_dumps = 0
+        self._labels = dict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = "%s (%s)" % (
+                code.co_name, os.path.basename(code.co_filename))
+        return label
+
+    def sample(self):
+        """Take a sample of all threads but the profiler's own.
+        """
+        names = dict(
+            (thread.ident, get_thread_label(thread))
+            for thread in threading.enumerate())
+        own_ident = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'unknown'))
+            self.counts[';'.join(reversed(stack))] += 1
+        self.num_samples += 1
+
+    def dump(self):
+        """Write counts collected so far to a new file and reset them.
+
+        Returns the path written or `None` if there was nothing to
+        write.
+        """
+        counts, self.counts = self.counts, collections.Counter()
+        if not counts:
+            return None
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.num_dumps += 1
+        filename = "profile-%s-%04d.folded" % (
+            time.strftime('%Y%m%d-%H%M%S'), self.num_dumps % 10000)
+        path = os.path.join(self.path, filename)
+        with open(path + '.tmp', 'w') as fd:
+            for stack, count in sorted(counts.items()):
+                fd.write("%s %s\n" % (stack, count))
+        os.replace(path + '.tmp', path)
+        self.rotate()
+        return path
+
+    def rotate(self):
+        """Remove all but the newest `max_files` dumps.
+        """
+        dumps = sorted(
+            name for name in os.listdir(self.path)
+            if name.startswith('profile-') and name.endswith('.folded'))
+        for name in dumps[:-self.max_files]:
+            os.unlink(os.path.join(self.path, name))
+
+    def run(self):
+        next_dump = time.time() + self.dump_interval
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.time() >= next_dump:
+                self.dump()
+                next_dump = time.time() + self.dump_interval
+        self.dump()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start sampling.
+        """
+        if self.running:
+            return self._thread
+        Logger.info(
+            "waeup.identifier: sampling profiler writes to %s" % self.path)
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Stop sampling and dump remaining samples.
+        """
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+def get_rss():
+    """Get the resident set size of this process in bytes.
+
+    Where ``/proc`` is not available, we get the maximum RSS so far.
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_open_fds():
+    """Get the number of open file descriptors of this process.
+
+    Returns `None` if we cannot tell.
+    """
+    for path in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(path):
+            return len(os.listdir(path)) - 1  # minus the listdir one
+    return None
+
+
+class ResourceTracker(object):
+    """Track memory, threads and open files of this process over time.
+
+    Call `sample()` regularly. Each sample is a dict with keys
+    `label`, `time`, `rss` (bytes), `threads`, `fds` and `traced`
+    (bytes allocated as seen by `tracemalloc`, if tracing).
+
+    With `trace_malloc` set, `start()` starts `tracemalloc` and
+    `mark_baseline()` takes the snapshot `top_allocators()` compares
+    to.
+    """
+    def __init__(self, trace_malloc=False):
+        self.trace_malloc = trace_malloc
+        self.samples = []
+        self.baseline = None
+        self._snapshot = None
+
+    def start(self):
+        if self.trace_malloc and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        return self.sample('start')
+
+    def stop(self):
+        if self.trace_malloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def sample(self, label=None):
+        """Take a sample and return it.
+        """
+        result = dict(
+            label=label, time=time.time(), rss=get_rss(),
+            threads=threading.active_count(), fds=count_open_fds(),
+            traced=(tracemalloc.get_traced_memory()[0]
+                    if tracemalloc.is_tracing() else None))
+        self.samples.append(result)
+        return result
+
+    def mark_baseline(self):
+        """Take the sample growth is measured from.
+
+        Call it after warming up, when caches are filled and pools
+        started.
+        """
+        self.baseline = self.sample('baseline')
+        if tracemalloc.is_tracing():
+            self._snapshot = tracemalloc.take_snapshot()
+        return self.baseline
+
+    def get_growth(self):
+        """Get a dict with the growth of all values since baseline.
+        """
+        first = self.baseline or self.samples[0]
+        last = self.samples[-1]
+        return dict(
+            (key, last[key] - first[key])
+            for key in ('rss', 'threads', 'fds', 'traced')
+            if last[key] is not None and first[key] is not None)
+
+    def check(self, limits):
+        """Check growth against `limits`.
+
+        `limits` is a dict mapping keys of `get_growth()` results to
+        the maximum growth allowed. Returns a list of messages, one
+        for each limit exceeded.
+        """
+        growth = self.get_growth()
+        return [
+            "%s grew by %s (limit: %s)" % (key, growth[key], limit)
+            for key, limit in sorted(limits.items())
+            if key in growth and growth[key] > limit]
+
+    def top_allocators(self, limit=10):
+        """Get the `limit` code lines that allocated most since baseline.
+
+        Returns a list of strings. Empty if not tracing.
+        """
+        if self._snapshot is None or not tracemalloc.is_tracing():
+            return []
+        stats = tracemalloc.take_snapshot().compare_to(
+            self._snapshot, 'lineno')
+        return ["%s" % stat for stat in stats[:limit]]
+
+    def format(self):
+        """Get all samples as table.
+        """
+        lines = ["%-10s %8s %10s %8s %6s %10s" % (
+            'label', 'secs', 'rss kB', 'threads', 'fds', 'traced kB')]
+        start = self.samples[0]['time'] if self.samples else 0
+        for sample in self.samples:
+            lines.append("%-10s %8.1f %10d %8d %6s %10s" % (
+                sample['label'], sample['time'] - start,
+                sample['rss'] // 1024, sample['threads'], sample['fds'],
+                '-' if sample['traced'] is None
+                else sample['traced'] // 1024))
+        return '\n'.join(lines)
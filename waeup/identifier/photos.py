@@ -0,0 +1,217 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Load student photos without blocking the UI.
+
+Photos are fetched, decoded and downscaled in a background thread.
+Only the texture upload happens in the main thread. Textures are kept
+in a small LRU cache for a limited time.
+
+Decoding photos requires `Pillow`. Without it, no photos are shown.
+"""
+import collections
+import hashlib
+import io
+import threading
+import time
+from kivy.clock import mainthread
+from kivy.logger import Logger
+try:
+    from PIL import Image as PILImage
+except ImportError:                      # pragma: no cover
+    PILImage = None
+
+
+#: Maximum size (width, height) of photos shown.
+PHOTO_SIZE = (240, 320)
+
+#: Seconds a cached photo is shown without asking the server again.
+PHOTO_TTL = 300.0
+
+
+def decode_photo(data, max_size=PHOTO_SIZE):
+    """Decode image `data` and scale it down to fit into `max_size`.
+
+    Returns a tuple ``(<SIZE>, <PIXELS>)`` with ``<SIZE>`` being a
+    tuple (width, height) and ``<PIXELS>`` the RGBA pixel data, bottom
+    row first, as expected by kivy textures.
+
+    Raises `ValueError` if the data cannot be decoded.
+    """
+    if PILImage is None:
+        raise ValueError("Cannot decode photos: Pillow not installed")
+    try:
+        img = PILImage.open(io.BytesIO(data))
+        img.draft('RGB', max_size)  # let JPEG decoder scale down early
+        img.thumbnail(max_size)
+        img = img.convert('RGBA').transpose(PILImage.FLIP_TOP_BOTTOM)
+    except (IOError, OSError) as err:
+        raise ValueError("Cannot decode photo: %s" % err)
+    return img.size, img.tobytes()
+
+
+def create_texture(size, pixels):
+    """Create a kivy texture from RGBA `pixels`.
+
+    Must be called in the main thread.
+    """
+    from kivy.graphics.texture import Texture
+    texture = Texture.create(size=size, colorfmt='rgba')
+    texture.blit_buffer(pixels, colorfmt='rgba', bufferfmt='ubyte')
+    return texture
+
+
+class LRUCache(object):
+    """A dict-like cache keeping the `maxsize` recently used items.
+
+    `hits` and `misses` count the results of `get()` calls.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PhotoLoader(object):
+    """Provide textures of student photos.
+
+    `fetch` is a callable that is called with a server URL and a
+    student id and returns a tuple ``(<IMG_NAME>, <IMG_DATA>)`` or an
+    error message, like `webservice.get_photo`.
+
+    Textures are cached by student id for `ttl` seconds. Afterwards
+    the photo is fetched again; if it did not change, the cached
+    texture is kept without decoding the photo again. `make_texture`
+    turns decoded pixels into a texture and is called in the main
+    thread.
+    """
+    def __init__(self, fetch, cache_size=32, max_size=PHOTO_SIZE,
+                 make_texture=create_texture, ttl=PHOTO_TTL):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.make_texture = make_texture
+        self.ttl = ttl
+        self.cache = LRUCache(cache_size)
+        self.hits = 0
+        self.misses = 0
+        self.decode_count = 0
+        self.decode_time = 0.0
+
+    def load(self, url, student_id, callback, photo=None):
+        """Get the photo texture of `student_id`.
+
+        `callback` is called in the main thread with the student id
+        and the texture (or `None` if no photo is available). On cache
+        hits this happens immediately.
+
+        If the photo was already downloaded, pass it as `photo`, a
+        tuple like the ones returned by `fetch`. It is used instead of
+        fetching the photo again.
+        """
+        # cache entries: (<STORED>, <IMG_NAME>, <DIGEST>, <TEXTURE>)
+        entry = self.cache.get(student_id)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            self.hits += 1
+            callback(student_id, entry[3])
+            return None
+        self.misses += 1
+        thread = threading.Thread(
+            target=self._load,
+            args=(url, student_id, callback, entry, photo), daemon=True)
+        thread.start()
+        return thread
+
+    def _load(self, url, student_id, callback, entry, photo):
+        # run in background
+        result = photo
+        if result is None:
+            result = self.fetch(url, student_id)
+        if not isinstance(result, tuple):
+            # no answer: keep showing what we have
+            Logger.debug(
+                "waeup.identifier: no photo for %s: %r" % (
+                    student_id, result))
+            self._deliver(student_id, callback, entry=entry)
+            return
+        img_name, data = result
+        digest = hashlib.sha1(data).digest()
+        if entry is not None and entry[1:3] == (img_name, digest):
+            # unchanged photo
+            self._deliver(student_id, callback, entry=(
+                time.time(), img_name, digest, entry[3]), store=True)
+            return
+        decoded = None
+        if data:
+            start = time.time()
+            try:
+                decoded = decode_photo(data, self.max_size)
+            except ValueError as err:
+                Logger.warning("waeup.identifier: %s" % err)
+            self.decode_count += 1
+            self.decode_time += time.time() - start
+        self._deliver(student_id, callback, entry=(
+            time.time(), img_name, digest, None), store=True,
+            decoded=decoded)
+
+    @mainthread
+    def _deliver(self, student_id, callback, entry=None, store=False,
+                 decoded=None):
+        # show the texture of cache `entry` or of `decoded` pixels
+        texture = None
+        if entry is not None:
+            texture = entry[3]
+            if decoded is not None:
+                texture = self.make_texture(*decoded)
+            if store:
+                self.cache[student_id] = entry[:3] + (texture, )
+        callback(student_id, texture)
+
+    def get_stats(self):
+        """Get a dict with decode times and cache hit rate.
+        """
+        lookups = self.hits + self.misses
+        return dict(
+            decode_count=self.decode_count,
+            decode_time=self.decode_time,
+            avg_decode_time=(
+                self.decode_time / self.decode_count
+                if self.decode_count else 0.0),
+            hit_rate=float(self.hits) / lookups if lookups else 0.0)
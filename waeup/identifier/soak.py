@@ -0,0 +1,215 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Soak test: run many enroll and verify cycles and watch for leaks.
+
+Kiosks run for many hours. The soak test drives thousands of
+simulated enrollments and verifications through the same machinery
+the app uses (scanner commands, enrollment sessions, background
+threads and webservice calls) against a fake Kofa server and a
+simulated scanner, all in-process. Memory, threads and open files are
+sampled over time. The test fails if they grow too much::
+
+  $ waeup_soak --cycles 5000 --tracemalloc
+
+Growth is measured from a baseline taken after warming up.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from waeup.identifier.app import (
+    EnrollmentSession, FPScanCommand, arm_scanner, call_in_background,
+    get_fpm_path,
+    )
+from waeup.identifier.backends import SimulatedBackend, set_backend
+from waeup.identifier.monitor import ResourceTracker
+from waeup.identifier.testing import fake_kofa
+from waeup.identifier.webservice import get_templates, store_fingerprints
+
+
+#: Growth allowed by default: 32 MB RSS, two threads, four files.
+DEFAULT_LIMITS = dict(rss=32 * 1024 * 1024, threads=2, fds=4)
+
+#: Seconds a single step of a cycle may take.
+STEP_TIMEOUT = 30.0
+
+
+class SoakError(Exception):
+    """Raised if a soak cycle fails.
+    """
+
+
+def run_in_background(callable, *args):
+    """Run `callable` via `call_in_background` and wait for the result.
+    """
+    results = []
+    done = threading.Event()
+
+    def callback(result):
+        results.append(result)
+        done.set()
+    call_in_background(callable, args=args, callback=callback)
+    if not done.wait(STEP_TIMEOUT):
+        raise SoakError("Timeout in %s" % callable.__name__)
+    return results[0]
+
+
+def run_command(cmd):
+    """Start `cmd` (a `FPScanCommand`) and wait for its callback.
+    """
+    done = threading.Event()
+    cmd.callback = lambda cmd: done.set()
+    cmd.start()
+    if not done.wait(STEP_TIMEOUT):
+        raise SoakError("Timeout in %s" % cmd.cmd)
+    cmd.join()
+    return cmd
+
+
+def enroll_cycle(url, student_id, fingers=(1, )):
+    """Scan `fingers` of `student_id` and upload them to `url`.
+    """
+    session = EnrollmentSession(student_id, fingers)
+    scanners = None
+    while session.next_finger() is not None:
+        finger = session.next_finger()
+        error, scanners, cmd = arm_scanner(
+            'fpscan', ['-s'], capture=session.get_buffer(finger),
+            scanners=scanners)
+        if error is not None:
+            raise SoakError("Cannot arm scanner: %s" % error)
+        run_command(cmd)
+        session.add_capture(finger, cmd.capture).join()
+    if session.errors:
+        raise SoakError("Invalid captures: %r" % session.errors)
+    result = run_in_background(
+        store_fingerprints, url, student_id, session.fingerprints)
+    if result is not True:
+        raise SoakError("Upload failed: %s" % result)
+
+
+def verify_cycle(url, student_id):
+    """Fetch the fingerprint of `student_id` and compare a scan.
+    """
+    result = run_in_background(get_templates, url, student_id)
+    if not isinstance(result, dict) or '1' not in result.get(
+            'fingerprints', {}):
+        raise SoakError("Download failed: %r" % (result, ))
+    path = get_fpm_path()
+    with open(path, 'wb') as fd:
+        fd.write(result['fingerprints']['1'].data)
+    cmd = run_command(FPScanCommand('fpscan', ['-c', '-i', path]))
+    if cmd.get_result() != 'ok':
+        raise SoakError("Verification failed: %s" % cmd.get_result())
+
+
+def popup_cycle():
+    """Open and dismiss a popup. Needs a display.
+    """
+    from kivy.clock import Clock
+    from waeup.identifier.app import FPScanPopup
+    popup = FPScanPopup(title="Soak test", message="Just testing")
+    popup.open(animation=False)
+    Clock.tick()
+    popup.dismiss(animation=False)
+    Clock.tick()
+
+
+def run_soak(url, cycles, students=100, fingers=(1, ), warmup=50,
+             sample_every=100, popups=False, tracker=None, out=None):
+    """Run `cycles` enroll and verify cycles against server `url`.
+
+    Students ``SK00000`` up to `students` are enrolled and verified
+    in turn. They must exist on the server. After `warmup` cycles the
+    baseline is taken, afterwards resources are sampled every
+    `sample_every` cycles and written to `out`, if given.
+
+    Returns the `ResourceTracker` used.
+    """
+    tracker = tracker or ResourceTracker()
+    tracker.start()
+    for num in range(cycles):
+        student_id = 'SK%05d' % (num % students)
+        enroll_cycle(url, student_id, fingers)
+        verify_cycle(url, student_id)
+        if popups:
+            popup_cycle()
+        if num + 1 == warmup:
+            tracker.mark_baseline()
+        elif num + 1 > warmup and (num + 1) % sample_every == 0:
+            sample = tracker.sample('%s' % (num + 1))
+            if out is not None:
+                out.write("%8s cycles: rss %s kB, threads %s, fds %s\n" % (
+                    sample['label'], sample['rss'] // 1024,
+                    sample['threads'], sample['fds']))
+    tracker.sample('end')
+    return tracker
+
+
+def soak_main(argv=None):
+    """Entry point of the `waeup_soak` script.
+
+    Exits with status 1 if resources grew more than allowed.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--cycles', type=int, default=1000,
+                        help="Enroll/verify cycles to run (default: 1000).")
+    parser.add_argument('-f', '--fingers', type=int, default=2,
+                        help="Fingers per enrollment (default: 2).")
+    parser.add_argument('-w', '--warmup', type=int, default=50,
+                        help="Cycles before the baseline (default: 50).")
+    parser.add_argument('-e', '--sample-every', type=int, default=100,
+                        help="Cycles between samples (default: 100).")
+    parser.add_argument('--max-rss', type=float, default=32.0,
+                        help="Allowed RSS growth in MB (default: 32).")
+    parser.add_argument('--max-threads', type=int, default=2,
+                        help="Allowed thread growth (default: 2).")
+    parser.add_argument('--max-fds', type=int, default=4,
+                        help="Allowed open files growth (default: 4).")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="Trace allocations and list top allocators.")
+    parser.add_argument('--popups', action='store_true',
+                        help="Also open popups (needs a display).")
+    args = parser.parse_args(argv)
+    limits = dict(rss=int(args.max_rss * 1024 * 1024),
+                  threads=args.max_threads, fds=args.max_fds)
+    workdir = tempfile.mkdtemp()
+    old_cwd = os.getcwd()
+    os.chdir(workdir)
+    old_backend = set_backend(SimulatedBackend(template_size=800))
+    tracker = ResourceTracker(trace_malloc=args.tracemalloc)
+    students = ['SK%05d' % num for num in range(100)]
+    try:
+        with fake_kofa(students=students) as server:
+            run_soak(server.url, args.cycles, len(students),
+                     range(1, args.fingers + 1), args.warmup,
+                     args.sample_every, args.popups, tracker, sys.stdout)
+        print(tracker.format())
+        for line in tracker.top_allocators():
+            print(line)
+        failures = tracker.check(limits)
+    finally:
+        tracker.stop()
+        set_backend(old_backend)
+        os.chdir(old_cwd)
+        shutil.rmtree(workdir)
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    sys.exit(1 if failures else 0)
@@ -15,20 +15,30 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import argparse
+import contextlib
+import functools
+import math
 import os
+import random
 import shutil
 import stat
 import sys
 import tempfile
+import threading
+import time
 import unittest
 try:
     import xmlrpc.client as xmlrpc_client
 except ImportError:                   # pragma: no cover
     import xmlrpclib as xmlrpcclient  # noqa: F401
 from base64 import b64decode
+from waeup.identifier.wire import CODECS
 try:                  # Python 3.x
+    from socketserver import ThreadingMixIn
     from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 except ImportError:   # Python 2.x    # pragma: no cover
+    from SocketServer import ThreadingMixIn
     from SimpleXMLRPCServer import (
         SimpleXMLRPCServer, SimpleXMLRPCRequestHandler)
 
@@ -36,7 +46,8 @@ except ImportError:   # Python 2.x    # pragma: no cover
 def create_executable(path, content):
     """Create an executable in `path` with `content` as content.
     """
-    open(path, 'w').write(content)
+    with open(path, 'w') as fd:
+        fd.write(content)
     os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
     return
 
@@ -79,7 +90,8 @@ def create_fake_fpm_file(path_dir):
     .fpm files are fingerprint files as created by libfprint.
     """
     path = os.path.join(path_dir, 'data.fpm')
-    open(path, 'wb').write(b'FP1-some-fake-file')
+    with open(path, 'wb') as fd:
+        fd.write(b'FP1-some-fake-file')
     return path
 
 
@@ -153,7 +165,140 @@ class AuthenticatingXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
                 self.send_error(401, 'Unauthorized')
         return False
 
+    def do_POST(self):
+        """Handle POST requests.
 
+        Requests to the path of the binary wire codec are handled
+        here. XMLRPC requests are handled here only if the server
+        injects faults and by the standard handler otherwise.
+        """
+        codecs = dict((codec.path, codec) for codec in CODECS.values())
+        codec = codecs.get(self.path)
+        faults = getattr(self.server, 'faults', None)
+        if codec is None or (codec.name == 'xmlrpc' and faults is None):
+            return super(AuthenticatingXMLRPCRequestHandler, self).do_POST()
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            method_name, params = codec.loads_request(self.rfile.read(length))
+        except Exception:
+            self.send_error(400, 'Bad Request')
+            return
+        action = None
+        if faults is not None:
+            time.sleep(faults.get_latency(method_name))
+            action = faults.get_action()
+        if action == 'error':
+            self.send_error(503, 'Service Unavailable')
+            return
+        try:
+            if action == 'fault':
+                raise xmlrpc_client.Fault(-32500, 'Injected fault')
+            response = codec.dumps_response(
+                self.server._dispatch(method_name, params))
+        except xmlrpc_client.Fault as fault:
+            response = codec.dumps_fault(fault.faultCode, fault.faultString)
+        except Exception as err:
+            response = codec.dumps_fault(1, "%s:%s" % (type(err), err))
+        self.send_response(200)
+        self.send_header('Content-Type', codec.content_type)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        if action == 'partial':
+            # send only half of the response, then hang and hang up
+            self.wfile.write(response[:len(response) // 2])
+            self.wfile.flush()
+            time.sleep(faults.stall)
+            self.close_connection = True
+            return
+        if faults is None or not faults.bandwidth:
+            self.wfile.write(response)
+            return
+        chunk_size = max(int(faults.bandwidth * 0.05), 1)
+        for pos in range(0, len(response), chunk_size):
+            chunk = response[pos:pos + chunk_size]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(len(chunk) / faults.bandwidth)
+
+
+class FaultInjector(object):
+    """Make a fake Kofa server behave like a server on a bad network.
+
+    `latency` is a dict mapping method names to tuples ``(<MEDIAN>,
+    <SIGMA>)``. Call latencies (in seconds) are drawn from a log-normal
+    distribution with the given median and shape `sigma`. Sigma ``0``
+    means a fixed latency. The entry for ``'*'`` applies to methods not
+    listed.
+
+    `bandwidth` limits responses to that many bytes per second.
+
+    `error_rate`, `fault_rate` and `partial_rate` give the
+    probabilities of HTTP 503 errors, XMLRPC faults, and partial
+    responses. Partial responses send half of the response, then
+    stall for `stall` seconds and close the connection.
+
+    Pass a `seed` to get reproducible runs.
+    """
+    def __init__(self, latency=None, bandwidth=None, error_rate=0.0,
+                 fault_rate=0.0, partial_rate=0.0, stall=30.0, seed=None):
+        self.latency = dict(latency or {})
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.partial_rate = partial_rate
+        self.stall = stall
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_scenario(cls, name, seed=None):
+        """Create an injector for one of the `SCENARIOS`.
+
+        Raises `KeyError` for unknown scenario names.
+        """
+        return cls(seed=seed, **SCENARIOS[name])
+
+    def get_latency(self, method_name):
+        """Get the seconds a call of `method_name` should be delayed.
+        """
+        median, sigma = self.latency.get(
+            method_name, self.latency.get('*', (0.0, 0.0)))
+        if median <= 0:
+            return 0.0
+        return self.random.lognormvariate(math.log(median), sigma)
+
+    def get_action(self):
+        """Get the kind of fault to inject into the next response.
+
+        One of ``'error'``, ``'fault'``, ``'partial'`` or `None`.
+        """
+        value = self.random.random()
+        for action, rate in (('error', self.error_rate),
+                             ('fault', self.fault_rate),
+                             ('partial', self.partial_rate)):
+            if value < rate:
+                return action
+            value -= rate
+        return None
+
+
+#: Bad network and server scenarios selectable for fake Kofa servers.
+SCENARIOS = {
+    'lan': dict(latency={'*': (0.002, 0.3)}),
+    'dsl': dict(latency={'*': (0.05, 0.3)}, bandwidth=100000),
+    'mobile': dict(
+        latency={'*': (0.3, 0.6), 'put_student_fingerprints': (0.6, 0.6)},
+        bandwidth=20000, partial_rate=0.01, stall=10.0),
+    'flaky': dict(
+        latency={'*': (0.1, 0.5)}, error_rate=0.1, fault_rate=0.05,
+        partial_rate=0.05, stall=5.0),
+    'overloaded': dict(
+        latency={'*': (2.0, 0.8)}, error_rate=0.3),
+    'slowloris': dict(partial_rate=1.0, stall=60.0),
+    }
+
+
+#: The student database used by functions below if no `db` is given.
+#: Servers have their own databases.
 fake_student_db = dict()
 
 
@@ -165,40 +310,48 @@ def xmlrpc_ping(x):
     return ('pong', x)
 
 
-def xmlrpc_reset_student_db():
+def xmlrpc_reset_student_db(db=None):
     """Remove all entries from local students DB.
 
+    `db` is the student database to use. By default
+    `fake_student_db`. The same applies to all functions below.
+
     This method is not part of Kofa.
     """
-    global fake_student_db
-    fake_student_db = dict()
+    if db is None:
+        db = fake_student_db
+    db.clear()
     return True
 
 
 def xmlrpc_create_student(student_id, email="bob@sample.org",
                           firstname="Bob", lastname="Barley",
-                          img_name="", img="", fingerprints={}):
+                          img_name="", img="", fingerprints=None, db=None):
     """Create an entry in local fake student DB.
 
     This method is not part of Kofa.
     """
-    global fake_student_db
-    if student_id not in fake_student_db.keys():
-        fake_student_db[student_id] = dict(
+    if db is None:
+        db = fake_student_db
+    if student_id not in db.keys():
+        db[student_id] = dict(
             email=email, firstname=firstname, lastname=lastname,
-            img=img, img_name=img_name, fingerprints=fingerprints
+            img=img, img_name=img_name,
+            fingerprints=dict(fingerprints or {})
             )
     return True
 
 
-def xmlrpc_put_student_fingerprints(identifier=None, fingerprints={}):
+def xmlrpc_put_student_fingerprints(identifier=None, fingerprints={},
+                                    db=None):
     """Put student fingerprint data into local fake DB.
 
     This function mimics behavior from Kofa.
     """
-    global fake_student_db
+    if db is None:
+        db = fake_student_db
     result = False
-    if identifier not in fake_student_db.keys():
+    if identifier not in db.keys():
         raise xmlrpc_client.Fault(
             xmlrpc_client.INVALID_METHOD_PARAMS,
             "No such student: '%s'" % identifier)
@@ -224,19 +377,20 @@ def xmlrpc_put_student_fingerprints(identifier=None, fingerprints={}):
                 "Invalid file format for finger %s" % num)
         result = True
     # everything fine. Now store uploaded fingerprints.
-    fake_student_db[identifier]["fingerprints"].update(fingerprints)
+    db[identifier]["fingerprints"].update(fingerprints)
     return result
 
 
-def xmlrpc_get_student_fingerprints(identifier=None):
+def xmlrpc_get_student_fingerprints(identifier=None, db=None):
     """Retrieve student data from local fake database.
 
     This method mimics Kofa functionality.
     """
-    global fake_student_db
-    if identifier not in fake_student_db.keys():
+    if db is None:
+        db = fake_student_db
+    if identifier not in db.keys():
         return dict()
-    student = fake_student_db[identifier]
+    student = db[identifier]
     return dict(
         email=student.get("email", ""),
         firstname=student.get("firstname", ""),
@@ -247,49 +401,178 @@ def xmlrpc_get_student_fingerprints(identifier=None):
         )
 
 
-class AuthenticatingXMLRPCServer(SimpleXMLRPCServer):
+def xmlrpc_get_student_templates(identifier=None, finger_nums=None,
+                                 db=None):
+    """Retrieve only fingerprints from local fake database.
+
+    Only the fingerprints of fingers listed in `finger_nums` are
+    returned. If `finger_nums` is `None`, all fingerprints are
+    returned.
+
+    This method is not part of Kofa.
+    """
+    if db is None:
+        db = fake_student_db
+    if identifier not in db.keys():
+        return dict()
+    fingerprints = db[identifier].get("fingerprints", {})
+    if finger_nums is not None:
+        fingerprints = dict(
+            (str(num), fingerprints[str(num)]) for num in finger_nums
+            if str(num) in fingerprints)
+    return dict(fingerprints=fingerprints)
+
+
+def xmlrpc_get_student_photo(identifier=None, db=None):
+    """Retrieve only the photo from local fake database.
+
+    This method is not part of Kofa.
+    """
+    if db is None:
+        db = fake_student_db
+    if identifier not in db.keys():
+        return dict()
+    student = db[identifier]
+    return dict(
+        img_name=student.get("img_name", ""), img=student.get("img", ""))
+
+
+class AuthenticatingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
     """An XMLRPC server that fakes WAeUP kofa XMLRPC services.
+
+    Each server has its own student database `db` (a dict), unless
+    one is passed in. Pass ``0`` as `port` to bind to a free port.
+    `url` tells where the server can be reached.
+
+    Each request is handled in its own (daemon) thread, so slow or
+    stalled requests neither delay others nor block `stop()`.
     """
-    def __init__(self, host="127.0.0.1", port=14096):
+    daemon_threads = True
+
+    #: Seconds between checks for a shutdown request in `start()`.
+    poll_interval = 0.05
+
+    def __init__(self, host="127.0.0.1", port=14096, faults=None,
+                 db=None, log_requests=True):
         super(AuthenticatingXMLRPCServer, self).__init__(
-            (host, port), requestHandler=AuthenticatingXMLRPCRequestHandler
+            (host, port), requestHandler=AuthenticatingXMLRPCRequestHandler,
+            logRequests=log_requests
             )
+        self.faults = faults
+        self.db = dict() if db is None else db
+        self._thread = None
         self.register_introspection_functions()
+        for func, name in (
+                (xmlrpc_create_student, 'create_student'),  # not in kofa
+                (xmlrpc_reset_student_db, 'reset_student_db'),  # dito
+                (xmlrpc_put_student_fingerprints,
+                 'put_student_fingerprints'),
+                (xmlrpc_get_student_fingerprints,
+                 'get_student_fingerprints'),
+                (xmlrpc_get_student_templates,
+                 'get_student_templates'),  # not part of kofa
+                (xmlrpc_get_student_photo,
+                 'get_student_photo')):  # dito
+            self.register_function(
+                functools.wraps(func)(functools.partial(func, db=self.db)),
+                name)
         self.register_function(xmlrpc_ping, 'ping')  # not part of kofa
-        self.register_function(xmlrpc_create_student,
-                               'create_student')     # not part of kofa
-        self.register_function(xmlrpc_reset_student_db,
-                               'reset_student_db')   # not part of kofa
-        self.register_function(xmlrpc_put_student_fingerprints,
-                               'put_student_fingerprints')
-        self.register_function(xmlrpc_get_student_fingerprints,
-                               'get_student_fingerprints')
         return
 
+    @property
+    def url(self):
+        """The URL of this server, including valid credentials.
+        """
+        return "http://mgr:mgrpw@%s:%s" % self.server_address[:2]
+
+    def start(self):
+        """Serve requests in a background thread.
+        """
+        self._thread = threading.Thread(
+            target=self.serve_forever, args=(self.poll_interval, ),
+            daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Stop serving requests and close the server socket.
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
 
-def start_fake_kofa():
+@contextlib.contextmanager
+def fake_kofa(host="127.0.0.1", port=0, faults=None, students=()):
+    """Run a fake Kofa server while in context.
+
+    By default the server listens on a free port. It has its own
+    student database, prefilled with entries for the `students` ids
+    given. The running `AuthenticatingXMLRPCServer` is returned, so
+    you can get its `url`::
+
+      with fake_kofa(students=['AA11111']) as server:
+          get_fingerprints(server.url, 'AA11111')
+
+    Any number of servers can run side by side.
+    """
+    server = AuthenticatingXMLRPCServer(
+        host, port, faults=faults, log_requests=False)
+    for student_id in students:
+        xmlrpc_create_student(student_id, db=server.db)
+    server.start()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+def start_fake_kofa(argv=None):
     """Entry point to start a fake kofa server on commandline.
 
     The fake server provides only a copy of the XMLRPC API of WAeUP
     Kofa. Useful for testing.
 
     With ``-- -p`` also a couple of fake student entries are created on
-    startup.
+    startup. With ``-- -s <SCENARIO>`` the server behaves like one of
+    the bad networks or servers in `SCENARIOS`.
 
     The double dash ``--`` tells `kivy` not to care for all
     following parameters, while `-p` tells us to populate the fake
     database with the said entries.
     """
-    server = AuthenticatingXMLRPCServer('127.0.0.1', 61616)
-    print("Starting server at 127.0.0.1:61616")
-    if "-p" not in sys.argv:
+    parser = argparse.ArgumentParser(description="Start a fake Kofa server.")
+    parser.add_argument(
+        '-p', '--populate', action='store_true',
+        help="Create some fake student entries.")
+    parser.add_argument(
+        '--port', type=int, default=61616,
+        help="Port to listen on, 0 for any free one (default: 61616).")
+    parser.add_argument(
+        '-s', '--scenario', choices=sorted(SCENARIOS), default=None,
+        help="Inject latencies and faults like in SCENARIO.")
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help="Seed for random faults, for reproducible runs.")
+    args = parser.parse_args(argv)
+    faults = None
+    if args.scenario is not None:
+        faults = FaultInjector.from_scenario(args.scenario, seed=args.seed)
+    server = AuthenticatingXMLRPCServer('127.0.0.1', args.port, faults)
+    print("Starting server at 127.0.0.1:%s" % server.server_address[1])
+    if args.scenario is not None:
+        print("Simulating scenario: %s" % args.scenario)
+    if not args.populate:
         print("No entries created. Restart with `-- -p' to create.")
     else:
         # create some fake entries
         for (stud_id, email, firstname, lastname) in [
                 ("AA11111", "alice@sample.org", "Alice", "Align"),
                 ("BB11111", "bob@simple.edu", "Bob", "Bash"), ]:
-            xmlrpc_create_student(stud_id, email, firstname, lastname)
+            xmlrpc_create_student(
+                stud_id, email, firstname, lastname, db=server.db)
             print("Created fake entry: %s" % stud_id)
     print("Press ^C (Ctrl-c) to abort.")
     server.serve_forever()
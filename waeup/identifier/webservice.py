@@ -17,6 +17,17 @@
 #
 """Connect to WAeUP kofa via webservices.
 """
+import random
+import socket
+import threading
+import time
+from base64 import b64encode
+from xml.parsers.expat import ExpatError
+from waeup.identifier.wire import binary_view, get_codec
+try:
+    import http.client as httpclient      # Python 3.x
+except ImportError:                       # pragma: no cover
+    import httplib as httpclient          # Python 2.x
 try:
     import xmlrpc.client as xmlrpcclient  # Python 3.x
 except ImportError:                       # pragma: no cover
@@ -27,6 +38,366 @@ except ImportError:                       # pragma: no cover
     from urlparse import urlparse         # Python 2.x
 
 
+#: Seconds to wait for a connection to a Kofa server.
+CONNECT_TIMEOUT = 5.0
+
+#: Seconds to wait for data from a Kofa server.
+READ_TIMEOUT = 30.0
+
+#: Seconds a webservice call may take at all, including retries.
+CALL_DEADLINE = 60.0
+
+#: How often failed idempotent calls are retried.
+RETRIES = 2
+
+#: Base delay in seconds for the (jittered) exponential retry backoff.
+RETRY_BACKOFF = 0.2
+
+#: Name of the wire codec used if none is given explicitly.
+#: Change with `set_default_codec()`.
+default_codec = 'xmlrpc'
+
+
+def set_default_codec(name):
+    """Set the wire codec used by default for all calls.
+
+    `name` must be the name of a codec in `wire.CODECS`. Otherwise a
+    `ValueError` is raised.
+    """
+    global default_codec
+    default_codec = get_codec(name).name
+
+
+class ServerUnavailable(Exception):
+    """Raised if a server is known to be down.
+    """
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for webservice calls.
+
+    While a server works, the breaker is ``closed`` and all calls are
+    allowed. After `threshold` failed calls in a row, the breaker
+    switches to ``open`` and calls should fail immediately. After
+    `reset_timeout` seconds the breaker becomes ``half-open`` and
+    allows a single trial call. If it succeeds, the breaker is closed
+    again, otherwise it reopens.
+
+    Callables registered with `add_listener()` are called with the
+    breaker and the new state whenever the state changes. They might
+    be called from any thread.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=3, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.listeners = []
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """Register `listener` to be notified on state changes.
+        """
+        self.listeners.append(listener)
+
+    def _set_state(self, state):
+        # must be called with lock held. Returns listeners to notify.
+        if state == self.state:
+            return []
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.time()
+        return list(self.listeners)
+
+    def _notify(self, listeners):
+        for listener in listeners:
+            listener(self, self.state)
+
+    def is_open(self):
+        """Tell whether calls will currently fail fast.
+
+        Different to `allow()` this does not change the breaker state.
+        """
+        with self._lock:
+            return self.state == self.OPEN and (
+                time.time() - self.opened_at < self.reset_timeout)
+
+    def allow(self):
+        """Tell whether a call should be tried.
+        """
+        listeners = []
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                listeners = self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial_running:
+                    return False
+                self._trial_running = True
+        self._notify(listeners)
+        return True
+
+    def record_success(self):
+        """Tell the breaker that a call succeeded.
+        """
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            listeners = self._set_state(self.CLOSED)
+        self._notify(listeners)
+
+    def record_failure(self):
+        """Tell the breaker that a call failed.
+        """
+        listeners = []
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or (
+                    self.failures >= self.threshold):
+                listeners = self._set_state(self.OPEN)
+        self._notify(listeners)
+
+
+class Deadline(object):
+    """Abort calls still running at `end` (a `time.time()` value).
+
+    Socket timeouts only limit single reads. A server sending a slow
+    trickle of data could keep a call running much longer. Sockets
+    passed to `watch()` are therefore shut down by a timer when the
+    deadline expires. Pending reads then fail right away.
+    """
+    def __init__(self, end):
+        self.end = end
+        self.expired = False
+        self._socks = []
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(max(end - time.time(), 0), self.expire)
+        self._timer.daemon = True
+
+    def start(self):
+        self._timer.start()
+        return self
+
+    def cancel(self):
+        self._timer.cancel()
+
+    def watch(self, sock):
+        """Shut down `sock` when the deadline expires.
+        """
+        with self._lock:
+            self._socks.append(sock)
+            expired = self.expired
+        if expired:
+            self._shutdown(sock)
+
+    def expire(self):
+        with self._lock:
+            self.expired = True
+            socks = list(self._socks)
+        for sock in socks:
+            self._shutdown(sock)
+
+    def _shutdown(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, ValueError):
+            pass  # already closed
+
+
+class TimeoutTransportMixin(object):
+    """Set separate connect and read timeouts on XMLRPC connections.
+
+    If a `Deadline` is set as `deadline`, it watches all connections.
+    """
+    connect_timeout = CONNECT_TIMEOUT
+    read_timeout = READ_TIMEOUT
+    deadline = None
+
+    def make_connection(self, host):
+        conn = super(TimeoutTransportMixin, self).make_connection(host)
+        conn.timeout = self.connect_timeout
+        if getattr(conn, 'waeup_timeouts_set', False):
+            return conn
+        connect = conn.connect
+
+        def connect_and_set_read_timeout():
+            connect()
+            conn.sock.settimeout(self.read_timeout)
+            if self.deadline is not None:
+                self.deadline.watch(conn.sock)
+        conn.connect = connect_and_set_read_timeout
+        conn.waeup_timeouts_set = True
+        return conn
+
+
+class TimeoutTransport(TimeoutTransportMixin, xmlrpcclient.Transport):
+    """An XMLRPC transport for HTTP with connect and read timeouts.
+    """
+
+
+class SafeTimeoutTransport(
+        TimeoutTransportMixin, xmlrpcclient.SafeTransport):
+    """An XMLRPC transport for HTTPS with connect and read timeouts.
+    """
+
+
+def get_server_proxy(url, connect_timeout=CONNECT_TIMEOUT,
+                     read_timeout=READ_TIMEOUT, deadline=None):
+    """Get an XMLRPC server proxy for `url` with timeouts set.
+
+    `deadline`, if given, is a `Deadline` aborting calls in flight.
+    """
+    if urlparse.urlparse(url).scheme == 'https':
+        transport = SafeTimeoutTransport()
+    else:
+        transport = TimeoutTransport()
+    transport.connect_timeout = connect_timeout
+    transport.read_timeout = read_timeout
+    transport.deadline = deadline
+    return xmlrpcclient.ServerProxy(url, transport=transport)
+
+
+def http_call(url, codec, method_name, args=(),
+              connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+              deadline=None):
+    """Call `method_name` with `args` on server `url`, using `codec`.
+
+    `codec` is a wire codec as defined in the `wire` module. The
+    request is POSTed to the codec's path on the server. Credentials
+    contained in `url` are sent via basic auth. `deadline`, if given,
+    is a `Deadline` aborting the call in flight.
+
+    Returns the call result. HTTP errors raise
+    `xmlrpc.client.ProtocolError`, as with XMLRPC server proxies.
+    """
+    parts = urlparse.urlparse(url)
+    if parts.scheme == 'https':
+        conn = httpclient.HTTPSConnection(
+            parts.hostname, parts.port, timeout=connect_timeout)
+    else:
+        conn = httpclient.HTTPConnection(
+            parts.hostname, parts.port, timeout=connect_timeout)
+    headers = {'Content-Type': codec.content_type}
+    if parts.username is not None:
+        creds = '%s:%s' % (
+            urlparse.unquote(parts.username),
+            urlparse.unquote(parts.password or ''))
+        headers['Authorization'] = 'Basic %s' % (
+            b64encode(creds.encode('utf-8')).decode('ascii'))
+    try:
+        conn.connect()
+        conn.sock.settimeout(read_timeout)
+        if deadline is not None:
+            deadline.watch(conn.sock)
+        conn.request(
+            'POST', codec.path, codec.dumps_request(method_name, args),
+            headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise xmlrpcclient.ProtocolError(
+                '%s:%s%s' % (parts.hostname, parts.port, codec.path),
+                response.status, response.reason,
+                dict(response.getheaders()))
+        return codec.loads_response(data)
+    finally:
+        conn.close()
+
+
+def is_transient_error(err):
+    """Tell whether `err` might vanish when we try again.
+
+    Network errors (including timeouts), HTTP server errors and
+    truncated or garbled responses (`http.client.HTTPException` like
+    `IncompleteRead`, or XML parse errors) are considered transient.
+    XMLRPC faults and HTTP client errors (like failed authentication)
+    are not.
+    """
+    if isinstance(err, xmlrpcclient.ProtocolError):
+        return err.errcode >= 500
+    return isinstance(err, (
+        socket.error, socket.timeout, httpclient.HTTPException, ExpatError))
+
+
+def call_kofa(url, method_name, args=(), retries=0, breaker=None,
+              connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+              deadline=CALL_DEADLINE, backoff=RETRY_BACKOFF, codec=None):
+    """Call XMLRPC method `method_name` with `args` on server `url`.
+
+    `codec` is the name of the wire codec to use. By default we use
+    `default_codec`, normally ``xmlrpc``.
+
+    Transient errors (see `is_transient_error`) are retried up to
+    `retries` times with a jittered exponential backoff. Only pass
+    `retries` for idempotent methods. The whole call, including all
+    retries, takes at most `deadline` seconds. Calls still running
+    then are aborted with `socket.timeout`.
+
+    If a `CircuitBreaker` is given as `breaker`, we raise
+    `ServerUnavailable` immediately while the breaker is open and
+    report success or failure of the call to it.
+
+    Returns the call result or raises the last exception.
+    """
+    if breaker is not None and not breaker.allow():
+        raise ServerUnavailable("Server unavailable: %s" % (
+            urlparse.urlparse(url).hostname, ))
+    codec = get_codec(codec or default_codec)
+    end = time.time() + deadline
+    call_deadline = Deadline(end).start()
+    try:
+        return _call_until(
+            url, codec, method_name, args, retries, breaker, connect_timeout,
+            read_timeout, call_deadline, backoff)
+    finally:
+        call_deadline.cancel()
+
+
+def _call_until(url, codec, method_name, args, retries, breaker,
+                connect_timeout, read_timeout, deadline, backoff):
+    # the retry loop of `call_kofa`
+    attempt = 0
+    while True:
+        remaining = max(deadline.end - time.time(), 0.001)
+        timeouts = (min(connect_timeout, remaining),
+                    min(read_timeout, remaining))
+        try:
+            if codec.name == 'xmlrpc':
+                proxy = get_server_proxy(url, *timeouts, deadline=deadline)
+                result = getattr(proxy, method_name)(*args)
+            else:
+                result = http_call(
+                    url, codec, method_name, args, *timeouts,
+                    deadline=deadline)
+        except Exception as err:
+            if deadline.expired:
+                err = socket.timeout("Call deadline exceeded")
+            transient = is_transient_error(err)
+            delay = random.uniform(0, backoff * 2 ** attempt)
+            if not transient or attempt >= retries or (
+                    time.time() + delay >= deadline.end):
+                if breaker is not None:
+                    if transient:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()  # server answered
+                raise err
+            time.sleep(delay)
+            attempt += 1
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
 def get_url(netlocation, username, password):
     """Create a valid URL from the given parts.
 
@@ -51,7 +422,50 @@ def get_url(netlocation, username, password):
     return urlparse.urlunparse(parts_list)
 
 
-def store_fingerprint(url, student_id, finger_num, data_file_path):
+def is_unreachable_error(err):
+    """Tell whether `err` means that the server could not be reached.
+
+    This is the case for transient errors (see `is_transient_error`)
+    and `ServerUnavailable`. Other errors come from servers that
+    answered.
+    """
+    return isinstance(err, ServerUnavailable) or is_transient_error(err)
+
+
+def get_error_message(err):
+    """Turn exception `err` from a webservice call into a message.
+    """
+    if isinstance(err, xmlrpcclient.Fault):
+        return "Error %s: %s" % (err.faultCode, err.faultString)
+    elif isinstance(err, xmlrpcclient.ProtocolError):
+        return "Error: %s %s" % (err.errcode, err.errmsg)
+    return "Error: %s" % err
+
+
+#: Methods supported by servers, by server URL.
+_server_methods = dict()
+
+
+def get_server_methods(url, breaker=None):
+    """Get the set of XMLRPC methods supported by server `url`.
+
+    The server is asked via introspection (``system.listMethods``)
+    once. Results are cached. If the server does not support
+    introspection, we get an empty set.
+    """
+    if url in _server_methods:
+        return _server_methods[url]
+    try:
+        methods = set(call_kofa(
+            url, 'system.listMethods', retries=RETRIES, breaker=breaker))
+    except xmlrpcclient.Fault:
+        methods = set()
+    _server_methods[url] = methods
+    return methods
+
+
+def store_fingerprint(url, student_id, finger_num, data_file_path,
+                      breaker=None):
     """Store a fingerprint on a Kofa server.
 
     Returns `None` on success or some message otherwise.
@@ -68,34 +482,137 @@ def store_fingerprint(url, student_id, finger_num, data_file_path):
     `data_file_path` is the path to a file that contains the
     fingerprint minutiae, i.e. the fingerprint data as produced by
     libfprint.
+
+    `breaker` is an optional `CircuitBreaker`. Uploads are not retried.
+    """
+    with open(data_file_path, 'rb') as fd:
+        data_to_store = fd.read()
+    return store_fingerprints(
+        url, student_id, {finger_num: data_to_store}, breaker=breaker)
+
+
+def store_fingerprints(url, student_id, fingerprints, breaker=None,
+                       raise_unreachable=False):
+    """Store several fingerprints of a student in one request.
+
+    `fingerprints` is a dict mapping finger numbers to fingerprint
+    data (any bytes-like object, `memoryview` for instance). The data
+    is not copied before encoding. All other arguments and the result
+    are the same as for `store_fingerprint`. See `get_fingerprints`
+    for `raise_unreachable`.
     """
-    server_proxy = xmlrpcclient.ServerProxy(url)
-    data_to_store = xmlrpcclient.Binary(open(data_file_path, 'rb').read())
-    fingerprint = {str(finger_num): data_to_store}
+    fingerprints = dict(
+        (str(finger_num), binary_view(data))
+        for finger_num, data in fingerprints.items())
     result = None
     try:
-        result = server_proxy.put_student_fingerprints(
-            student_id, fingerprint)
-    except xmlrpcclient.Fault as err:
-        result = "Error %s: %s" % (err.faultCode, err.faultString)
-    except xmlrpcclient.ProtocolError as err:
-        result = "Error: %s %s" % (err.errcode, err.errmsg)
+        result = call_kofa(
+            url, 'put_student_fingerprints', (student_id, fingerprints),
+            breaker=breaker)
     except Exception as err:
-        result = "Error: %s" % err
+        if raise_unreachable and is_unreachable_error(err):
+            raise
+        result = get_error_message(err)
     return result
 
 
-def get_fingerprints(url, student_id):
+def get_fingerprints(url, student_id, breaker=None, retries=RETRIES,
+                     raise_unreachable=False):
     """Get fingerprints of student with `student_id`.
+
+    Failed requests are retried `retries` times. `breaker` is an
+    optional `CircuitBreaker`. Errors are returned as messages. With
+    `raise_unreachable` errors telling that the server could not be
+    reached (see `is_unreachable_error`) are raised instead.
     """
-    server_proxy = xmlrpcclient.ServerProxy(url)
     result = None
     try:
-        result = server_proxy.get_student_fingerprints(student_id)
-    except xmlrpcclient.Fault as err:
-        result = "Error %s: %s" % (err.faultCode, err.faultString)
-    except xmlrpcclient.ProtocolError as err:
-        result = "Error: %s %s" % (err.errcode, err.errmsg)
+        result = call_kofa(
+            url, 'get_student_fingerprints', (student_id, ),
+            retries=retries, breaker=breaker)
     except Exception as err:
-        result = "Error: %s" % err
+        if raise_unreachable and is_unreachable_error(err):
+            raise
+        result = get_error_message(err)
     return result
+
+
+def get_templates(url, student_id, finger_nums=('1', ), breaker=None,
+                  retries=RETRIES, raise_unreachable=False):
+    """Get only the fingerprints of student `student_id`.
+
+    Different to `get_fingerprints` we do not fetch the student photo
+    and other data, if the server supports it. Servers that provide a
+    ``get_student_templates`` method (detected via introspection) send
+    only the fingerprints of `finger_nums`. With other servers we
+    fall back to ``get_student_fingerprints``. As these servers send
+    the student photo anyway, it is kept in ``img_name`` and ``img``
+    entries then, to save another download (see `extract_photo`).
+
+    Returns a dict with a ``fingerprints`` entry, an empty dict if no
+    such student exists, or an error message. See `get_fingerprints`
+    for `raise_unreachable`.
+    """
+    finger_nums = [str(num) for num in finger_nums]
+    try:
+        if 'get_student_templates' in get_server_methods(url, breaker):
+            result = call_kofa(
+                url, 'get_student_templates', (student_id, finger_nums),
+                retries=retries, breaker=breaker)
+        else:
+            result = call_kofa(
+                url, 'get_student_fingerprints', (student_id, ),
+                retries=retries, breaker=breaker)
+    except Exception as err:
+        if raise_unreachable and is_unreachable_error(err):
+            raise
+        return get_error_message(err)
+    if not result:
+        return result
+    fingerprints = result.get('fingerprints', {})
+    templates = dict(fingerprints=dict(
+        (num, fingerprints[num]) for num in finger_nums
+        if num in fingerprints))
+    if 'img' in result:
+        templates.update(img_name=result.get('img_name', ''),
+                         img=result['img'])
+    return templates
+
+
+def extract_photo(result):
+    """Get the photo from a student dict `result` sent by a server.
+
+    Returns a tuple ``(<IMG_NAME>, <IMG_DATA>)``.
+    """
+    img = result.get('img', b'')
+    if isinstance(img, xmlrpcclient.Binary):
+        img = img.data
+    return result.get('img_name', ''), img or b''
+
+
+def get_photo(url, student_id, breaker=None, retries=RETRIES,
+              raise_unreachable=False):
+    """Get the photo of student `student_id`.
+
+    Servers that provide a ``get_student_photo`` method (detected via
+    introspection) send only the photo. With other servers we fall
+    back to ``get_student_fingerprints``.
+
+    Returns a tuple ``(<IMG_NAME>, <IMG_DATA>)`` or an error message.
+    If no photo is stored, we get ``('', b'')``. See `get_fingerprints`
+    for `raise_unreachable`.
+    """
+    try:
+        if 'get_student_photo' in get_server_methods(url, breaker):
+            result = call_kofa(
+                url, 'get_student_photo', (student_id, ),
+                retries=retries, breaker=breaker)
+        else:
+            result = call_kofa(
+                url, 'get_student_fingerprints', (student_id, ),
+                retries=retries, breaker=breaker)
+    except Exception as err:
+        if raise_unreachable and is_unreachable_error(err):
+            raise
+        return get_error_message(err)
+    return extract_photo(result)
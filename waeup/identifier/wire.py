@@ -0,0 +1,232 @@
+#
+#    waeup.identifier - identifiy WAeUP Kofa students biometrically
+#    Copyright (C) 2014  Uli Fouquet, WAeUP Germany
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Wire codecs for webservice calls.
+
+A codec turns method calls and their results into bytes sent over
+HTTP and back. Each codec is served on its own HTTP path.
+
+Two codecs are available:
+
+* ``xmlrpc``: plain XMLRPC as understood by Kofa. The default.
+
+* ``binary``: a compact binary format. Binary data (like fingerprints)
+  is sent as-is instead of base64 encoded. Needs server support.
+
+Both codecs represent binary data as `xmlrpc.client.Binary` instances
+in decoded values, so results look the same, whatever codec was used.
+"""
+import struct
+try:
+    import xmlrpc.client as xmlrpcclient  # Python 3.x
+except ImportError:                       # pragma: no cover
+    import xmlrpclib as xmlrpcclient      # Python 2.x
+
+
+class XMLRPCCodec(object):
+    """Encode calls as XMLRPC.
+    """
+    name = 'xmlrpc'
+    path = '/RPC2'
+    content_type = 'text/xml'
+
+    def dumps_request(self, method_name, params):
+        return xmlrpcclient.dumps(
+            tuple(params), method_name, encoding='utf-8').encode('utf-8')
+
+    def loads_request(self, data):
+        params, method_name = xmlrpcclient.loads(data)
+        return method_name, list(params)
+
+    def dumps_response(self, result):
+        return xmlrpcclient.dumps(
+            (result, ), methodresponse=True,
+            encoding='utf-8').encode('utf-8')
+
+    def dumps_fault(self, fault_code, fault_string):
+        return xmlrpcclient.dumps(
+            xmlrpcclient.Fault(fault_code, fault_string),
+            encoding='utf-8').encode('utf-8')
+
+    def loads_response(self, data):
+        """Get the result from response `data`.
+
+        Raises `xmlrpc.client.Fault` if the response is a fault.
+        """
+        return xmlrpcclient.loads(data)[0][0]
+
+
+def binary_view(data):
+    """Wrap bytes-like `data` into a `xmlrpc.client.Binary` without copy.
+
+    `Binary` normally copies the data passed in. The instance returned
+    here references `data` (as `memoryview`) instead. Both codecs
+    encode it like any other `Binary`.
+    """
+    result = xmlrpcclient.Binary()
+    result.data = memoryview(data)
+    return result
+
+
+#: Magic bytes starting each message of the binary codec.
+BINARY_MAGIC = b'WB1'
+
+_LENGTH = struct.Struct('>I')
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+
+
+def _encode(value, out):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, int):
+        out += b'i' + _INT.pack(value)
+    elif isinstance(value, float):
+        out += b'd' + _FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out += b's' + _LENGTH.pack(len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += b'b' + _LENGTH.pack(len(value))
+        out += value
+    elif isinstance(value, xmlrpcclient.Binary):
+        _encode(value.data, out)
+    elif isinstance(value, (list, tuple)):
+        out += b'l' + _LENGTH.pack(len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b'm' + _LENGTH.pack(len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError("Cannot encode %r" % type(value))
+
+
+def _decode(view, pos):
+    tag = view[pos:pos + 1].tobytes()
+    pos += 1
+    if tag == b'N':
+        return None, pos
+    elif tag == b'T':
+        return True, pos
+    elif tag == b'F':
+        return False, pos
+    elif tag == b'i':
+        return _INT.unpack_from(view, pos)[0], pos + _INT.size
+    elif tag == b'd':
+        return _FLOAT.unpack_from(view, pos)[0], pos + _FLOAT.size
+    length = _LENGTH.unpack_from(view, pos)[0]
+    pos += _LENGTH.size
+    if tag == b's':
+        return str(view[pos:pos + length], 'utf-8'), pos + length
+    elif tag == b'b':
+        return xmlrpcclient.Binary(view[pos:pos + length].tobytes()), (
+            pos + length)
+    elif tag == b'l':
+        result = []
+        for num in range(length):
+            item, pos = _decode(view, pos)
+            result.append(item)
+        return result, pos
+    elif tag == b'm':
+        result = dict()
+        for num in range(length):
+            key, pos = _decode(view, pos)
+            result[key], pos = _decode(view, pos)
+        return result, pos
+    raise ValueError("Invalid binary message: unknown tag %r" % tag)
+
+
+def binary_dumps(value):
+    """Encode `value` in binary format.
+    """
+    out = bytearray(BINARY_MAGIC)
+    _encode(value, out)
+    return bytes(out)
+
+
+def binary_loads(data):
+    """Decode `data` in binary format.
+
+    Raises `ValueError` for invalid data.
+    """
+    view = memoryview(data)
+    if view[:len(BINARY_MAGIC)].tobytes() != BINARY_MAGIC:
+        raise ValueError("Invalid binary message: wrong magic")
+    try:
+        value, pos = _decode(view, len(BINARY_MAGIC))
+    except struct.error as err:
+        raise ValueError("Invalid binary message: %s" % err)
+    if pos != len(view):
+        raise ValueError("Invalid binary message: trailing data")
+    return value
+
+
+class BinaryCodec(object):
+    """Encode calls in a compact binary format.
+
+    Requests are encoded as ``[<METHOD_NAME>, <PARAMS>]``, responses as
+    ``{'result': <RESULT>}`` or ``{'fault': [<CODE>, <STRING>]}``.
+    """
+    name = 'binary'
+    path = '/binary'
+    content_type = 'application/x-waeup-binary'
+
+    def dumps_request(self, method_name, params):
+        return binary_dumps([method_name, list(params)])
+
+    def loads_request(self, data):
+        method_name, params = binary_loads(data)
+        return method_name, params
+
+    def dumps_response(self, result):
+        return binary_dumps({'result': result})
+
+    def dumps_fault(self, fault_code, fault_string):
+        return binary_dumps({'fault': [fault_code, fault_string]})
+
+    def loads_response(self, data):
+        """Get the result from response `data`.
+
+        Raises `xmlrpc.client.Fault` if the response is a fault.
+        """
+        response = binary_loads(data)
+        if 'fault' in response:
+            raise xmlrpcclient.Fault(*response['fault'])
+        return response['result']
+
+
+#: Available codecs by name.
+CODECS = dict(
+    (codec.name, codec) for codec in (XMLRPCCodec(), BinaryCodec()))
+
+
+def get_codec(name):
+    """Get the codec registered under `name`.
+
+    Raises `ValueError` for unknown codec names.
+    """
+    if name not in CODECS:
+        raise ValueError("No such wire codec: %s" % name)
+    return CODECS[name]